@@ -0,0 +1,649 @@
+# async_client.py - 基于 asyncio 的 SiliconFlow / 密钥服务客户端：按主机复用 keep-alive 连接、限制总并发、请求体和响应体都可流式传输
+# 只用标准库实现 HTTP/1.1；一个事件循环即可同时维持数百个进行中的请求，不再需要每个请求一个线程
+# 同步代码（Streamlit 页面）通过 SyncClient 在后台事件循环线程中调用
+# 并发上限可通过环境变量 ASYNC_MAX_CONCURRENCY / ASYNC_MAX_CONNECTIONS_PER_HOST 配置
+import asyncio
+import json
+import os
+import random
+import ssl
+import threading
+import time
+import uuid
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+SILICONFLOW_BASE_URL = os.environ.get("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1").rstrip("/")
+KMS_BASE_URL = os.environ.get("KMS_BASE_URL", "http://localhost:8503").rstrip("/")
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", "256"))
+ASYNC_MAX_CONNECTIONS_PER_HOST = int(os.environ.get("ASYNC_MAX_CONNECTIONS_PER_HOST", "128"))
+
+CHUNK_SIZE = 64 * 1024
+# (连接超时, 读取超时)，与 requests 的 timeout 元组含义相同：读取超时针对每次读操作
+Timeout = Union[float, Tuple[float, float]]
+
+
+class ClientError(Exception):
+    """连接失败、连接被对端关闭或响应格式错误"""
+
+
+class ClientTimeout(ClientError):
+    """连接或读取超时"""
+
+
+class _Headers(dict):
+    """响应头，键统一为小写，get 时不区分大小写"""
+
+    def get(self, key, default=None):
+        return super().get(key.lower(), default)
+
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+    def __contains__(self, key):
+        return super().__contains__(key.lower())
+
+
+class _Connection:
+    __slots__ = ("key", "reader", "writer", "idle_since")
+
+    def __init__(self, key: Tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.idle_since = 0.0
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class AsyncResponse:
+    """HTTP 响应。stream=False 时正文已读入 content；stream=True 时用 iter_chunks() 读取，读完或 release() 后连接归还连接池"""
+
+    def __init__(self, pool: "ConnectionPool", conn: _Connection, method: str, status_code: int,
+                 reason: str, headers: _Headers, keep_alive: bool, read_timeout: float):
+        self._pool = pool
+        self._conn: Optional[_Connection] = conn
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content: Optional[bytes] = None
+        self._keep_alive = keep_alive
+        self._read_timeout = read_timeout
+        self._consumed = False
+        if method == "HEAD" or status_code in (204, 304) or 100 <= status_code < 200:
+            self._mode, self._remaining = "length", 0
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            self._mode, self._remaining = "chunked", 0
+        elif headers.get("content-length") is not None:
+            self._mode, self._remaining = "length", int(headers["content-length"])
+        else:
+            # 没有长度信息时读到连接关闭，连接不能复用
+            self._mode, self._remaining = "eof", 0
+            self._keep_alive = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
+
+    @property
+    def text(self) -> str:
+        return (self.content or b"").decode(self._charset(), "replace")
+
+    def json(self):
+        return json.loads(self.content or b"null")
+
+    def _charset(self) -> str:
+        for part in self.headers.get("content-type", "").split(";")[1:]:
+            name, _, value = part.strip().partition("=")
+            if name.lower() == "charset" and value:
+                return value.strip('"')
+        return "utf-8"
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, self._read_timeout)
+        except asyncio.TimeoutError:
+            raise ClientTimeout(f"读取响应超过 {self._read_timeout:.1f} 秒") from None
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            raise ClientError(f"读取响应失败: {e}") from None
+
+    async def iter_chunks(self, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """逐块读取正文，读完后自动归还连接；中途停止读取时需调用 release()"""
+        if self.content is not None:
+            if self.content:
+                yield self.content
+            return
+        reader = self._conn.reader if self._conn else None
+        try:
+            while reader is not None and not self._consumed:
+                if self._mode == "length":
+                    if self._remaining <= 0:
+                        self._consumed = True
+                        break
+                    chunk = await self._read(reader.readexactly(min(chunk_size, self._remaining)))
+                    self._remaining -= len(chunk)
+                elif self._mode == "chunked":
+                    if self._remaining <= 0:
+                        size_line = await self._read(reader.readline())
+                        self._remaining = int(size_line.split(b";")[0].strip() or b"0", 16)
+                        if self._remaining == 0:
+                            # 读掉 trailer 直到空行
+                            while (await self._read(reader.readline())) not in (b"\r\n", b"\n", b""):
+                                pass
+                            self._consumed = True
+                            break
+                    chunk = await self._read(reader.readexactly(min(chunk_size, self._remaining)))
+                    self._remaining -= len(chunk)
+                    if self._remaining == 0:
+                        await self._read(reader.readline())
+                else:
+                    chunk = await self._read(reader.read(chunk_size))
+                    if not chunk:
+                        self._consumed = True
+                        break
+                yield chunk
+        except BaseException:
+            self._keep_alive = False
+            await self.release()
+            raise
+        await self.release()
+
+    async def read(self) -> bytes:
+        if self.content is None:
+            parts = [chunk async for chunk in self.iter_chunks()]
+            self.content = b"".join(parts)
+        return self.content
+
+    async def release(self):
+        """归还连接：正文已读完且可以 keep-alive 时放回连接池，否则关闭连接"""
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            self._pool._release(conn, reusable=self._keep_alive and self._consumed)
+
+
+class ConnectionPool:
+    """按 (scheme, host, port) 复用 keep-alive 连接；max_concurrency 限制同时进行的请求总数，
+    max_per_host 限制每个主机的连接数（进行中的请求在释放前一直占用名额）"""
+
+    def __init__(self, max_concurrency: int = ASYNC_MAX_CONCURRENCY, max_per_host: int = ASYNC_MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout: float = 30.0, ssl_context: Optional[ssl.SSLContext] = None):
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self._idle: Dict[Tuple, List[_Connection]] = {}
+        self._concurrency: Optional[asyncio.Semaphore] = None
+        self._host_slots: Dict[Tuple, asyncio.Semaphore] = {}
+        self._stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0, "errors": 0,
+                       "in_flight": 0, "peak_in_flight": 0}
+
+    def _slots(self, key: Tuple) -> Tuple[asyncio.Semaphore, asyncio.Semaphore]:
+        # 信号量在第一次使用时创建，绑定到调用方的事件循环
+        if self._concurrency is None:
+            self._concurrency = asyncio.Semaphore(self.max_concurrency)
+        if key not in self._host_slots:
+            self._host_slots[key] = asyncio.Semaphore(self.max_per_host)
+        return self._concurrency, self._host_slots[key]
+
+    async def _connect(self, key: Tuple, connect_timeout: float) -> Tuple[_Connection, bool]:
+        """取一个空闲连接（返回 reused=True）或新建连接"""
+        idle = self._idle.get(key, [])
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if now - conn.idle_since < self.idle_timeout and not conn.reader.at_eof():
+                self._stats["connections_reused"] += 1
+                return conn, True
+            conn.close()
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            ssl_context = self.ssl_context or ssl.create_default_context()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=ssl_context, limit=CHUNK_SIZE * 4), connect_timeout)
+        except asyncio.TimeoutError:
+            raise ClientTimeout(f"连接 {host}:{port} 超过 {connect_timeout:.1f} 秒") from None
+        except OSError as e:
+            raise ClientError(f"无法连接 {host}:{port}: {e}") from None
+        self._stats["connections_opened"] += 1
+        return _Connection(key, reader, writer), False
+
+    def _release(self, conn: _Connection, reusable: bool):
+        if reusable:
+            conn.idle_since = time.monotonic()
+            self._idle.setdefault(conn.key, []).append(conn)
+        else:
+            conn.close()
+        self._stats["in_flight"] -= 1
+        concurrency, host_slots = self._slots(conn.key)
+        host_slots.release()
+        concurrency.release()
+
+    async def request(self, method: str, url: str, headers: Optional[Dict[str, str]] = None,
+                      body=None, content_length: Optional[int] = None, timeout: Timeout = (10.0, 300.0),
+                      stream: bool = False) -> AsyncResponse:
+        """发送请求。body 可以是 bytes、同步/异步的字节块迭代器或带 read() 的文件对象；
+        长度未知的流式请求体使用 chunked 编码。stream=False 时读完正文并归还连接"""
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        host_header = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        replayable = body is None or isinstance(body, (bytes, bytearray))
+        if replayable:
+            content_length = len(body or b"")
+
+        head = {"Host": host_header, "User-Agent": "siliconflow-async/1.0", "Accept-Encoding": "identity",
+                "Connection": "keep-alive"}
+        head.update(headers or {})
+        if content_length is not None:
+            if body is not None or method not in ("GET", "HEAD"):
+                head["Content-Length"] = str(content_length)
+        else:
+            head["Transfer-Encoding"] = "chunked"
+        request_head = (f"{method} {target} HTTP/1.1\r\n"
+                        + "".join(f"{name}: {value}\r\n" for name, value in head.items()) + "\r\n").encode("latin-1")
+
+        concurrency, host_slots = self._slots(key)
+        await concurrency.acquire()
+        try:
+            await host_slots.acquire()
+        except BaseException:
+            concurrency.release()
+            raise
+        self._stats["requests"] += 1
+        self._stats["in_flight"] += 1
+        self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], self._stats["in_flight"])
+
+        conn = None
+        try:
+            # 复用的空闲连接可能已被服务器关闭：请求体可重放时换新连接重试一次
+            for attempt in range(2):
+                conn, reused = await self._connect(key, connect_timeout)
+                try:
+                    await self._send(conn, request_head, body, chunked=content_length is None, timeout=read_timeout)
+                    status_code, reason, response_headers, version = await self._read_head(conn, read_timeout)
+                    break
+                except ClientError as e:
+                    conn.close()
+                    conn = None
+                    if not (reused and replayable and attempt == 0 and not isinstance(e, ClientTimeout)):
+                        raise
+            keep_alive = version != "HTTP/1.0" and response_headers.get("connection", "").lower() != "close"
+            response = AsyncResponse(self, conn, method, status_code, reason, response_headers, keep_alive, read_timeout)
+        except BaseException:
+            self._stats["errors"] += 1
+            if conn is not None:
+                conn.close()
+            self._stats["in_flight"] -= 1
+            host_slots.release()
+            concurrency.release()
+            raise
+
+        if not stream:
+            await response.read()
+        return response
+
+    async def _send(self, conn: _Connection, request_head: bytes, body, chunked: bool, timeout: float):
+        async def drain():
+            try:
+                await asyncio.wait_for(conn.writer.drain(), timeout)
+            except asyncio.TimeoutError:
+                raise ClientTimeout(f"发送请求超过 {timeout:.1f} 秒") from None
+            except ConnectionError as e:
+                raise ClientError(f"发送请求失败: {e}") from None
+
+        conn.writer.write(request_head)
+        if isinstance(body, (bytes, bytearray)):
+            conn.writer.write(body)
+            await drain()
+            return
+        await drain()
+        if body is None:
+            return
+        async for chunk in _iter_body(body):
+            if not chunk:
+                continue
+            if chunked:
+                conn.writer.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+            else:
+                conn.writer.write(chunk)
+            await drain()
+        if chunked:
+            conn.writer.write(b"0\r\n\r\n")
+            await drain()
+
+    async def _read_head(self, conn: _Connection, timeout: float):
+        async def readline():
+            try:
+                line = await asyncio.wait_for(conn.reader.readline(), timeout)
+            except asyncio.TimeoutError:
+                raise ClientTimeout(f"等待响应超过 {timeout:.1f} 秒") from None
+            except (ConnectionError, ValueError) as e:
+                raise ClientError(f"读取响应失败: {e}") from None
+            if not line:
+                raise ClientError("连接已被服务器关闭")
+            return line
+
+        while True:
+            status_line = (await readline()).decode("latin-1").rstrip("\r\n")
+            version, _, rest = status_line.partition(" ")
+            code, _, reason = rest.partition(" ")
+            if not version.startswith("HTTP/") or not code.isdigit():
+                raise ClientError(f"无效的响应行: {status_line[:80]}")
+            headers = _Headers()
+            while True:
+                line = (await readline()).decode("latin-1").rstrip("\r\n")
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                name = name.strip().lower()
+                headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+            # 跳过 100 Continue 等中间响应
+            if int(code) >= 200 or int(code) == 101:
+                return int(code), reason, headers, version
+
+    async def close(self):
+        for connections in self._idle.values():
+            for conn in connections:
+                conn.close()
+        self._idle.clear()
+
+    def stats(self) -> Dict:
+        stats = dict(self._stats)
+        stats["idle_connections"] = sum(len(connections) for connections in self._idle.values())
+        return stats
+
+
+async def _iter_body(body) -> AsyncIterator[bytes]:
+    """把各种请求体统一为异步字节块迭代器；文件在线程池中分块读取，不阻塞事件循环"""
+    if hasattr(body, "__aiter__"):
+        async for chunk in body:
+            yield chunk
+    elif hasattr(body, "read"):
+        while True:
+            chunk = await asyncio.to_thread(body.read, CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        for chunk in body:
+            yield chunk
+
+
+class MultipartBody:
+    """流式 multipart/form-data 请求体，长度可预先计算（上游需要 Content-Length）；
+    files 的值为 (文件名, bytes 或文件对象, content_type)，on_progress(已发送字节数, 总字节数) 在每块发送前调用"""
+
+    def __init__(self, fields: Dict[str, str], files: Dict[str, Tuple[str, object, str]],
+                 on_progress: Optional[Callable[[int, int], None]] = None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.on_progress = on_progress
+        self._parts: List[Tuple[bytes, object, int]] = []
+        for name, value in fields.items():
+            header = (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                      f"{value}\r\n").encode("utf-8")
+            self._parts.append((header, None, 0))
+        for name, (filename, data, content_type) in files.items():
+            header = (f"--{self.boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                      f"Content-Type: {content_type}\r\n\r\n").encode("utf-8")
+            if isinstance(data, (bytes, bytearray)):
+                size = len(data)
+            else:
+                size = os.fstat(data.fileno()).st_size - data.tell()
+            self._parts.append((header, data, size))
+        self._closing = f"--{self.boundary}--\r\n".encode("ascii")
+        self.length = sum(len(header) + size + (2 if data is not None else 0) for header, data, size in self._parts) \
+            + len(self._closing)
+
+    async def __aiter__(self):
+        sent = 0
+
+        def progress(chunk: bytes) -> bytes:
+            nonlocal sent
+            if self.on_progress:
+                self.on_progress(sent, self.length)
+            sent += len(chunk)
+            return chunk
+
+        for header, data, _ in self._parts:
+            yield progress(header)
+            if data is None:
+                continue
+            if isinstance(data, (bytes, bytearray)):
+                for offset in range(0, len(data), CHUNK_SIZE):
+                    yield progress(bytes(data[offset:offset + CHUNK_SIZE]))
+            else:
+                async for chunk in _iter_body(data):
+                    yield progress(chunk)
+            yield progress(b"\r\n")
+        yield progress(self._closing)
+        if self.on_progress:
+            self.on_progress(sent, self.length)
+
+
+class AsyncSiliconFlowClient:
+    """SiliconFlow 语音接口：转录、语音合成（流式响应）和模型列表"""
+
+    def __init__(self, base_url: str = SILICONFLOW_BASE_URL, pool: Optional[ConnectionPool] = None):
+        self.base_url = base_url.rstrip("/")
+        self.pool = pool or ConnectionPool()
+
+    async def transcribe(self, master_key: str, audio, filename: str, model: str = "FunAudioLLM/SenseVoiceSmall",
+                         content_type: str = "audio/mpeg", timeout: Timeout = (10.0, 300.0),
+                         headers: Optional[Dict[str, str]] = None,
+                         on_progress: Optional[Callable[[int, int], None]] = None) -> AsyncResponse:
+        """上传音频转录；audio 为 bytes 或文件对象（按块流式上传，不整体读入内存）"""
+        body = MultipartBody({"model": model}, {"file": (filename, audio, content_type)}, on_progress)
+        request_headers = {"Authorization": f"Bearer {master_key}", "Content-Type": body.content_type}
+        request_headers.update(headers or {})
+        return await self.pool.request("POST", f"{self.base_url}/audio/transcriptions", request_headers,
+                                       body, content_length=body.length, timeout=timeout)
+
+    async def speech(self, master_key: str, payload: Dict, timeout: Timeout = (10.0, 300.0),
+                     headers: Optional[Dict[str, str]] = None, stream: bool = True) -> AsyncResponse:
+        """语音合成；默认返回流式响应，用 iter_chunks() 边下载边写入"""
+        request_headers = {"Authorization": f"Bearer {master_key}", "Content-Type": "application/json"}
+        request_headers.update(headers or {})
+        return await self.pool.request("POST", f"{self.base_url}/audio/speech", request_headers,
+                                       json.dumps(payload), timeout=timeout, stream=stream)
+
+    async def list_models(self, master_key: str, timeout: Timeout = (10.0, 30.0)) -> AsyncResponse:
+        return await self.pool.request("GET", f"{self.base_url}/models",
+                                       {"Authorization": f"Bearer {master_key}"}, timeout=timeout)
+
+
+class AsyncKMSClient:
+    """密钥服务全部端点；与 tts_or_stt.KeyManagementClient 一样，连接失败或超时按指数退避重试，
+    最终失败时返回 {"success": False, "error": ...}。没有幂等键的写操作（create_key、update_balance、delete_key）
+    超时后可能已在服务器生效，不重试，只在 503（请求未执行）时重试"""
+
+    def __init__(self, base_url: str = KMS_BASE_URL, pool: Optional[ConnectionPool] = None,
+                 timeout: float = 3.0, max_retries: int = 2):
+        self.base_url = base_url.rstrip("/")
+        self.pool = pool or ConnectionPool()
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+    async def _request(self, method: str, path: str, payload: Optional[Dict] = None,
+                       headers: Optional[Dict[str, str]] = None, retry: bool = True) -> AsyncResponse:
+        request_headers = {"Content-Type": "application/json"} if payload is not None else {}
+        request_headers.update(headers or {})
+        body = json.dumps(payload) if payload is not None else None
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.pool.request(method, f"{self.base_url}{path}", request_headers, body,
+                                                   timeout=self.timeout)
+                # 密钥服务饱和时返回 503 + Retry-After，被拒绝的请求没有执行，按提示等待（加随机抖动）后重试
+                if response.status_code == 503 and attempt < self.max_retries:
+                    try:
+                        wait = min(float(response.headers.get("retry-after", 1)), 5.0)
+                    except ValueError:
+                        wait = 1.0
+                    await asyncio.sleep(wait * random.uniform(1.0, 1.5))
+                    continue
+                return response
+            except ClientError:
+                if not retry or attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(0.1 * (2 ** attempt))
+
+    async def _call(self, endpoint: str, payload: Dict, headers: Optional[Dict[str, str]] = None,
+                    retry: bool = True) -> Dict:
+        try:
+            response = await self._request("POST", f"/api/{endpoint}", payload, headers, retry)
+            return response.json()
+        except (ClientError, ValueError) as e:
+            return {"success": False, "error": f"密钥服务连接失败: {str(e)}"}
+
+    async def validate_and_deduct(self, sub_key: str, amount: float = 1.0, idempotency_key: Optional[str] = None) -> Dict:
+        """扣费（amount 为负数时退款），重试使用同一幂等键"""
+        return await self._call("validate_and_deduct", {
+            "sub_key": sub_key, "amount": amount, "idempotency_key": idempotency_key or uuid.uuid4().hex})
+
+    async def get_balance(self, sub_key: str, etag: Optional[str] = None) -> Dict:
+        """查询余额；传入 etag 且余额未变化时返回 {"success": True, "not_modified": True}"""
+        headers = {"If-None-Match": etag} if etag else None
+        try:
+            response = await self._request("POST", "/api/get_balance", {"sub_key": sub_key}, headers)
+        except ClientError as e:
+            return {"success": False, "error": f"密钥服务连接失败: {str(e)}"}
+        if response.status_code == 304:
+            return {"success": True, "not_modified": True, "etag": etag}
+        result = response.json()
+        result["etag"] = response.headers.get("etag")
+        return result
+
+    async def create_key(self, master_key: str, balance: float = 100.0, description: str = "") -> Dict:
+        return await self._call("create_key", {"master_key": master_key, "balance": balance, "description": description},
+                                retry=False)
+
+    async def list_keys(self, master_key: str) -> Dict:
+        return await self._call("list_keys", {"master_key": master_key})
+
+    async def changes(self, master_key: str, since: int = 0, epoch: Optional[str] = None) -> Dict:
+        return await self._call("changes", {"master_key": master_key, "since": since, "epoch": epoch})
+
+    async def update_balance(self, master_key: str, sub_key: str, new_balance: float) -> Dict:
+        return await self._call("update_balance", {"master_key": master_key, "sub_key": sub_key, "new_balance": new_balance},
+                                retry=False)
+
+    async def delete_key(self, master_key: str, sub_key: str) -> Dict:
+        return await self._call("delete_key", {"master_key": master_key, "sub_key": sub_key}, retry=False)
+
+    async def acquire_lease(self, sub_key: str, amount: float, ttl: float = 300.0,
+                            idempotency_key: Optional[str] = None) -> Dict:
+        return await self._call("leases/acquire", {
+            "sub_key": sub_key, "amount": amount, "ttl": ttl, "idempotency_key": idempotency_key or uuid.uuid4().hex})
+
+    async def reconcile_lease(self, lease_id: str, used: float, release: bool = False,
+                              ttl: Optional[float] = None) -> Dict:
+        return await self._call("leases/reconcile", {"lease_id": lease_id, "used": used, "release": release, "ttl": ttl})
+
+    async def list_master_keys(self, master_key: str) -> Dict:
+        return await self._call("master_keys/list", {"master_key": master_key})
+
+    async def metrics(self) -> str:
+        """Prometheus 文本格式的指标"""
+        return (await self._request("GET", "/metrics")).text
+
+    async def health(self) -> Dict:
+        try:
+            return (await self._request("GET", "/health")).json()
+        except (ClientError, ValueError) as e:
+            return {"status": "unreachable", "error": str(e)}
+
+
+class SyncResponse:
+    """流式 AsyncResponse 的同步包装，iter_content() 可直接交给 ResultStore.put"""
+
+    def __init__(self, loop_thread: "SyncClient", response: AsyncResponse):
+        self._loop_thread = loop_thread
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    @property
+    def content(self) -> bytes:
+        return self._loop_thread.run(self._response.read())
+
+    @property
+    def text(self) -> str:
+        self.content
+        return self._response.text
+
+    def json(self):
+        self.content
+        return self._response.json()
+
+    def iter_content(self, chunk_size: int = CHUNK_SIZE) -> Iterable[bytes]:
+        chunks = self._response.iter_chunks(chunk_size)
+        try:
+            while True:
+                try:
+                    yield self._loop_thread.run(chunks.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        self._loop_thread.run(self._response.release())
+
+
+class SyncClient:
+    """在后台线程运行一个事件循环，供同步代码调用异步客户端：
+    client = SyncClient(); client.kms.get_balance(sub_key); client.siliconflow.speech(...) 返回 SyncResponse"""
+
+    def __init__(self, siliconflow_url: str = SILICONFLOW_BASE_URL, kms_url: str = KMS_BASE_URL,
+                 pool: Optional[ConnectionPool] = None):
+        self.pool = pool or ConnectionPool()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="async-client", daemon=True).start()
+        self.siliconflow = _SyncProxy(self, AsyncSiliconFlowClient(siliconflow_url, self.pool))
+        self.kms = _SyncProxy(self, AsyncKMSClient(kms_url, self.pool))
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """在后台事件循环中执行协程并等待结果（不能在该事件循环线程内调用）"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    def stats(self) -> Dict:
+        return self.run(self._stats())
+
+    async def _stats(self) -> Dict:
+        return self.pool.stats()
+
+    def close(self):
+        self.run(self.pool.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+class _SyncProxy:
+    """把异步客户端的方法包装为同步调用；返回流式响应时包装为 SyncResponse"""
+
+    def __init__(self, loop_thread: SyncClient, client):
+        self._loop_thread = loop_thread
+        self._client = client
+
+    def __getattr__(self, name: str):
+        method = getattr(self._client, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            result = self._loop_thread.run(method(*args, **kwargs))
+            return SyncResponse(self._loop_thread, result) if isinstance(result, AsyncResponse) else result
+        return call
@@ -0,0 +1,207 @@
+# batch_cli.py - 无界面批量 TTS/STT：读取 CSV/JSONL 清单并发处理，输出文件和结果清单，中断后重跑会跳过已完成的条目
+# 用法:
+#   python batch_cli.py tts prompts.csv --sub-key <子密钥> --output-dir out/tts --parallel 8
+#   python batch_cli.py stt archive.jsonl --sub-key <子密钥> --output-dir out/stt --parallel 4
+# 清单字段: id（可选，缺省为行号）；TTS: text, model, voice, speed, format；STT: path（相对清单所在目录）, model
+# 结果清单 <output-dir>/results.jsonl 每完成一条追加一行；已成功且输出文件存在的条目在重跑时跳过
+import argparse
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from async_client import KMS_BASE_URL, SILICONFLOW_BASE_URL, AsyncKMSClient, AsyncSiliconFlowClient, ConnectionPool
+from speech_jobs import DEFAULT_STT_MODEL, DEFAULT_TTS_MODEL, SpeechJobs, load_master_keys, stt_cost, tts_cost
+
+RESULTS_FILE = "results.jsonl"
+
+
+def load_manifest(path: str) -> List[Dict]:
+    """读取 CSV（带表头）或 JSONL 清单，没有 id 的条目用行号作为 id"""
+    with open(path, "r", encoding="utf-8-sig") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = list(csv.DictReader(f))
+    for index, item in enumerate(items, 1):
+        item["id"] = str(item.get("id") or index)
+    ids = [item["id"] for item in items]
+    if len(set(ids)) != len(ids):
+        raise ValueError("清单中存在重复的 id")
+    # 不同的 id 可能对应同一个输出文件（如 a/b 和 a_b，或大小写不敏感的文件系统上的 A 和 a），后完成的条目会覆盖前一个
+    seen = {}
+    for item_id in ids:
+        other = seen.setdefault(output_stem(item_id).lower(), item_id)
+        if other != item_id:
+            raise ValueError(f"id {other!r} 和 {item_id!r} 对应同一个输出文件，请修改其中一个")
+    return items
+
+
+def load_results(output_dir: str) -> Tuple[Dict[str, Dict], Dict[str, int]]:
+    """读取已有的结果清单，返回 (每个 id 最后一次结果, 每个 id 已失败的次数)"""
+    latest, failures = {}, {}
+    path = os.path.join(output_dir, RESULTS_FILE)
+    if not os.path.exists(path):
+        return latest, failures
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # 中断时写了一半的行
+            latest[record["id"]] = record
+            if record["status"] != "ok":
+                failures[record["id"]] = failures.get(record["id"], 0) + 1
+    return latest, failures
+
+
+def output_stem(item_id: str) -> str:
+    return re.sub(r"[^\w.-]", "_", item_id)
+
+
+def output_name(item_id: str, extension: str) -> str:
+    return output_stem(item_id) + "." + extension
+
+
+def pending_items(items: List[Dict], latest: Dict[str, Dict], output_dir: str) -> List[Dict]:
+    """尚未完成的条目：没有成功记录，或成功记录的输出文件已不存在"""
+    return [item for item in items
+            if not (latest.get(item["id"], {}).get("status") == "ok"
+                    and os.path.exists(os.path.join(output_dir, latest[item["id"]]["output"])))]
+
+
+def idempotency_key(kind: str, sub_key: str, item: Dict, attempt: int) -> str:
+    """同一条目、同一内容、同一尝试次数的扣费使用相同幂等键：进程在扣费后中断时，重跑会重放首次扣费而不是再扣一次；
+    失败并已退款的条目重跑时尝试次数加一，重新扣费"""
+    digest = hashlib.sha256(json.dumps([kind, sub_key, item], sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return f"batch:{digest.hexdigest()[:32]}:{attempt}"
+
+
+async def run_batch(args, items: List[Dict], manifest_dir: str) -> Dict:
+    os.makedirs(args.output_dir, exist_ok=True)
+    latest, failures = load_results(args.output_dir)
+    pending = pending_items(items, latest, args.output_dir)
+    print(f"清单 {len(items)} 条，已完成 {len(items) - len(pending)} 条，本次处理 {len(pending)} 条（并发 {args.parallel}）")
+
+    pool = ConnectionPool(max_concurrency=args.parallel * 2, max_per_host=args.parallel * 2)
+    jobs = SpeechJobs(AsyncSiliconFlowClient(args.siliconflow_url, pool), AsyncKMSClient(args.kms_url, pool),
+                      load_master_keys(args.master_keys), timeout=(10.0, args.timeout))
+    semaphore = asyncio.Semaphore(args.parallel)
+    summary = {"ok": 0, "failed": 0, "cost": 0.0}
+    results_file = open(os.path.join(args.output_dir, RESULTS_FILE), "a", encoding="utf-8")
+    done = [0]
+
+    async def process(item: Dict):
+        async with semaphore:
+            started = time.perf_counter()
+            attempt = failures.get(item["id"], 0)
+            key = idempotency_key(args.kind, args.sub_key, item, attempt)
+            if args.kind == "tts":
+                extension = item.get("format") or args.format
+                output = output_name(item["id"], extension)
+                result = await jobs.synthesize(
+                    args.sub_key, item["text"], os.path.join(args.output_dir, output),
+                    model=item.get("model") or args.model or DEFAULT_TTS_MODEL,
+                    voice=item.get("voice") or args.voice, speed=float(item.get("speed") or args.speed),
+                    response_format=extension, idempotency_key=key)
+            else:
+                output = output_name(item["id"], "txt")
+                result = await jobs.transcribe(
+                    args.sub_key, os.path.join(manifest_dir, item["path"]),
+                    model=item.get("model") or args.model or DEFAULT_STT_MODEL,
+                    convert=not args.no_convert, idempotency_key=key)
+                if result["success"]:
+                    with open(os.path.join(args.output_dir, output), "w", encoding="utf-8") as f:
+                        f.write(result["text"])
+
+        record = {"id": item["id"], "kind": args.kind, "status": "ok" if result["success"] else "error",
+                  "output": output if result["success"] else None, "cost": round(result["cost"], 2),
+                  "attempt": attempt + 1, "elapsed_s": round(time.perf_counter() - started, 3),
+                  "finished_at": time.time()}
+        if not result["success"]:
+            record["error"] = result["error"]
+        results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        results_file.flush()
+        summary["ok" if result["success"] else "failed"] += 1
+        summary["cost"] += result["cost"]
+        done[0] += 1
+        status = "完成" if result["success"] else f"失败: {result['error']}"
+        print(f"[{done[0]}/{len(pending)}] {item['id']} {status} ({record['elapsed_s']:.1f}s, ¥{record['cost']:.2f})")
+
+    async def process_safely(item: Dict):
+        try:
+            await process(item)
+        except (KeyError, ValueError, OSError) as e:
+            # 清单字段缺失或文件不存在：记录失败，不影响其他条目
+            record = {"id": item["id"], "kind": args.kind, "status": "error", "output": None, "cost": 0.0,
+                      "attempt": failures.get(item["id"], 0) + 1, "error": f"{type(e).__name__}: {e}",
+                      "finished_at": time.time()}
+            results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            results_file.flush()
+            summary["failed"] += 1
+            done[0] += 1
+            print(f"[{done[0]}/{len(pending)}] {item['id']} 失败: {record['error']}")
+
+    try:
+        await asyncio.gather(*(process_safely(item) for item in pending))
+    finally:
+        results_file.close()
+        await pool.close()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量语音合成 / 转录（不经过 Streamlit 页面）")
+    parser.add_argument("kind", choices=["tts", "stt"], help="tts 语音合成，stt 语音转文字")
+    parser.add_argument("manifest", help="清单文件（.csv 带表头，或 .jsonl）")
+    parser.add_argument("--sub-key", default=os.environ.get("BATCH_SUB_KEY", ""), help="计费使用的子密钥（或环境变量 BATCH_SUB_KEY）")
+    parser.add_argument("--output-dir", default="batch_output", help="输出目录，结果清单写在其中的 results.jsonl")
+    parser.add_argument("--parallel", type=int, default=4, help="同时处理的条目数")
+    parser.add_argument("--model", default="", help="默认模型（清单中的 model 字段优先）")
+    parser.add_argument("--voice", default="", help="TTS 默认语音（默认为模型的 alex）")
+    parser.add_argument("--speed", type=float, default=1.0, help="TTS 默认语速")
+    parser.add_argument("--format", default="mp3", choices=["mp3", "wav"], help="TTS 默认输出格式")
+    parser.add_argument("--no-convert", action="store_true", help="STT 不把 FLAC/M4A 转换为 MP3")
+    parser.add_argument("--timeout", type=float, default=300.0, help="上游读取超时（秒）")
+    parser.add_argument("--master-keys", default="master_keys.json", help="主密钥文件")
+    parser.add_argument("--siliconflow-url", default=SILICONFLOW_BASE_URL)
+    parser.add_argument("--kms-url", default=KMS_BASE_URL)
+    parser.add_argument("--dry-run", action="store_true", help="只统计待处理条目和预估费用")
+    args = parser.parse_args()
+
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    items = load_manifest(args.manifest)
+
+    if args.dry_run:
+        latest, _ = load_results(args.output_dir)
+        pending = pending_items(items, latest, args.output_dir)
+        if args.kind == "tts":
+            total = sum(tts_cost(item.get("text", "")) for item in pending)
+        else:
+            total = sum(stt_cost(os.path.getsize(os.path.join(manifest_dir, item["path"])))
+                        for item in pending if os.path.exists(os.path.join(manifest_dir, item["path"])))
+        print(f"清单 {len(items)} 条，待处理 {len(pending)} 条，预估费用 ¥{total:.2f}")
+        return
+
+    if not args.sub_key:
+        print("缺少子密钥：使用 --sub-key 或环境变量 BATCH_SUB_KEY")
+        sys.exit(2)
+
+    started = time.perf_counter()
+    try:
+        summary = asyncio.run(run_batch(args, items, manifest_dir))
+    except KeyboardInterrupt:
+        print("已中断，重新运行相同命令即可从中断处继续")
+        sys.exit(130)
+    print(f"成功 {summary['ok']} 条，失败 {summary['failed']} 条，费用 ¥{summary['cost']:.2f}，"
+          f"耗时 {time.perf_counter() - started:.1f}s；结果清单: {os.path.join(args.output_dir, RESULTS_FILE)}")
+    sys.exit(1 if summary["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
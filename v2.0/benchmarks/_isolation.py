@@ -0,0 +1,17 @@
+# _isolation.py - 基准脚本共用：在临时目录中导入服务器模块，避免模块级初始化改写真实的 keys.json / master_keys.json
+import importlib
+import os
+import sys
+import tempfile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 切换目录前的工作目录，脚本的输出路径相对于它解析
+ORIGINAL_CWD = os.getcwd()
+
+
+def isolated_import(name: str = "kms_api_server"):
+    """把工作目录切换到新建的临时目录后导入模块并返回；之后的相对路径都落在该临时目录中"""
+    if BASE_DIR not in sys.path:
+        sys.path.insert(0, BASE_DIR)
+    os.chdir(tempfile.mkdtemp(prefix="kms_bench_"))
+    return importlib.import_module(name)
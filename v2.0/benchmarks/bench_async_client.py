@@ -0,0 +1,168 @@
+# bench_async_client.py - 单进程能维持多少个进行中的上游请求：每请求一个线程的 requests 与 asyncio 客户端对比
+# 用法: python benchmarks/bench_async_client.py [--concurrency 50,200,800] [--duration 10] [--latency 0.5]
+# 自动启动 SiliconFlow 替身服务器（固定延迟），每种模式和并发数在独立的子进程中运行，记录吞吐、
+# 按 Little 定律折算的平均进行中请求数（吞吐 × 平均延迟）、延迟分位数、线程数、CPU 时间和峰值内存
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from async_client import AsyncSiliconFlowClient, ClientError, ConnectionPool
+from job_timing import percentile
+
+PAYLOAD = {"model": "FunAudioLLM/CosyVoice2-0.5B", "input": "并发基准", "voice": "FunAudioLLM/CosyVoice2-0.5B:alex",
+           "response_format": "mp3"}
+
+
+def run_threaded(base_url: str, concurrency: int, duration: float) -> Dict:
+    """当前前端的方式：每个进行中的请求占用一个线程"""
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    peak_threads = [0]
+
+    def worker():
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = requests.post(f"{base_url}/audio/speech", json=PAYLOAD, timeout=60,
+                                         headers={"Authorization": "Bearer sk-bench"})
+                ok = response.status_code == 200 and bool(response.content)
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+    for thread in threads:
+        thread.join()
+    return {"latencies": latencies, "errors": errors[0], "threads": peak_threads[0]}
+
+
+def run_async(base_url: str, concurrency: int, duration: float) -> Dict:
+    """asyncio 客户端：一个事件循环线程维持全部进行中的请求"""
+    latencies: List[float] = []
+    errors = [0]
+
+    async def main():
+        client = AsyncSiliconFlowClient(base_url, ConnectionPool(max_concurrency=concurrency, max_per_host=concurrency))
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    response = await client.speech("sk-bench", PAYLOAD, timeout=(10.0, 60.0), stream=False)
+                    ok = response.status_code == 200 and bool(response.content)
+                except ClientError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors[0] += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        await client.pool.close()
+
+    asyncio.run(main())
+    return {"latencies": latencies, "errors": errors[0], "threads": threading.active_count()}
+
+
+def worker_main(mode: str, base_url: str, concurrency: int, duration: float):
+    """子进程入口：运行一轮并把结果 JSON 打印到 stdout"""
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    result = (run_async if mode == "async" else run_threaded)(base_url, concurrency, duration)
+    elapsed = time.perf_counter() - started
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    latencies = sorted(result["latencies"])
+    throughput = len(latencies) / elapsed
+    mean_latency = sum(latencies) / len(latencies) if latencies else 0.0
+    print(json.dumps({
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": result["errors"],
+        "rps": round(throughput, 1),
+        "in_flight": round(throughput * mean_latency, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "threads": result["threads"],
+        "cpu_s": round(after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime, 2),
+        # Linux 下 ru_maxrss 单位为 KB
+        "peak_rss_mb": round(after.ru_maxrss / 1024, 1)
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="异步客户端并发能力基准")
+    parser.add_argument("--concurrency", default="50,200,800", help="要测试的并发数")
+    parser.add_argument("--duration", type=float, default=10.0, help="每轮时长（秒）")
+    parser.add_argument("--latency", type=float, default=0.5, help="替身服务器固定延迟（秒）")
+    parser.add_argument("--port", type=int, default=18514, help="替身服务器端口")
+    parser.add_argument("--modes", default="threaded,async")
+    parser.add_argument("--output", default="", help="结果 JSON 路径（可选）")
+    parser.add_argument("--worker", nargs=4, metavar=("MODE", "URL", "CONCURRENCY", "DURATION"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        mode, url, concurrency, duration = args.worker
+        worker_main(mode, url, int(concurrency), float(duration))
+        return
+
+    base_url = f"http://127.0.0.1:{args.port}/v1"
+    server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "fake_siliconflow.py"), "--port", str(args.port),
+                               "--latency", f"speech=fixed:{args.latency}"],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"http://127.0.0.1:{args.port}/stats", timeout=1)
+                break
+            except requests.RequestException:
+                time.sleep(0.1)
+        print(f"替身服务器固定延迟 {args.latency}s，每轮 {args.duration}s（理想进行中请求数 = 并发数）")
+        print(f"{'模式':<10}{'并发':>6}{'请求/秒':>10}{'进行中':>8}{'p50 ms':>9}{'p99 ms':>9}{'错误':>6}"
+              f"{'线程':>6}{'CPU s':>7}{'内存 MB':>9}")
+        for concurrency in [int(value) for value in args.concurrency.split(",") if value]:
+            for mode in args.modes.split(","):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", mode, base_url,
+                                         str(concurrency), str(args.duration)],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                print(f"{mode:<10}{concurrency:>6}{result['rps']:>10.1f}{result['in_flight']:>8.1f}"
+                      f"{result['p50_ms']:>9.0f}{result['p99_ms']:>9.0f}{result['errors']:>6}{result['threads']:>6}"
+                      f"{result['cpu_s']:>7.2f}{result['peak_rss_mb']:>9.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"tool": "bench_async_client", "python": platform.python_version(), "config": vars(args),
+                       "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+# bench_audio_convert.py - 音频格式转换基准：原 pydub 路径 vs ffmpeg 管道 / 直通 / 重封装
+# 在本地用 ffmpeg 生成 FLAC/M4A/WAV/MP3 测试音频（多种时长和采样率），每次转换在独立子进程中执行，
+# 记录墙钟时间、CPU 时间、峰值内存和输出大小，输出 JSON 报告和 SVG 图表，可与保存的基线对比
+# 用法:
+#   python benchmarks/bench_audio_convert.py --output benchmarks/results/audio_baseline.json
+#   python benchmarks/bench_audio_convert.py --formats flac,m4a --durations 60 --compare benchmarks/results/audio_baseline.json
+# 需要 ffmpeg 在 PATH 中
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows 下没有 resource 模块，只记录本进程 CPU 时间
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCHEMA_VERSION = 1
+ENGINES = ("pydub", "ffmpeg_pipe", "passthrough", "remux")
+# 生成测试音频使用的编码参数
+SOURCE_CODECS = {
+    "wav": ["-c:a", "pcm_s16le"],
+    "flac": ["-c:a", "flac"],
+    "m4a": ["-c:a", "aac", "-b:a", "128k"],
+    "mp3": ["-c:a", "libmp3lame", "-b:a", "128k"],
+}
+# 重封装：不重新编码，只把音频流放进可流式读取的容器
+REMUX_TARGETS = {"m4a": "adts", "flac": "flac", "wav": "wav", "mp3": "mp3"}
+
+
+# ---------------------- 测试音频 ----------------------
+def generate_source(directory: str, fmt: str, duration: int, sample_rate: int) -> str:
+    """生成带噪声的双声道正弦测试音频（纯正弦压缩率过高，不代表真实语音）"""
+    path = os.path.join(directory, f"src_{duration}s_{sample_rate}.{fmt}")
+    if os.path.exists(path):
+        return path
+    subprocess.run([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency=220:sample_rate={sample_rate}:duration={duration}",
+        "-f", "lavfi", "-i", f"anoisesrc=color=pink:amplitude=0.1:sample_rate={sample_rate}:duration={duration}",
+        "-filter_complex", "[0][1]amix=inputs=2,aformat=channel_layouts=stereo",
+        *SOURCE_CODECS[fmt], path
+    ], check=True)
+    return path
+
+
+# ---------------------- 转换路径（在子进程中执行） ----------------------
+def convert_pydub(input_path: str) -> bytes:
+    """改用转码池之前 convert_audio_format 的路径：写临时文件 → AudioSegment 解码 → 导出 MP3 → 读回"""
+    from pydub import AudioSegment
+    with open(input_path, "rb") as f:
+        data = f.read()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(input_path)[1]) as temp_input:
+        temp_input.write(data)
+        temp_input_path = temp_input.name
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as temp_output:
+        temp_output_path = temp_output.name
+    try:
+        audio = AudioSegment.from_file(temp_input_path)
+        audio.export(temp_output_path, format="mp3")
+        with open(temp_output_path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(temp_input_path)
+        os.unlink(temp_output_path)
+
+
+def convert_ffmpeg_pipe(input_path: str) -> bytes:
+    """输入经 stdin、输出经 stdout 的一次 ffmpeg 转码，不落临时文件"""
+    with open(input_path, "rb") as f:
+        data = f.read()
+    result = subprocess.run(["ffmpeg", "-v", "error", "-i", "pipe:0", "-vn", "-f", "mp3", "pipe:1"],
+                            input=data, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", "replace").strip()[-300:])
+    return result.stdout
+
+
+def convert_passthrough(input_path: str) -> bytes:
+    """不转换，直接上传原文件"""
+    with open(input_path, "rb") as f:
+        return f.read()
+
+
+def convert_remux(input_path: str) -> bytes:
+    """不重新编码，只更换容器（m4a 的 AAC 流放进 ADTS）"""
+    fmt = os.path.splitext(input_path)[1].lstrip(".")
+    result = subprocess.run(["ffmpeg", "-v", "error", "-i", input_path, "-vn", "-c:a", "copy",
+                             "-f", REMUX_TARGETS[fmt], "pipe:1"], capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", "replace").strip()[-300:])
+    return result.stdout
+
+
+CONVERTERS = {
+    "pydub": convert_pydub,
+    "ffmpeg_pipe": convert_ffmpeg_pipe,
+    "passthrough": convert_passthrough,
+    "remux": convert_remux,
+}
+
+
+def run_worker(engine: str, input_path: str):
+    """子进程入口：执行一次转换并以 JSON 输出测量结果"""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    error = None
+    output_bytes = 0
+    try:
+        output_bytes = len(CONVERTERS[engine](input_path))
+    except Exception as e:
+        error = str(e)
+    result = {
+        "wall_s": time.perf_counter() - wall_start,
+        "cpu_s": time.process_time() - cpu_start,
+        "output_bytes": output_bytes,
+        "error": error,
+        "peak_rss_mb": None,
+        "child_peak_rss_mb": None,
+    }
+    if resource is not None:
+        # ru_maxrss 在 Linux 上单位为 KB，在 macOS 上为字节
+        scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        result["cpu_s"] += children.ru_utime + children.ru_stime
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        result["child_peak_rss_mb"] = children.ru_maxrss / scale
+    print(json.dumps(result))
+
+
+def measure(engine: str, input_path: str, repeats: int) -> Dict:
+    """重复 repeats 次，每次一个新进程，取各项中位数"""
+    runs = []
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", engine, input_path],
+                                   capture_output=True, text=True)
+        try:
+            runs.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+        except (IndexError, json.JSONDecodeError):
+            runs.append({"error": completed.stderr.strip()[-300:] or "worker failed"})
+        if runs[-1].get("error"):
+            return {"error": runs[-1]["error"]}
+
+    def median(name):
+        values = [run[name] for run in runs if run.get(name) is not None]
+        return round(statistics.median(values), 4) if values else None
+
+    # 总峰值取 Python 进程与 ffmpeg 子进程之和，为上界：子进程的 ru_maxrss 可能包含 fork 时继承的父进程内存
+    python_rss, ffmpeg_rss = median("peak_rss_mb"), median("child_peak_rss_mb")
+    return {
+        "wall_s": median("wall_s"),
+        "cpu_s": median("cpu_s"),
+        "peak_rss_mb": round(python_rss + (ffmpeg_rss or 0), 1) if python_rss is not None else None,
+        "python_peak_rss_mb": python_rss,
+        "ffmpeg_peak_rss_mb": ffmpeg_rss,
+        "output_bytes": runs[-1]["output_bytes"],
+        "error": None,
+    }
+
+
+# ---------------------- 图表与对比 ----------------------
+def write_svg_chart(path: str, title: str, cases: List[str], series: Dict[str, List[Optional[float]]], unit: str):
+    """分组横向条形图：每个用例一组，每个转换路径一根条"""
+    colors = ["#4e79a7", "#f28e2b", "#59a14f", "#e15759", "#76b7b2", "#b07aa1"]
+    bar, gap, label_width, chart_width = 12, 10, 230, 520
+    group_height = bar * len(series) + gap
+    height = 60 + group_height * len(cases) + 20 * len(series)
+    peak = max([value for values in series.values() for value in values if value] or [1])
+    lines = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{label_width + chart_width + 120}" height="{height}" '
+             f'font-family="sans-serif" font-size="11">',
+             f'<text x="10" y="20" font-size="14" font-weight="bold">{title}</text>']
+    y = 40
+    for index, case in enumerate(cases):
+        lines.append(f'<text x="10" y="{y + group_height / 2}">{case}</text>')
+        for offset, (engine, values) in enumerate(series.items()):
+            value = values[index]
+            top = y + offset * bar
+            color = colors[offset % len(colors)]
+            if value is None:
+                lines.append(f'<text x="{label_width}" y="{top + bar - 2}" fill="#999">失败</text>')
+                continue
+            width = max(1, value / peak * chart_width)
+            lines.append(f'<rect x="{label_width}" y="{top}" width="{width:.1f}" height="{bar - 2}" fill="{color}"/>')
+            lines.append(f'<text x="{label_width + width + 4:.1f}" y="{top + bar - 3}">{value:.3g} {unit}</text>')
+        y += group_height
+    for offset, engine in enumerate(series):
+        top = y + 10 + offset * 20
+        lines.append(f'<rect x="10" y="{top}" width="12" height="12" fill="{colors[offset % len(colors)]}"/>')
+        lines.append(f'<text x="28" y="{top + 10}">{engine}</text>')
+    lines.append("</svg>")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+
+
+def result_key(result: Dict) -> Tuple:
+    return result["format"], result["duration_s"], result["sample_rate"], result["engine"]
+
+
+def compare_reports(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    """按 (格式, 时长, 采样率, 路径) 对比墙钟时间、CPU 时间和峰值内存，返回超出容差的退化项"""
+    old = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    print(f"\n对比基线 {baseline.get('git_revision') or '-'}（容差 {tolerance:.0%}）")
+    print(f"{'用例':<36}{'wall':>9}{'cpu':>9}{'rss':>9}")
+    for result in current["results"]:
+        before = old.get(result_key(result))
+        if not before or before.get("error") or result.get("error"):
+            continue
+        changes = []
+        for field in ("wall_s", "cpu_s", "peak_rss_mb"):
+            if before.get(field) and result.get(field) is not None:
+                changes.append((result[field] - before[field]) / before[field])
+            else:
+                changes.append(None)
+        label = "{}/{}s/{}Hz/{}".format(*result_key(result))
+        text = "".join(f"{change:>+9.1%}" if change is not None else f"{'-':>9}" for change in changes)
+        # 极短的转换（如直通）受进程调度影响大，只在绝对差超过 50ms 时才算时间退化
+        slow = changes[0] is not None and changes[0] > tolerance and result["wall_s"] - before["wall_s"] > 0.05
+        fat = changes[2] is not None and changes[2] > tolerance
+        print(f"{label:<36}{text}{'  ✗' if slow or fat else ''}")
+        if slow or fat:
+            regressions.append(label)
+    return regressions
+
+
+def ffmpeg_version() -> Optional[str]:
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        run_worker(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description="音频格式转换基准")
+    parser.add_argument("--formats", default="flac,m4a,wav,mp3", help="源音频格式，逗号分隔")
+    parser.add_argument("--durations", default="10,60,300", help="时长（秒），逗号分隔")
+    parser.add_argument("--sample-rates", default="16000,44100,48000", help="采样率，逗号分隔")
+    parser.add_argument("--engines", default=",".join(ENGINES), help="转换路径: " + "/".join(ENGINES))
+    parser.add_argument("--repeats", type=int, default=3, help="每个用例重复次数（取中位数）")
+    parser.add_argument("--cache-dir", default="", help="测试音频缓存目录（默认使用临时目录）")
+    parser.add_argument("--output", default="", help="结果 JSON 路径（默认 benchmarks/results/audio_convert_<时间>.json）")
+    parser.add_argument("--compare", default="", help="与之前的结果 JSON 对比，超出容差时以非零状态退出")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="对比时允许的相对退化")
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        print("未找到 ffmpeg，无法生成测试音频。请先安装 FFmpeg 并添加到 PATH")
+        sys.exit(2)
+
+    formats = [fmt for fmt in args.formats.split(",") if fmt]
+    durations = [int(value) for value in args.durations.split(",") if value]
+    sample_rates = [int(value) for value in args.sample_rates.split(",") if value]
+    engines = [engine for engine in args.engines.split(",") if engine]
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="audio_bench_")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    results = []
+    print(f"{'用例':<28}{'输入MB':>9}{'路径':>13}{'wall s':>9}{'cpu s':>9}{'RSS MB':>9}{'输出MB':>9}")
+    for fmt in formats:
+        for duration in durations:
+            for sample_rate in sample_rates:
+                source = generate_source(cache_dir, fmt, duration, sample_rate)
+                input_bytes = os.path.getsize(source)
+                for engine in engines:
+                    result = {"format": fmt, "duration_s": duration, "sample_rate": sample_rate,
+                              "engine": engine, "input_bytes": input_bytes, **measure(engine, source, args.repeats)}
+                    results.append(result)
+                    case = f"{fmt}/{duration}s/{sample_rate}Hz"
+                    if result["error"]:
+                        print(f"{case:<28}{input_bytes / 1048576:>9.2f}{engine:>13}  失败: {result['error'][:60]}")
+                        continue
+                    rss = f"{result['peak_rss_mb']:>9.1f}" if result["peak_rss_mb"] is not None else f"{'-':>9}"
+                    print(f"{case:<28}{input_bytes / 1048576:>9.2f}{engine:>13}{result['wall_s']:>9.3f}"
+                          f"{result['cpu_s']:>9.3f}{rss}{result['output_bytes'] / 1048576:>9.2f}")
+
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "tool": "bench_audio_convert",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count(), "ffmpeg": ffmpeg_version()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "cache_dir")},
+        "results": results,
+    }
+    output = args.output or os.path.join(BASE_DIR, "benchmarks", "results",
+                                         f"audio_convert_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    # 每个指标一张图，与 JSON 放在同一目录
+    cases = [(fmt, duration, sample_rate) for fmt in formats for duration in durations for sample_rate in sample_rates]
+    by_key = {result_key(result): result for result in results}
+    stem = os.path.splitext(output)[0]
+    for field, title, unit in (("wall_s", "墙钟时间", "s"), ("cpu_s", "CPU 时间", "s"),
+                               ("peak_rss_mb", "峰值内存", "MB"), ("output_bytes", "输出大小", "B")):
+        series = {engine: [by_key[(*case, engine)].get(field) if not by_key[(*case, engine)]["error"] else None
+                           for case in cases] for engine in engines}
+        write_svg_chart(f"{stem}_{field}.svg", title, [f"{c[0]}/{c[1]}s/{c[2]}Hz" for c in cases], series, unit)
+    print(f"\n结果已保存: {output}（图表: {stem}_*.svg）")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.tolerance)
+        if regressions:
+            print(f"性能退化 {len(regressions)} 项: {', '.join(regressions)}")
+            sys.exit(1)
+        print("未发现超出容差的退化")
+
+
+if __name__ == "__main__":
+    main()
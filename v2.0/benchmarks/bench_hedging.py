@@ -0,0 +1,121 @@
+# bench_hedging.py - 对冲请求对尾延迟的影响：替身服务器按概率注入长时间卡顿，对比关闭/开启对冲时 TTS 请求的延迟分位数和上游请求量
+# 用法: python benchmarks/bench_hedging.py [--requests 400] [--concurrency 8] [--stall 0.03:10] [--budget 0.1]
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import requests
+from werkzeug.serving import make_server
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from fake_siliconflow import FakeUpstream, create_app
+from hedging import HedgePolicy
+from job_timing import percentile
+
+MASTER_KEYS = ["sk-hedge-a", "sk-hedge-b", "sk-hedge-c"]
+
+
+def run_round(base_url: str, policy: HedgePolicy, args) -> Dict:
+    """并发发送 args.requests 个 TTS 请求，返回延迟分位数（毫秒）和失败数"""
+    latencies: List[float] = []
+    failures = [0]
+    lock = threading.Lock()
+    counter = iter(range(args.requests))
+    payload = json.dumps({"model": "FunAudioLLM/CosyVoice2-0.5B", "input": "对冲请求基准测试文本" * 3,
+                          "voice": "FunAudioLLM/CosyVoice2-0.5B:alex", "response_format": "mp3"})
+
+    def send(attempt):
+        return requests.post(f"{base_url}/audio/speech", data=payload, stream=True, timeout=300,
+                             headers={"Authorization": f"Bearer {attempt.master_key}",
+                                      "Content-Type": "application/json"})
+
+    def alternate(exclude):
+        return next(key for key in MASTER_KEYS if key != exclude)
+
+    def worker(index: int):
+        while True:
+            with lock:
+                item = next(counter, None)
+            if item is None:
+                return
+            started = time.perf_counter()
+            try:
+                response, _, _ = policy.call("tts", len(payload), send, MASTER_KEYS[item % len(MASTER_KEYS)], alternate)
+                ok = response.status_code == 200 and len(response.content) > 0
+            except requests.RequestException:
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "seconds": round(elapsed, 3),
+        "ok": len(latencies),
+        "failed": failures[0],
+        **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 90, 99)},
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="对冲请求尾延迟基准")
+    parser.add_argument("--requests", type=int, default=400, help="每轮请求数")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发数")
+    parser.add_argument("--latency", default="lognormal:0.2:0.3", help="替身服务器 speech 延迟分布")
+    parser.add_argument("--stall", default="0.03:10", help="卡顿注入（概率:秒）")
+    parser.add_argument("--percentile", type=float, default=95, help="对冲等待的延迟分位数")
+    parser.add_argument("--budget", type=float, default=0.1, help="对冲额度（对冲数/请求数）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="结果 JSON 路径（可选）")
+    args = parser.parse_args()
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    results = []
+    print(f"{args.requests} 个请求，并发 {args.concurrency}，延迟 {args.latency}，卡顿 {args.stall}")
+    print(f"{'对冲':<6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'上游请求':>10}{'对冲':>6}{'对冲胜出':>10}{'额度不足':>10}")
+    for enabled in (False, True):
+        # 每轮使用新的替身服务器和相同的随机种子，卡顿序列一致
+        upstream = FakeUpstream(keys=MASTER_KEYS, latency={"speech": args.latency}, stall=args.stall, seed=args.seed)
+        server = make_server("127.0.0.1", 0, create_app(upstream), threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        policy = HedgePolicy(enabled=enabled, percentile=args.percentile, min_delay=0.05,
+                             max_delay=2.0, budget=args.budget, min_samples=20)
+        try:
+            result = run_round(f"http://127.0.0.1:{server.server_port}/v1", policy, args)
+        finally:
+            server.shutdown()
+        with upstream.lock:
+            upstream_requests = upstream.stats.get("speech.requests", 0)
+        stats = policy.stats()
+        result.update(hedging=enabled, upstream_requests=upstream_requests, hedged=stats["hedged"],
+                      hedge_wins=stats["hedge_wins"], budget_denied=stats["budget_denied"],
+                      hedge_delay_ms=round(stats["delays"].get("tts", 0.0) * 1000, 1))
+        results.append(result)
+        print(f"{'开' if enabled else '关':<6}{result['p50_ms']:>10.0f}{result['p90_ms']:>10.0f}{result['p99_ms']:>10.0f}"
+              f"{result['max_ms']:>10.0f}{upstream_requests:>10}{stats['hedged']:>6}{stats['hedge_wins']:>10}"
+              f"{stats['budget_denied']:>10}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"tool": "bench_hedging", "config": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# bench_key_records.py - 子密钥记录模型微基准：整数分 KeyRecord vs 旧的浮点字典
+# 用法: python benchmarks/bench_key_records.py [--keys 100000] [--ops 200000]
+import argparse
+import os
+import random
+import time
+import tracemalloc
+from decimal import Decimal, ROUND_HALF_UP
+
+from _isolation import isolated_import
+
+isolated_import()
+from kms_api_server import KeyManagementSystem, KeyRecord, yuan_to_cents, cents_to_yuan
+
+
+class LegacyKeyStore:
+    """旧版表示：每个密钥一个浮点字典，每次操作都经过 Decimal(str(...)) 往返"""
+
+    def __init__(self):
+        self.keys = {}
+
+    def _round_decimal(self, value: Decimal) -> Decimal:
+        return value.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    def add(self, sub_key: str, balance: float):
+        self.keys[sub_key] = {
+            "balance": float(self._round_decimal(Decimal(str(balance)))),
+            "created_time": time.time(),
+            "description": "",
+            "is_active": True,
+            "used_amount": 0.0,
+            "last_used": None
+        }
+
+    def validate_and_deduct(self, sub_key: str, amount: float):
+        # 对应旧版 api_validate_and_deduct + deduct_balance + get_balance（不含持久化）
+        if sub_key not in self.keys or not self.keys[sub_key]["is_active"]:
+            return None
+        current_balance = Decimal(str(self.keys[sub_key]["balance"]))
+        amount_decimal = Decimal(str(amount)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        if amount_decimal > 0 and current_balance < amount_decimal:
+            return None
+        info = self.keys[sub_key]
+        current_balance = Decimal(str(info["balance"]))
+        amount_decimal = self._round_decimal(Decimal(str(float(amount_decimal))))
+        new_balance = current_balance - amount_decimal
+        info["used_amount"] = float(Decimal(str(info["used_amount"])) + amount_decimal)
+        info["balance"] = float(self._round_decimal(new_balance))
+        info["last_used"] = time.time()
+        return float(self._round_decimal(Decimal(str(info["balance"]))))
+
+
+def build_compact(key_ids):
+    kms = KeyManagementSystem(storage_file=os.path.join(os.getcwd(), "keys.json"))
+    kms._save_keys = lambda: True  # 只测量内存中的热路径
+    for sub_key in key_ids:
+        kms.keys[sub_key] = KeyRecord(balance_cents=yuan_to_cents(1000000), created_time=time.time())
+    return kms
+
+
+def build_legacy(key_ids):
+    store = LegacyKeyStore()
+    for sub_key in key_ids:
+        store.add(sub_key, 1000000)
+    return store
+
+
+def compact_validate_and_deduct(kms, sub_key, amount):
+    # 对应新版 api_validate_and_deduct：边界处一次转换，内部全部整数运算
+    amount_cents = yuan_to_cents(amount)
+    record = kms.keys.get(sub_key)
+    if record is None or not record.is_active:
+        return None
+    if amount_cents > 0 and record.balance_cents < amount_cents:
+        return None
+    if kms.deduct_cents(sub_key, amount_cents):
+        return cents_to_yuan(record.balance_cents)
+    return None
+
+
+def measure_memory(builder, key_ids):
+    tracemalloc.start()
+    store = builder(key_ids)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, current
+
+
+def measure_throughput(fn, store, workload):
+    start = time.perf_counter()
+    for sub_key, amount in workload:
+        fn(store, sub_key, amount)
+    return len(workload) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="KeyRecord 与旧版浮点字典的吞吐和内存对比")
+    parser.add_argument("--keys", type=int, default=100000, help="子密钥数量")
+    parser.add_argument("--ops", type=int, default=200000, help="validate_and_deduct 调用次数")
+    args = parser.parse_args()
+
+    key_ids = [f"{i:032x}" for i in range(args.keys)]
+    # 金额按前端实际计费分布：多数为最低 0.10，少量按大小计费，约 10% 为退款
+    rng = random.Random(42)
+    workload = []
+    for _ in range(args.ops):
+        amount = rng.choice([0.10, 0.10, 0.10, 0.37, 1.25, 12.5])
+        if rng.random() < 0.1:
+            amount = -amount
+        workload.append((rng.choice(key_ids), amount))
+
+    legacy, legacy_bytes = measure_memory(build_legacy, key_ids)
+    compact, compact_bytes = measure_memory(build_compact, key_ids)
+
+    legacy_ops = measure_throughput(LegacyKeyStore.validate_and_deduct, legacy, workload)
+    compact_ops = measure_throughput(compact_validate_and_deduct, compact, workload)
+
+    per_100k = 100000 / args.keys
+    print(f"密钥数: {args.keys}  操作数: {args.ops}")
+    print(f"{'表示':<12}{'ops/s':>14}{'MB/10万密钥':>16}")
+    print(f"{'legacy dict':<12}{legacy_ops:>14,.0f}{legacy_bytes * per_100k / 1024 / 1024:>16.2f}")
+    print(f"{'KeyRecord':<12}{compact_ops:>14,.0f}{compact_bytes * per_100k / 1024 / 1024:>16.2f}")
+    print(f"吞吐提升: {compact_ops / legacy_ops:.2f}x  内存节省: {1 - compact_bytes / legacy_bytes:.1%}")
+
+
+if __name__ == "__main__":
+    main()
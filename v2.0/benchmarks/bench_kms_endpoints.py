@@ -0,0 +1,253 @@
+# bench_kms_endpoints.py - 密钥服务各端点在不同密钥规模下的吞吐与延迟，以及 keys.json 写放大
+# 用法: python benchmarks/bench_kms_endpoints.py [--sizes 1000,10000,100000,1000000] [--concurrency 8]
+#       [--ops 2000] [--max-seconds 10] [--output benchmarks/results/kms_endpoints.json]
+# 每种规模在独立的临时目录中建库；每个场景在达到 --ops 次或 --max-seconds 秒时结束，大规模下的写接口通常受时间上限约束
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List
+
+import requests
+from werkzeug.serving import make_server
+
+from _isolation import BASE_DIR, ORIGINAL_CWD, isolated_import
+
+kms_api_server = isolated_import()
+from kms_api_server import KeyManagementSystem, KeyRecord, PERSIST_BYTES, app, master_key_manager, yuan_to_cents
+from job_timing import percentile
+
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+SCHEMA_VERSION = 1
+ENDPOINTS = ("validate_and_deduct", "get_balance", "create_key", "list_keys", "update_balance")
+# 会触发 keys.json 整体重写的端点
+WRITE_ENDPOINTS = ("validate_and_deduct", "create_key", "update_balance")
+
+
+def build_store(size: int, directory: str) -> KeyManagementSystem:
+    """在 directory 下建一个含 size 个子密钥的库，并替换服务器模块使用的全局实例"""
+    kms = KeyManagementSystem(storage_file=os.path.join(directory, "keys.json"),
+                              lease_file=os.path.join(directory, "leases.json"))
+    now = time.time()
+    for i in range(size):
+        kms.keys[f"{i:032x}"] = KeyRecord(balance_cents=yuan_to_cents(1000000), created_time=now,
+                                          description="bench")
+    kms._save_keys()
+    kms_api_server.kms = kms
+    return kms
+
+
+def make_payload(endpoint: str, key_ids: List[str], rng: random.Random) -> Dict:
+    master_key = master_key_manager.master_keys[0]
+    if endpoint == "validate_and_deduct":
+        return {"sub_key": rng.choice(key_ids), "amount": 0.10, "idempotency_key": uuid.uuid4().hex}
+    if endpoint == "get_balance":
+        return {"sub_key": rng.choice(key_ids)}
+    if endpoint == "create_key":
+        return {"master_key": master_key, "balance": 10, "description": "bench"}
+    if endpoint == "list_keys":
+        return {"master_key": master_key}
+    return {"master_key": master_key, "sub_key": rng.choice(key_ids), "new_balance": round(rng.uniform(1, 1000), 2)}
+
+
+class TestClientTransport:
+    name = "test_client"
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def post(self, endpoint: str, payload: Dict) -> Dict:
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = self.local.client = app.test_client()
+        return client.post(f"/api/{endpoint}", json=payload).get_json()
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """在后台线程中运行真实的多线程 HTTP 服务器，每个压测线程使用自己的 keep-alive 连接"""
+    name = "socket"
+
+    def __init__(self):
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def post(self, endpoint: str, payload: Dict) -> Dict:
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        return session.post(f"{self.base_url}/api/{endpoint}", json=payload, timeout=300).json()
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+def run_scenario(transport, endpoint: str, key_ids: List[str], concurrency: int,
+                 ops: int, max_seconds: float, seed: int) -> Dict:
+    """concurrency 个线程共同完成 ops 次请求，超过 max_seconds 后不再发起新请求"""
+    latencies: List[float] = []
+    errors = [0]
+    remaining = [ops]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + max_seconds
+    bytes_before = PERSIST_BYTES.value("keys")
+
+    def worker(index: int):
+        rng = random.Random(seed * 100 + index)
+        local_latencies = []
+        local_errors = 0
+        while time.perf_counter() < deadline:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            payload = make_payload(endpoint, key_ids, rng)
+            start = time.perf_counter()
+            try:
+                result = transport.post(endpoint, payload)
+                ok = bool(result and result.get("success"))
+            except Exception:
+                ok = False
+            local_latencies.append(time.perf_counter() - start)
+            local_errors += 0 if ok else 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    completed = len(latencies)
+    persisted = PERSIST_BYTES.value("keys") - bytes_before
+    result = {
+        "ops": completed,
+        "errors": errors[0],
+        "seconds": round(elapsed, 4),
+        "ops_per_s": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 4),
+            "p90": round(percentile(latencies, 90) * 1000, 4),
+            "p99": round(percentile(latencies, 99) * 1000, 4),
+            "max": round(latencies[-1] * 1000, 4) if latencies else 0.0,
+            "mean": round(sum(latencies) / completed * 1000, 4) if completed else 0.0
+        },
+        "time_limited": completed < ops
+    }
+    if endpoint in WRITE_ENDPOINTS:
+        result["persist_bytes_per_op"] = round(persisted / completed) if completed else 0
+    return result
+
+
+def record_bytes() -> int:
+    """单条密钥记录在 keys.json 中的字节数，用于计算写放大倍数"""
+    record = KeyRecord(balance_cents=yuan_to_cents(1000000), created_time=time.time(), description="bench")
+    return len(json.dumps({f"{0:032x}": record.to_dict()}, ensure_ascii=False, indent=2).encode("utf-8"))
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="密钥服务端点微基准")
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000", help="子密钥数量，逗号分隔")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="要测的端点，逗号分隔")
+    parser.add_argument("--transports", default="test_client,socket", help="test_client / socket")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发场景的客户端线程数（另有单线程场景）")
+    parser.add_argument("--ops", type=int, default=2000, help="每个场景的请求数上限")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="每个场景的时间上限（秒）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="", help="结果 JSON 路径（默认 benchmarks/results/kms_endpoints_<时间>.json）")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    endpoints = [endpoint for endpoint in args.endpoints.split(",") if endpoint]
+    transports: Dict[str, Callable] = {"test_client": TestClientTransport, "socket": SocketTransport}
+    one_record = record_bytes()
+    results = []
+    stores = []
+
+    print(f"{'密钥数':>9} {'端点':<20}{'方式':<12}{'并发':>5}{'ops/s':>11}{'p50ms':>9}{'p99ms':>9}{'错误':>6}{'字节/次':>12}")
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix=f"kms_bench_{size}_")
+        populate_started = time.perf_counter()
+        kms = build_store(size, directory)
+        populate_seconds = time.perf_counter() - populate_started
+        file_bytes = os.path.getsize(kms.storage_file)
+        key_ids = list(kms.keys)
+        stores.append({"keys": size, "populate_s": round(populate_seconds, 3), "keys_json_bytes": file_bytes})
+
+        for transport_name in args.transports.split(","):
+            transport = transports[transport_name]()
+            try:
+                for endpoint in endpoints:
+                    for concurrency in sorted({1, args.concurrency}):
+                        result = run_scenario(transport, endpoint, key_ids, concurrency,
+                                              args.ops, args.max_seconds, args.seed)
+                        result.update(keys=size, endpoint=endpoint, transport=transport_name, concurrency=concurrency)
+                        if "persist_bytes_per_op" in result:
+                            result["write_amplification"] = round(result["persist_bytes_per_op"] / one_record, 1)
+                        results.append(result)
+                        per_op = result.get("persist_bytes_per_op", "")
+                        print(f"{size:>9} {endpoint:<20}{transport_name:<12}{concurrency:>5}{result['ops_per_s']:>11,.1f}"
+                              f"{result['latency_ms']['p50']:>9.2f}{result['latency_ms']['p99']:>9.2f}"
+                              f"{result['errors']:>6}{per_op:>12}")
+            finally:
+                transport.close()
+        os.remove(kms.storage_file)
+
+    deductions = [r for r in results if r["endpoint"] == "validate_and_deduct" and r["ops"]]
+    print("\nkeys.json 写放大（每次扣款写入的字节）:")
+    for store in stores:
+        rows = [r for r in deductions if r["keys"] == store["keys"]]
+        if rows:
+            print(f"  {store['keys']:>9} 个密钥: {rows[0]['persist_bytes_per_op']:>14,} 字节/次 "
+                  f"（单条记录 {one_record} 字节，放大 {rows[0]['write_amplification']:,.0f}x）")
+
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "tool": "bench_kms_endpoints",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "record_bytes": one_record,
+        "stores": stores,
+        "results": results
+    }
+    output = args.output or os.path.join(BASE_DIR, "benchmarks", "results",
+                                         f"kms_endpoints_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    output = os.path.join(ORIGINAL_CWD, output)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {output}")
+
+
+if __name__ == "__main__":
+    main()
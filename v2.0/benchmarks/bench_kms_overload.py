@@ -0,0 +1,235 @@
+# bench_kms_overload.py - 密钥服务过载基准：对比 Flask 开发服务器（KMS_SERVER=dev）与带准入控制的线程池服务器（pool）
+# 用法: python benchmarks/bench_kms_overload.py [--keys 5000] [--rates 0.5,1,2,4] [--duration 10]
+#       [--modes dev,pool] [--output benchmarks/results/kms_overload.json]
+# 先用闭环并发测出单实例的扣费吞吐（容量），再按容量的倍数以开环方式（固定到达速率，不等待前一个请求完成）
+# 发送 validate_and_deduct，统计成功请求的延迟分位数、503 拒绝比例和超时；过载时 pool 的成功延迟应基本不随负载上升
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from job_timing import percentile
+
+SCHEMA_VERSION = 1
+MASTER_KEY = "sk-bench-overload"
+
+
+def build_workdir(keys: int) -> str:
+    """临时目录中写入 master_keys.json 和含 keys 个子密钥的 keys.json（每次扣费都会整体重写，子密钥越多单次扣费越慢）"""
+    workdir = tempfile.mkdtemp(prefix="kms_overload_")
+    with open(os.path.join(workdir, "master_keys.json"), "w", encoding="utf-8") as f:
+        json.dump({"master_keys": [MASTER_KEY]}, f)
+    now = time.time()
+    records = {f"{i:032x}": {"balance": 1000000.0, "created_time": now, "description": "bench", "is_active": True,
+                             "used_amount": 0.0, "last_used": None} for i in range(keys)}
+    with open(os.path.join(workdir, "keys.json"), "w", encoding="utf-8") as f:
+        json.dump(records, f)
+    return workdir
+
+
+class KMSProcess:
+    """在 workdir 的副本中启动一个密钥服务进程"""
+
+    def __init__(self, mode: str, port: int, source_dir: str, args):
+        self.workdir = tempfile.mkdtemp(prefix=f"kms_{mode}_")
+        for name in ("master_keys.json", "keys.json"):
+            with open(os.path.join(source_dir, name), "rb") as src, open(os.path.join(self.workdir, name), "wb") as dst:
+                dst.write(src.read())
+        env = {**os.environ, "KMS_PORT": str(port), "KMS_SERVER": mode, "KMS_WORKERS": str(args.workers),
+               "KMS_QUEUE_DEPTH": str(args.queue_depth), "KMS_QUEUE_TIMEOUT": str(args.queue_timeout)}
+        self.log = open(os.path.join(self.workdir, "kms.log"), "w", encoding="utf-8")
+        self.process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "kms_api_server.py")], cwd=self.workdir,
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"密钥服务启动失败，见日志 {self.log.name}")
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("密钥服务在 30 秒内未就绪")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def deduct(url: str, key_ids: List[str], rng: random.Random, timeout: float) -> Dict:
+    """发送一次扣费，返回 {"outcome": ok/rejected/timeout/error, "latency": 秒}"""
+    started = time.perf_counter()
+    try:
+        response = requests.post(f"{url}/api/validate_and_deduct", timeout=timeout, json={
+            "sub_key": rng.choice(key_ids), "amount": 0.01, "idempotency_key": uuid.uuid4().hex})
+        if response.status_code == 503:
+            outcome = "rejected"
+        elif response.status_code == 200 and response.json().get("success"):
+            outcome = "ok"
+        else:
+            outcome = "error"
+    except requests.exceptions.Timeout:
+        outcome = "timeout"
+    except requests.RequestException:
+        outcome = "error"
+    return {"outcome": outcome, "latency": time.perf_counter() - started}
+
+
+def measure_capacity(url: str, key_ids: List[str], concurrency: int, seconds: float, timeout: float) -> float:
+    """闭环并发扣费 seconds 秒，返回成功请求的吞吐（次/秒）"""
+    end = time.monotonic() + seconds
+    counts = [0] * concurrency
+
+    def worker(index: int):
+        rng = random.Random(index)
+        while time.monotonic() < end:
+            if deduct(url, key_ids, rng, timeout)["outcome"] == "ok":
+                counts[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.monotonic() - started)
+
+
+def run_open_loop(url: str, key_ids: List[str], rate: float, duration: float, timeout: float,
+                  max_inflight: int, seed: int) -> Dict:
+    """按泊松到达以 rate 次/秒发送 duration 秒，客户端并发达到 max_inflight 时记为 client_dropped"""
+    rng = random.Random(seed)
+    results: List[Dict] = []
+    lock = threading.Lock()
+    inflight = threading.BoundedSemaphore(max_inflight)
+    dropped = 0
+
+    def send(request_seed: int):
+        try:
+            result = deduct(url, key_ids, random.Random(request_seed), timeout)
+            with lock:
+                results.append(result)
+        finally:
+            inflight.release()
+
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        started = time.perf_counter()
+        next_at = started
+        while next_at - started < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if inflight.acquire(blocking=False):
+                executor.submit(send, rng.getrandbits(32))
+            else:
+                dropped += 1
+            next_at += rng.expovariate(rate)
+    elapsed = time.perf_counter() - started
+
+    ok = sorted(r["latency"] for r in results if r["outcome"] == "ok")
+    rejected = sorted(r["latency"] for r in results if r["outcome"] == "rejected")
+    total = len(results) + dropped
+    count = lambda outcome: sum(1 for r in results if r["outcome"] == outcome)
+    return {
+        "offered_rps": round(rate, 1),
+        "sent": total,
+        "ok": len(ok),
+        "goodput_rps": round(len(ok) / elapsed, 1),
+        "rejected_ratio": round(len(rejected) / total, 4) if total else 0.0,
+        "timeouts": count("timeout"),
+        "errors": count("error"),
+        "client_dropped": dropped,
+        "ok_latency_ms": {name: round(percentile(ok, q) * 1000, 1) if ok else None
+                          for name, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "reject_latency_ms": {name: round(percentile(rejected, q) * 1000, 1) if rejected else None
+                              for name, q in (("p50", 50), ("p99", 99))},
+    }
+
+
+def print_table(report: Dict):
+    print(f"\n容量（闭环扣费吞吐）: {report['capacity_rps']:.1f} 次/秒")
+    print(f"{'模式':<6}{'倍数':>6}{'到达/s':>9}{'成功/s':>9}{'拒绝率':>8}{'超时':>6}{'错误':>6}"
+          f"{'p50ms':>9}{'p95ms':>9}{'p99ms':>9}{'拒绝p50':>9}{'拒绝p99':>9}")
+    for mode, runs in report["results"].items():
+        for run in runs:
+            latency = run["ok_latency_ms"]
+            fmt = lambda value: f"{value:>9.1f}" if value is not None else f"{'-':>9}"
+            print(f"{mode:<6}{run['multiplier']:>6}{run['offered_rps']:>9.1f}{run['goodput_rps']:>9.1f}"
+                  f"{run['rejected_ratio']:>8.1%}{run['timeouts']:>6}{run['errors'] + run['client_dropped']:>6}"
+                  f"{fmt(latency['p50'])}{fmt(latency['p95'])}{fmt(latency['p99'])}"
+                  f"{fmt(run['reject_latency_ms']['p50'])}{fmt(run['reject_latency_ms']['p99'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="密钥服务过载基准（开发服务器 vs 准入控制线程池）")
+    parser.add_argument("--keys", type=int, default=5000, help="子密钥数量（决定单次扣费耗时）")
+    parser.add_argument("--rates", default="0.5,1,2,4", help="到达速率，为容量的倍数")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个速率的持续时间（秒）")
+    parser.add_argument("--modes", default="dev,pool", help="对比的服务器模式")
+    parser.add_argument("--workers", type=int, default=8, help="pool 模式工作线程数（KMS_WORKERS）")
+    parser.add_argument("--queue-depth", type=int, default=64, help="pool 模式排队上限（KMS_QUEUE_DEPTH）")
+    parser.add_argument("--queue-timeout", type=float, default=1.0, help="pool 模式排队超时（KMS_QUEUE_TIMEOUT）")
+    parser.add_argument("--timeout", type=float, default=10.0, help="客户端请求超时（秒）")
+    parser.add_argument("--max-inflight", type=int, default=512, help="客户端最大并发请求数")
+    parser.add_argument("--calibrate-seconds", type=float, default=5.0, help="测容量的时长（秒）")
+    parser.add_argument("--port", type=int, default=18513)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    multipliers = [float(value) for value in args.rates.split(",")]
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    print(f"建库: {args.keys} 个子密钥")
+    source_dir = build_workdir(args.keys)
+    key_ids = [f"{i:032x}" for i in range(args.keys)]
+
+    report = {"schema_version": SCHEMA_VERSION, "timestamp": time.time(), "platform": platform.platform(),
+              "python": platform.python_version(), "config": vars(args), "capacity_rps": None, "results": {}}
+    for mode in modes:
+        runs = []
+        for index, multiplier in enumerate(multipliers):
+            # 每个速率使用新进程，避免上一轮积压的请求影响下一轮
+            server = KMSProcess(mode, args.port, source_dir, args)
+            try:
+                if report["capacity_rps"] is None:
+                    report["capacity_rps"] = measure_capacity(server.url, key_ids, 8, args.calibrate_seconds, args.timeout)
+                    print(f"容量: {report['capacity_rps']:.1f} 次/秒（{mode} 模式，8 并发闭环）")
+                rate = report["capacity_rps"] * multiplier
+                print(f"[{mode}] {multiplier}x 容量，{rate:.1f} 次/秒，持续 {args.duration:.0f}s ...")
+                run = run_open_loop(server.url, key_ids, rate, args.duration, args.timeout, args.max_inflight,
+                                    args.seed + index)
+                run["multiplier"] = multiplier
+                runs.append(run)
+            finally:
+                server.stop()
+        report["results"][mode] = runs
+
+    print_table(report)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
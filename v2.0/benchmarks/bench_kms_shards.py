@@ -0,0 +1,118 @@
+# bench_kms_shards.py - 分片存储的扣费吞吐随分片数（KMS_SHARDS）的变化
+# 用法: python benchmarks/bench_kms_shards.py [--keys 20000] [--shards 1,2,4,8,16] [--concurrency 8]
+#       [--seconds 5] [--output benchmarks/results/kms_shards.json]
+# 每个分片数在独立的临时目录中建库，经 Flask test client 并发调用 validate_and_deduct（含幂等键和分片路由），
+# 统计吞吐、延迟分位数和每次扣费写入的字节数；扣费只重写所在分片的文件，写入量约为 1/分片数
+import argparse
+import json
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+from _isolation import ORIGINAL_CWD, isolated_import
+
+kms_api_server = isolated_import()
+from kms_api_server import KeyRecord, PERSIST_BYTES, ShardedKeyManagementSystem, app, yuan_to_cents
+from job_timing import percentile
+
+SCHEMA_VERSION = 1
+
+
+def build_store(keys: int, shards: int) -> ShardedKeyManagementSystem:
+    """在新的临时目录中建一个 shards 个分片、含 keys 个子密钥的库，并替换服务器模块使用的全局实例"""
+    directory = tempfile.mkdtemp(prefix=f"kms_shards_{shards}_")
+    kms = ShardedKeyManagementSystem(os.path.join(directory, "keys.json"), os.path.join(directory, "leases.json"), shards)
+    now = time.time()
+    for i in range(keys):
+        sub_key = f"{i:032x}"
+        kms.shard_for(sub_key).keys[sub_key] = KeyRecord(balance_cents=yuan_to_cents(1000000), created_time=now,
+                                                         description="bench")
+    for shard in kms.shards:
+        shard._save_keys()
+    kms_api_server.kms = kms
+    return kms
+
+
+def run_deducts(key_ids: List[str], concurrency: int, seconds: float, seed: int) -> Dict:
+    """concurrency 个线程闭环扣费 seconds 秒"""
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    end = time.monotonic() + seconds
+    bytes_before = PERSIST_BYTES.value("keys")
+
+    def worker(index: int):
+        rng = random.Random(seed * 100 + index)
+        client = app.test_client()
+        local = []
+        while time.monotonic() < end:
+            started = time.perf_counter()
+            result = client.post("/api/validate_and_deduct", json={
+                "sub_key": rng.choice(key_ids), "amount": 0.01, "idempotency_key": uuid.uuid4().hex}).get_json()
+            local.append(time.perf_counter() - started)
+            if not result.get("success"):
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies.sort()
+    completed = len(latencies)
+    return {
+        "ops": completed,
+        "errors": errors[0],
+        "ops_per_sec": round(completed / elapsed, 1),
+        "latency_ms": {name: round(percentile(latencies, q) * 1000, 2) if latencies else None
+                       for name, q in (("p50", 50), ("p90", 90), ("p99", 99))},
+        "bytes_per_deduct": round((PERSIST_BYTES.value("keys") - bytes_before) / completed) if completed else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片存储扣费吞吐基准")
+    parser.add_argument("--keys", type=int, default=20000, help="子密钥数量")
+    parser.add_argument("--shards", default="1,2,4,8,16", help="分片数，逗号分隔")
+    parser.add_argument("--concurrency", type=int, default=8, help="并发线程数")
+    parser.add_argument("--seconds", type=float, default=5.0, help="每个分片数的压测时长（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    key_ids = [f"{i:032x}" for i in range(args.keys)]
+    report = {"schema_version": SCHEMA_VERSION, "timestamp": time.time(), "platform": platform.platform(),
+              "python": platform.python_version(), "cpu_count": os.cpu_count(), "config": vars(args), "results": []}
+    print(f"{'分片':>4}{'扣费/s':>10}{'加速':>7}{'p50ms':>9}{'p90ms':>9}{'p99ms':>9}{'字节/次':>11}{'错误':>6}")
+    baseline = None
+    for shards in [int(value) for value in args.shards.split(",")]:
+        build_store(args.keys, shards)
+        run = run_deducts(key_ids, args.concurrency, args.seconds, args.seed)
+        run["shards"] = shards
+        baseline = baseline or run["ops_per_sec"]
+        run["speedup"] = round(run["ops_per_sec"] / baseline, 2) if baseline else None
+        report["results"].append(run)
+        latency = run["latency_ms"]
+        print(f"{shards:>4}{run['ops_per_sec']:>10.1f}{run['speedup']:>7.2f}{latency['p50']:>9.2f}{latency['p90']:>9.2f}"
+              f"{latency['p99']:>9.2f}{run['bytes_per_deduct']:>11}{run['errors']:>6}")
+
+    if args.output:
+        output = os.path.join(ORIGINAL_CWD, args.output)
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
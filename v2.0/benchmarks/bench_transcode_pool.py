@@ -0,0 +1,65 @@
+# bench_transcode_pool.py - 转码池吞吐随工作线程数的扩展情况
+# 用法: python benchmarks/bench_transcode_pool.py [--jobs 16] [--duration 60] [--workers 1,2,4,8]
+# 需要 ffmpeg 在 PATH 中
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from transcode_pool import TranscodePool
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    default_workers = sorted({1, 2, 4, cpu_count} & set(range(1, cpu_count + 1)))
+    parser = argparse.ArgumentParser(description="转码池吞吐扩展测试")
+    parser.add_argument("--jobs", type=int, default=16, help="每轮提交的转码任务数")
+    parser.add_argument("--duration", type=int, default=60, help="测试音频时长（秒）")
+    parser.add_argument("--format", default="flac", help="测试音频格式（flac/m4a）")
+    parser.add_argument("--workers", default=",".join(map(str, default_workers)), help="要测试的工作线程数")
+    parser.add_argument("--output", default="", help="结果 JSON 路径（可选）")
+    args = parser.parse_args()
+
+    if shutil.which("ffmpeg") is None:
+        print("未找到 ffmpeg。请先安装 FFmpeg 并添加到 PATH")
+        sys.exit(2)
+
+    source = os.path.join(tempfile.mkdtemp(prefix="transcode_bench_"), f"source.{args.format}")
+    subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "lavfi",
+                    "-i", f"anoisesrc=color=pink:sample_rate=44100:duration={args.duration}",
+                    "-ac", "2", source], check=True)
+    with open(source, "rb") as f:
+        data = f.read()
+
+    results = []
+    baseline = None
+    print(f"{args.jobs} 个 {args.duration}s {args.format.upper()} 转 MP3（{cpu_count} 核）")
+    print(f"{'workers':>8}{'耗时 s':>10}{'任务/秒':>10}{'加速比':>8}")
+    for workers in [int(value) for value in args.workers.split(",") if value]:
+        pool = TranscodePool(workers=workers, queue_depth=args.jobs)
+        started = time.perf_counter()
+        jobs = [pool.submit(data, args.format, "mp3") for _ in range(args.jobs)]
+        for job in jobs:
+            job.result()
+        elapsed = time.perf_counter() - started
+        throughput = args.jobs / elapsed
+        baseline = baseline or throughput
+        results.append({"workers": workers, "seconds": round(elapsed, 3), "jobs_per_s": round(throughput, 3),
+                        "speedup": round(throughput / baseline, 2)})
+        print(f"{workers:>8}{elapsed:>10.2f}{throughput:>10.2f}{throughput / baseline:>8.2f}x")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"tool": "bench_transcode_pool", "cpu_count": cpu_count, "config": vars(args),
+                       "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# check_kms_consistency.py - 多进程密钥服务（KMS_PROCESSES > 1）的一致性检查：并发扣费、退款、幂等重放和租约分散到各工作进程后，
+# 余额必须与客户端记账完全一致
+# 用法: python benchmarks/check_kms_consistency.py [--processes 4] [--threads 32] [--ops 4000] [--journal-max-bytes 262144]
+# 在临时目录中启动服务；较小的 --journal-max-bytes 让日志在压测中多次压缩，同时检查压缩路径。任何一项不一致时以非零状态退出
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASTER_KEY = "sk-consistency-check"
+
+
+class KMSCluster:
+    """以多进程模式启动一个密钥服务"""
+
+    def __init__(self, workdir: str, port: int, processes: int, journal_max_bytes: int):
+        self.url = f"http://127.0.0.1:{port}"
+        env = {**os.environ, "KMS_PORT": str(port), "KMS_PROCESSES": str(processes),
+               "KMS_JOURNAL_MAX_BYTES": str(journal_max_bytes), "KMS_QUEUE_DEPTH": "512", "KMS_QUEUE_TIMEOUT": "30"}
+        self.log = open(os.path.join(workdir, "kms.log"), "a", encoding="utf-8")
+        self.process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "kms_api_server.py")], cwd=workdir,
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 30
+        pids = set()
+        # 等到所有工作进程都在 accept（不同连接会落到不同进程上）
+        while time.monotonic() < deadline and len(pids) < processes:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"密钥服务启动失败，见日志 {self.log.name}")
+            try:
+                pids.add(requests.get(f"{self.url}/health", timeout=1).json()["pid"])
+            except requests.RequestException:
+                time.sleep(0.2)
+        if not pids:
+            raise RuntimeError("密钥服务在 30 秒内未就绪")
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+def post(url: str, endpoint: str, payload: Dict) -> Dict:
+    response = requests.post(f"{url}/api/{endpoint}", json=payload, timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+class Ledger:
+    """客户端记账：每个子密钥按成功的操作计算应有余额"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected = {}
+        self.counts = defaultdict(int)
+        self.errors: List[str] = []
+
+    def add(self, sub_key: str, delta_cents: int, kind: str):
+        with self.lock:
+            self.expected[sub_key] += delta_cents
+            self.counts[kind] += 1
+
+    def error(self, message: str):
+        with self.lock:
+            self.errors.append(message)
+
+
+def run_mixed_load(url: str, keys: List[str], ledger: Ledger, threads: int, ops: int, seed: int):
+    """并发执行扣费、退款、幂等重放、租约和查询"""
+    remaining = [ops]
+    lock = threading.Lock()
+
+    def worker(index: int):
+        rng = random.Random(seed * 1000 + index)
+        history = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            sub_key = rng.choice(keys)
+            roll = rng.random()
+            try:
+                if roll < 0.45:
+                    cents = rng.randint(1, 100)
+                    key = uuid.uuid4().hex
+                    result = post(url, "validate_and_deduct", {"sub_key": sub_key, "amount": cents / 100, "idempotency_key": key})
+                    if result.get("success"):
+                        ledger.add(sub_key, -cents, "deduct")
+                        history.append((sub_key, cents, key, result))
+                    elif result.get("error") != "余额不足":
+                        ledger.error(f"扣费失败: {result}")
+                elif roll < 0.6 and history:
+                    # 退还之前的一笔扣费
+                    charged_key, cents, key, _ = history.pop(rng.randrange(len(history)))
+                    result = post(url, "validate_and_deduct", {"sub_key": charged_key, "amount": -cents / 100,
+                                                                "idempotency_key": key + ":refund"})
+                    if not result.get("success"):
+                        ledger.error(f"退款失败: {result}")
+                    else:
+                        ledger.add(charged_key, cents, "refund")
+                elif roll < 0.75 and history:
+                    # 重放之前的扣费：大概率落到另一个工作进程，必须返回首次结果且不再扣费
+                    charged_key, cents, key, first = history[rng.randrange(len(history))]
+                    result = post(url, "validate_and_deduct", {"sub_key": charged_key, "amount": cents / 100, "idempotency_key": key})
+                    if not result.get("replayed") or result.get("new_balance") != first.get("new_balance"):
+                        ledger.error(f"幂等重放结果不一致: 首次 {first}，重放 {result}")
+                    with ledger.lock:
+                        ledger.counts["replay"] += 1
+                elif roll < 0.85:
+                    # 申请租约后按部分用量结算并释放
+                    result = post(url, "leases/acquire", {"sub_key": sub_key, "amount": 1.0, "ttl": 60,
+                                                          "idempotency_key": uuid.uuid4().hex})
+                    if result.get("success"):
+                        granted = to_cents(result["granted"])
+                        used = rng.randint(0, granted)
+                        settled = post(url, "leases/reconcile", {"lease_id": result["lease_id"], "used": used / 100,
+                                                                 "release": True})
+                        if not settled.get("success") or to_cents(settled["returned"]) != granted - used:
+                            ledger.error(f"租约结算不一致: 额度 {granted}，用量 {used}，结果 {settled}")
+                        ledger.add(sub_key, -used, "lease")
+                else:
+                    result = post(url, "get_balance", {"sub_key": sub_key})
+                    if not result.get("success"):
+                        ledger.error(f"查询余额失败: {result}")
+                    with ledger.lock:
+                        ledger.counts["read"] += 1
+            except requests.RequestException as e:
+                # 请求结果未知（可能已执行），无法记账，直接判为失败
+                ledger.error(f"请求异常: {e}")
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def run_overdraw(url: str, sub_key: str, balance_cents: int, attempts: int, threads: int) -> int:
+    """余额只够 balance_cents 次 0.01 的扣费时并发扣 attempts 次，返回成功次数（应恰好为 balance_cents）"""
+    successes = [0]
+    lock = threading.Lock()
+    per_thread = attempts // threads
+
+    def worker():
+        for _ in range(per_thread):
+            result = post(url, "validate_and_deduct", {"sub_key": sub_key, "amount": 0.01, "idempotency_key": uuid.uuid4().hex})
+            if result.get("success"):
+                with lock:
+                    successes[0] += 1
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return successes[0]
+
+
+def verify_balances(url: str, ledger: Ledger, initial_cents: int, rounds: int) -> List[str]:
+    """多次列出全部子密钥（分散到不同工作进程），每次都必须与记账一致，且余额 + 已用 = 初始余额"""
+    problems = []
+    for _ in range(rounds):
+        keys = post(url, "list_keys", {"master_key": MASTER_KEY})["keys"]
+        for sub_key, expected in ledger.expected.items():
+            info = keys.get(sub_key)
+            if info is None:
+                problems.append(f"{sub_key[:8]} 不存在")
+                continue
+            if to_cents(info["balance"]) != expected:
+                problems.append(f"{sub_key[:8]} 余额 {info['balance']:.2f}，应为 {expected / 100:.2f}")
+            if to_cents(info["balance"]) + to_cents(info["used_amount"]) != initial_cents:
+                problems.append(f"{sub_key[:8]} 余额 + 已用 = {info['balance'] + info['used_amount']:.2f}，应为 {initial_cents / 100:.2f}")
+    return sorted(set(problems))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多进程密钥服务一致性检查")
+    parser.add_argument("--processes", type=int, default=4, help="工作进程数（KMS_PROCESSES）")
+    parser.add_argument("--threads", type=int, default=32, help="客户端并发线程数")
+    parser.add_argument("--ops", type=int, default=4000, help="混合操作总数")
+    parser.add_argument("--keys", type=int, default=20, help="子密钥数量（越少竞争越激烈）")
+    parser.add_argument("--balance", type=float, default=50.0, help="每个子密钥的初始余额")
+    parser.add_argument("--journal-max-bytes", type=int, default=256 * 1024, help="日志压缩阈值（KMS_JOURNAL_MAX_BYTES）")
+    parser.add_argument("--port", type=int, default=18523)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="kms_consistency_")
+    with open(os.path.join(workdir, "master_keys.json"), "w", encoding="utf-8") as f:
+        json.dump({"master_keys": [MASTER_KEY]}, f)
+    print(f"工作目录: {workdir}")
+    failures = []
+
+    cluster = KMSCluster(workdir, args.port, args.processes, args.journal_max_bytes)
+    try:
+        pids = {requests.get(f"{cluster.url}/health", timeout=5).json()["pid"] for _ in range(args.processes * 10)}
+        print(f"工作进程: {len(pids)} 个响应了健康检查")
+        if len(pids) < 2:
+            failures.append("请求没有分散到多个工作进程")
+
+        ledger = Ledger()
+        initial_cents = to_cents(args.balance)
+        keys = []
+        for _ in range(args.keys):
+            sub_key = post(cluster.url, "create_key", {"master_key": MASTER_KEY, "balance": args.balance})["sub_key"]
+            keys.append(sub_key)
+            ledger.expected[sub_key] = initial_cents
+
+        started = time.perf_counter()
+        run_mixed_load(cluster.url, keys, ledger, args.threads, args.ops, args.seed)
+        elapsed = time.perf_counter() - started
+        counts = dict(ledger.counts)
+        print(f"混合负载: {args.ops} 次操作，{elapsed:.1f}s（{args.ops / elapsed:.0f} 次/秒）: {counts}")
+        failures.extend(ledger.errors[:20])
+        if not counts.get("replay"):
+            failures.append("没有执行幂等重放")
+
+        problems = verify_balances(cluster.url, ledger, initial_cents, args.processes * 3)
+        print(f"余额核对（{args.processes * 3} 次全量读取）: {'一致' if not problems else f'{len(problems)} 处不一致'}")
+        failures.extend(problems[:20])
+
+        hot_key = post(cluster.url, "create_key", {"master_key": MASTER_KEY, "balance": 5.0})["sub_key"]
+        successes = run_overdraw(cluster.url, hot_key, 500, 1000, args.threads)
+        final = post(cluster.url, "get_balance", {"sub_key": hot_key})["balance"]
+        print(f"透支检查: 余额 5.00 并发扣费 1000 次 × 0.01，成功 {successes} 次，剩余 {final:.2f}")
+        if successes != 500 or final != 0:
+            failures.append(f"透支检查失败: 成功 {successes} 次（应为 500），剩余 {final}")
+    finally:
+        cluster.stop()
+
+    journal_path = os.path.join(workdir, "keys.json.journal")
+    print(f"日志大小: {os.path.getsize(journal_path)} 字节（压缩阈值 {args.journal_max_bytes}）")
+
+    # 重启后从快照和日志恢复，余额不变
+    cluster = KMSCluster(workdir, args.port, args.processes, args.journal_max_bytes)
+    try:
+        problems = verify_balances(cluster.url, ledger, initial_cents, args.processes * 2)
+        print(f"重启后余额核对: {'一致' if not problems else f'{len(problems)} 处不一致'}")
+        failures.extend(f"重启后: {problem}" for problem in problems[:20])
+    finally:
+        cluster.stop()
+
+    if failures:
+        print("\n检查失败:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("\n检查通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,349 @@
+# check_kms_replication.py - 密钥服务主从复制检查：在本机不同端口启动 1 个主节点和 2 个只读副本，
+# 主节点写入的同时从副本读取，核对副本与主节点、客户端记账一致，统计复制延迟和读吞吐；
+# 然后杀掉主节点，提升副本 1，副本 2 改为跟随它，确认幂等键在新主节点上仍然有效、继续写入后副本跟上，
+# 最后重启副本 2，确认它从本地日志续传而不是重新拉取快照
+# 用法: python benchmarks/check_kms_replication.py [--ops 2000] [--journal-max-bytes 65536] [--output benchmarks/results/kms_replication.json]
+# 较小的 --journal-max-bytes 让主节点在写入中多次压缩，副本需要按新 epoch 重新拉取快照。任何一项不一致时以非零状态退出
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from job_timing import percentile
+
+SCHEMA_VERSION = 1
+MASTER_KEY = "sk-replication-check"
+
+
+class KMSNode:
+    """在独立的临时目录中启动一个密钥服务节点"""
+
+    def __init__(self, name: str, port: int, env: Dict[str, str], workdir: Optional[str] = None):
+        self.name = name
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = env
+        self.workdir = workdir or tempfile.mkdtemp(prefix=f"kms_{name}_")
+        with open(os.path.join(self.workdir, "master_keys.json"), "w", encoding="utf-8") as f:
+            json.dump({"master_keys": [MASTER_KEY]}, f)
+        self.start()
+
+    def start(self):
+        env = {**os.environ, "KMS_PORT": str(self.port), "KMS_QUEUE_DEPTH": "256", "KMS_QUEUE_TIMEOUT": "10", **self.env}
+        self.log = open(os.path.join(self.workdir, "kms.log"), "a", encoding="utf-8")
+        self.process = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, "kms_api_server.py")], cwd=self.workdir,
+                                        env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} 启动失败，见日志 {self.log.name}")
+            try:
+                if requests.get(f"{self.url}/ready", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError(f"{self.name} 在 {timeout:.0f} 秒内未就绪")
+
+    def stop(self, kill: bool = False):
+        if self.process.poll() is None:
+            if kill:
+                self.process.kill()
+            else:
+                self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+    def post(self, endpoint: str, payload: Dict) -> Dict:
+        response = requests.post(f"{self.url}/api/{endpoint}", json=payload, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def health(self) -> Dict:
+        return requests.get(f"{self.url}/health", timeout=5).json()
+
+    def balances(self) -> Dict[str, tuple]:
+        keys = self.post("list_keys", {"master_key": MASTER_KEY})["keys"]
+        return {sub_key: (to_cents(info["balance"]), to_cents(info["used_amount"])) for sub_key, info in keys.items()}
+
+
+def to_cents(amount: float) -> int:
+    return int(round(amount * 100))
+
+
+class Ledger:
+    """客户端记账，以及可用于重放的幂等键"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expected: Dict[str, int] = {}
+        self.history: List[tuple] = []
+        self.errors: List[str] = []
+
+    def deduct(self, node: KMSNode, sub_key: str, cents: int) -> Optional[Dict]:
+        key = uuid.uuid4().hex
+        result = node.post("validate_and_deduct", {"sub_key": sub_key, "amount": cents / 100, "idempotency_key": key})
+        with self.lock:
+            if result.get("success"):
+                self.expected[sub_key] -= cents
+                self.history.append((sub_key, cents, key, result))
+            elif result.get("error") != "余额不足":
+                self.errors.append(f"{node.name} 扣费失败: {result}")
+        return result
+
+
+def run_writes(node: KMSNode, keys: List[str], ledger: Ledger, ops: int, threads: int, seed: int):
+    """在主节点上并发扣费（少量为退款）"""
+    remaining = [ops]
+    lock = threading.Lock()
+
+    def worker(index: int):
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                cents = rng.randint(1, 50) * (-1 if rng.random() < 0.2 else 1)
+                ledger.deduct(node, rng.choice(keys), cents)
+            except requests.RequestException as e:
+                with ledger.lock:
+                    ledger.errors.append(f"写入异常: {e}")
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def read_worker(urls: List[str], keys: List[str], threads: int, seconds: float, seed: int) -> tuple:
+    """闭环并发查询余额，请求轮流发往 urls，返回 (成功次数, 错误列表)"""
+    end = time.monotonic() + seconds
+    counts = [0] * threads
+    errors: List[str] = []
+
+    def worker(index: int):
+        rng = random.Random(seed * 1000 + index)
+        turn = index
+        session = requests.Session()
+        while time.monotonic() < end:
+            url = urls[turn % len(urls)]
+            turn += 1
+            try:
+                response = session.post(f"{url}/api/get_balance", json={"sub_key": rng.choice(keys)}, timeout=30)
+                if response.status_code == 200 and response.json().get("success"):
+                    counts[index] += 1
+                else:
+                    errors.append(f"{url} 查询失败: {response.status_code} {response.text[:200]}")
+            except requests.RequestException as e:
+                errors.append(f"{url} 查询异常: {e}")
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts), errors
+
+
+def run_reads(urls: List[str], keys: List[str], threads: int, seconds: float, processes: int, errors: List[str]) -> float:
+    """用 processes 个客户端进程（避免客户端自身成为瓶颈）各 threads 个线程查询余额，返回总吞吐（次/秒）"""
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(read_worker, urls, keys, threads, seconds, seed) for seed in range(processes)]
+        results = [future.result() for future in futures]
+    for _, worker_errors in results:
+        errors.extend(worker_errors)
+    return sum(count for count, _ in results) / seconds
+
+
+def measure_delay(leader: KMSNode, follower: KMSNode, keys: List[str], ledger: Ledger, samples: int) -> List[float]:
+    """逐次在主节点扣费，轮询副本直到读到新余额，返回每次从主节点确认到副本可见的时间（秒）"""
+    delays = []
+    for index in range(samples):
+        sub_key = keys[index % len(keys)]
+        result = ledger.deduct(leader, sub_key, 1)
+        acked = time.perf_counter()
+        if not result.get("success"):
+            continue
+        while time.perf_counter() - acked < 10:
+            if follower.post("get_balance", {"sub_key": sub_key}).get("balance") == result["new_balance"]:
+                delays.append(time.perf_counter() - acked)
+                break
+            time.sleep(0.001)
+        else:
+            ledger.errors.append(f"{follower.name} 10 秒内未看到 {sub_key[:8]} 的新余额")
+    return delays
+
+
+def wait_converged(source: KMSNode, replicas: List[KMSNode], timeout: float = 15.0) -> Optional[str]:
+    """等待副本的全部子密钥与 source 相同，超时返回说明"""
+    expected = source.balances()
+    deadline = time.monotonic() + timeout
+    pending = list(replicas)
+    while pending and time.monotonic() < deadline:
+        pending = [node for node in pending if node.balances() != expected]
+        if pending:
+            time.sleep(0.05)
+    if pending:
+        return f"{', '.join(node.name for node in pending)} 在 {timeout:.0f} 秒内未与 {source.name} 一致"
+    return None
+
+
+def check_ledger(node: KMSNode, ledger: Ledger) -> List[str]:
+    balances = node.balances()
+    return [f"{node.name} {sub_key[:8]} 余额 {balances.get(sub_key, (None,))[0]}，应为 {expected}"
+            for sub_key, expected in ledger.expected.items() if balances.get(sub_key, (None,))[0] != expected]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="密钥服务主从复制检查")
+    parser.add_argument("--ops", type=int, default=2000, help="主节点并发写入次数")
+    parser.add_argument("--threads", type=int, default=16, help="客户端并发线程数")
+    parser.add_argument("--keys", type=int, default=20, help="子密钥数量")
+    parser.add_argument("--samples", type=int, default=100, help="复制延迟采样次数")
+    parser.add_argument("--read-seconds", type=float, default=5.0, help="每种读分布的压测时长（秒）")
+    parser.add_argument("--read-processes", type=int, default=min(4, os.cpu_count() or 1), help="读压测的客户端进程数")
+    parser.add_argument("--journal-max-bytes", type=int, default=64 * 1024, help="主节点的日志压缩阈值")
+    parser.add_argument("--port", type=int, default=18533, help="主节点端口，副本依次使用后面的端口")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="", help="结果 JSON 路径")
+    args = parser.parse_args()
+
+    failures: List[str] = []
+    report = {"schema_version": SCHEMA_VERSION, "timestamp": time.time(), "platform": platform.platform(),
+              "python": platform.python_version(), "cpu_count": os.cpu_count(), "config": vars(args)}
+    leader_url = f"http://127.0.0.1:{args.port}"
+    follower_env = {"KMS_ROLE": "follower", "KMS_LEADER_URL": leader_url, "KMS_REPLICATION_KEY": MASTER_KEY}
+    leader = KMSNode("主节点", args.port, {"KMS_ROLE": "leader", "KMS_JOURNAL_MAX_BYTES": str(args.journal_max_bytes)})
+    followers = [KMSNode(f"副本{i}", args.port + i, follower_env) for i in (1, 2)]
+    nodes = [leader] + followers
+    try:
+        for node in nodes:
+            node.wait_ready()
+        ledger = Ledger()
+        keys = []
+        for _ in range(args.keys):
+            sub_key = leader.post("create_key", {"master_key": MASTER_KEY, "balance": 50.0})["sub_key"]
+            keys.append(sub_key)
+            ledger.expected[sub_key] = 5000
+
+        # 1. 主节点并发写入，同时从副本读取
+        concurrent_reads = {}
+        reader = threading.Thread(target=lambda: concurrent_reads.update(
+            result=read_worker([node.url for node in followers], keys, 4, 3.0, 0)))
+        reader.start()
+        started = time.perf_counter()
+        run_writes(leader, keys, ledger, args.ops, args.threads, args.seed)
+        write_seconds = time.perf_counter() - started
+        reader.join()
+        _, read_errors = concurrent_reads["result"]
+        print(f"主节点写入: {args.ops} 次，{write_seconds:.1f}s（{args.ops / write_seconds:.0f} 次/秒），期间副本查询失败 {len(read_errors)} 次")
+        failures.extend(ledger.errors[:10] + read_errors[:10])
+
+        problem = wait_converged(leader, followers)
+        failures.extend([problem] if problem else [])
+        failures.extend(check_ledger(followers[0], ledger)[:10])
+        snapshots = [node.health()["replication"]["snapshots"] for node in followers]
+        print(f"副本与主节点一致: {'是' if not problem else '否'}（副本拉取快照次数 {snapshots}，主节点压缩后需重新拉取）")
+
+        # 2. 复制延迟：主节点确认写入到副本可见
+        delays = measure_delay(leader, followers[0], keys, ledger, args.samples)
+        report["replication_delay_ms"] = {name: round(percentile(sorted(delays), q) * 1000, 2) if delays else None
+                                          for name, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+        print(f"复制延迟（{len(delays)} 次）: p50 {report['replication_delay_ms']['p50']}ms，"
+              f"p95 {report['replication_delay_ms']['p95']}ms，p99 {report['replication_delay_ms']['p99']}ms")
+
+        # 3. 副本拒绝写入
+        rejected = followers[0].post("validate_and_deduct", {"sub_key": keys[0], "amount": 0.01})
+        if rejected.get("success") or rejected.get("leader") != leader_url:
+            failures.append(f"副本没有拒绝写入: {rejected}")
+        print(f"副本拒绝写入: {rejected.get('error')}（主节点 {rejected.get('leader')}）")
+
+        # 4. 读吞吐：只读主节点 vs 分散到主节点和副本
+        report["read_rps"] = {}
+        for label, targets in (("leader", [leader]), ("leader+2 followers", nodes)):
+            errors: List[str] = []
+            rps = run_reads([node.url for node in targets], keys, args.threads, args.read_seconds, args.read_processes, errors)
+            report["read_rps"][label] = round(rps, 1)
+            failures.extend(errors[:5])
+            print(f"读吞吐（{label}，{args.read_processes} 个客户端进程 × {args.threads} 线程）: {rps:.0f} 次/秒")
+
+        # 5. 故障切换：杀掉主节点，提升副本 1，副本 2 改为跟随副本 1
+        problem = wait_converged(leader, followers)
+        failures.extend([problem] if problem else [])
+        leader.stop(kill=True)
+        new_leader, follower = followers
+        promoted = new_leader.post("replication/promote", {"master_key": MASTER_KEY})
+        followed = follower.post("replication/follow", {"master_key": MASTER_KEY, "leader": new_leader.url})
+        if not promoted.get("success") or not followed.get("success"):
+            failures.append(f"故障切换失败: {promoted} {followed}")
+        print(f"故障切换: {new_leader.name} 提升为主节点（epoch {promoted.get('epoch')}），{follower.name} 改为跟随它")
+
+        sub_key, cents, key, first = ledger.history[0]
+        replay = new_leader.post("validate_and_deduct", {"sub_key": sub_key, "amount": cents / 100, "idempotency_key": key})
+        if not replay.get("replayed") or replay.get("new_balance") != first.get("new_balance"):
+            failures.append(f"新主节点上的幂等重放不一致: 首次 {first}，重放 {replay}")
+        print(f"新主节点幂等重放: {'返回首次结果，未重复扣费' if replay.get('replayed') else replay}")
+
+        run_writes(new_leader, keys, ledger, args.ops // 4, args.threads, args.seed + 1)
+        failures.extend(ledger.errors[:10])
+        problem = wait_converged(new_leader, [follower])
+        failures.extend([problem] if problem else [])
+        failures.extend(check_ledger(new_leader, ledger)[:10])
+        failures.extend(check_ledger(follower, ledger)[:10])
+        print(f"切换后继续写入 {args.ops // 4} 次: {follower.name} {'已跟上' if not problem else '未跟上'}，余额与记账"
+              f"{'一致' if not check_ledger(new_leader, ledger) else '不一致'}")
+
+        # 6. 副本重启后从本地日志续传
+        follower.stop()
+        follower.env = dict(follower_env, KMS_LEADER_URL=new_leader.url)
+        follower.start()
+        follower.wait_ready()
+        ledger.deduct(new_leader, keys[0], 1)
+        problem = wait_converged(new_leader, [follower])
+        failures.extend([problem] if problem else [])
+        resumed = follower.health()["replication"]
+        if resumed["snapshots"]:
+            failures.append(f"{follower.name} 重启后重新拉取了快照，没有从本地日志续传")
+        print(f"{follower.name} 重启: 拉取快照 {resumed['snapshots']} 次，应用日志条目 {resumed['entries']} 个，"
+              f"{'已跟上' if not problem else '未跟上'}")
+    finally:
+        for node in nodes:
+            node.stop()
+
+    report["failures"] = failures
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+    if failures:
+        print("\n检查失败:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    print("\n检查通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# check_lease_release.py - 租约结算重放检查：释放请求超时后客户端重试、或租约过期后才上报用量时，
+# 服务器返回 settled 和结算时的用量，余额和已用金额都不能再变化
+# 用法: python benchmarks/check_lease_release.py
+# 经 Flask test client 调用 /api/leases/*，依次检查单文件存储、两个工作进程共用的共享存储（重试落到另一个进程）和分片存储；
+# 任何一项不一致时以非零状态退出
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+from _isolation import isolated_import
+
+kms_api_server = isolated_import()
+from kms_api_server import KeyManagementSystem, SharedKeyManagementSystem, ShardedKeyManagementSystem, app
+
+
+def call(store, endpoint: str, payload: Dict) -> Dict:
+    """以 store 作为服务器当前的存储调用一个端点（换 store 即模拟请求落到另一个工作进程）"""
+    kms_api_server.kms = store
+    return app.test_client().post(f"/api/{endpoint}", json=payload).get_json()
+
+
+def snapshot(store, sub_key: str):
+    store.refresh()
+    record = store.shard_for(sub_key).keys[sub_key]
+    return record.balance_cents, record.used_cents
+
+
+def check_store(name: str, stores: List, expire: Callable[[str], None]) -> List[str]:
+    """stores 为同一份数据的一个或多个访问入口，重放请求轮流发往不同入口"""
+    problems = []
+    first, other = stores[0], stores[-1]
+    sub_key = first.create_sub_key(10.0, "lease-check")
+
+    # 释放后重放：第一次释放生效但响应丢失，客户端用相同的累计用量重试
+    lease = call(first, "leases/acquire", {"sub_key": sub_key, "amount": 5.0, "ttl": 60})
+    released = call(first, "leases/reconcile", {"lease_id": lease["lease_id"], "used": 1.0, "release": True})
+    before = snapshot(other, sub_key)
+    replay = call(other, "leases/reconcile", {"lease_id": lease["lease_id"], "used": 1.0, "release": True})
+    after = snapshot(other, sub_key)
+    print(f"[{name}] 释放: {released}")
+    print(f"[{name}] 重放: {replay}")
+    if released.get("settled") is not False or not released.get("closed"):
+        problems.append(f"{name}: 首次释放应返回 closed 且未标记 settled: {released}")
+    if not (replay.get("success") and replay.get("settled")) or replay.get("used") != 1.0:
+        problems.append(f"{name}: 重放应返回 settled 和结算用量 1.00: {replay}")
+    if before != after or after != (900, 100):
+        problems.append(f"{name}: 重放后余额/已用 {after}，应保持 {before} = (900, 100)")
+
+    # 续期上报落在已关闭的租约上：同样不能修改状态
+    late = call(other, "leases/reconcile", {"lease_id": lease["lease_id"], "used": 2.0, "ttl": 60})
+    if not late.get("settled") or snapshot(other, sub_key) != after:
+        problems.append(f"{name}: 已关闭租约的续期上报修改了状态: {late}")
+
+    # 过期后才上报：服务器只记录过期前上报的用量，多出的部分由客户端另行扣费
+    lease = call(first, "leases/acquire", {"sub_key": sub_key, "amount": 3.0, "ttl": 60})
+    call(first, "leases/reconcile", {"lease_id": lease["lease_id"], "used": 0.5})
+    expire(lease["lease_id"])
+    before = snapshot(other, sub_key)
+    expired = call(other, "leases/reconcile", {"lease_id": lease["lease_id"], "used": 0.8, "release": True})
+    print(f"[{name}] 过期后上报: {expired}")
+    if not expired.get("settled") or expired.get("used") != 0.5 or snapshot(other, sub_key) != before:
+        problems.append(f"{name}: 过期租约应返回 settled 和过期前的用量 0.50 且不修改余额: {expired}")
+    if before != (850, 150):
+        problems.append(f"{name}: 过期回收后余额/已用 {before}，应为 (850, 150)")
+    return problems
+
+
+def expire_in(store) -> Callable[[str], None]:
+    def expire(lease_id: str):
+        with store.transaction():
+            for lease in store.leases.values():
+                if lease.lease_id == lease_id:
+                    lease.expires_at = time.time() - 1
+                    store.shard_for(lease.sub_key)._save_leases()
+        store.expire_leases()
+    return expire
+
+
+def main():
+    problems = []
+
+    directory = tempfile.mkdtemp(prefix="lease_check_single_")
+    store = KeyManagementSystem(os.path.join(directory, "keys.json"), os.path.join(directory, "leases.json"))
+    problems.extend(check_store("单文件", [store], expire_in(store)))
+
+    directory = tempfile.mkdtemp(prefix="lease_check_shared_")
+    paths = (os.path.join(directory, "keys.json"), os.path.join(directory, "leases.json"))
+    workers = [SharedKeyManagementSystem(*paths), SharedKeyManagementSystem(*paths)]
+    problems.extend(check_store("共享存储", workers, expire_in(workers[0])))
+
+    directory = tempfile.mkdtemp(prefix="lease_check_sharded_")
+    store = ShardedKeyManagementSystem(os.path.join(directory, "keys.json"), os.path.join(directory, "leases.json"), 4)
+    problems.extend(check_store("分片存储", [store], expire_in(store)))
+
+    if problems:
+        print("\n检查失败:")
+        for problem in problems:
+            print(f"  - {problem}")
+        sys.exit(1)
+    print("\n检查通过")
+
+
+if __name__ == "__main__":
+    main()
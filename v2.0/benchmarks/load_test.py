@@ -0,0 +1,560 @@
+# load_test.py - 端到端压测：N 个虚拟用户按前端相同的请求序列（扣费 → 调用上游 → 失败退款）并发执行 TTS/STT 任务
+# 默认在临时目录中启动密钥服务和 SiliconFlow 替身服务器，不会触碰真实的 keys.json 和上游
+# 用法:
+#   python benchmarks/load_test.py --users 50 --duration 60 --output benchmarks/results/load_50u.json
+#   python benchmarks/load_test.py --users 50 --duration 60 --compare benchmarks/results/load_50u.json
+#   压测已在运行的服务: --kms-url http://localhost:8503 --master-key sk-xxx --upstream-url http://localhost:8504/v1
+#   同时记录前端进程内存: --monitor tts=<pid> --monitor kms_web=<pid>
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import requests
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+from job_timing import percentile
+
+SCHEMA_VERSION = 1
+MASTER_KEY = "sk-loadtest-master"
+PERCENTILES = (50, 90, 95, 99)
+
+# 压测样本文本（中文为主，UTF-8 约 3 字节/字符，与前端计费一致）
+SAMPLE_TEXT = "今天天气晴朗，适合出门散步。语音合成服务会把这段文字转换成自然流畅的语音。Hello world, this is a load test. "
+
+
+# ---------------------- 被测服务 ----------------------
+class ServiceProcess:
+    """启动一个子进程服务并等待健康检查通过"""
+
+    def __init__(self, name: str, args: List[str], cwd: str, env: Dict[str, str], health_url: str):
+        self.name = name
+        self.health_url = health_url
+        self.log = open(os.path.join(cwd, f"{name}.log"), "w", encoding="utf-8")
+        self.process = subprocess.Popen(args, cwd=cwd, env={**os.environ, **env},
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def wait_ready(self, timeout: float = 20.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} 启动失败，见日志 {self.log.name}")
+            try:
+                if requests.get(self.health_url, timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"{self.name} 在 {timeout:.0f} 秒内未就绪")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+def start_services(args, workdir: str) -> List[ServiceProcess]:
+    with open(os.path.join(workdir, "master_keys.json"), "w", encoding="utf-8") as f:
+        json.dump({"master_keys": [MASTER_KEY]}, f)
+    services = []
+    if not args.kms_url:
+        args.kms_url = f"http://127.0.0.1:{args.kms_port}"
+        services.append(ServiceProcess(
+            "kms", [sys.executable, os.path.join(BASE_DIR, "kms_api_server.py")], workdir,
+            {"KMS_PORT": str(args.kms_port), "TRACE_SPANS_FILE": os.path.join(workdir, "spans.jsonl")},
+            f"{args.kms_url}/health"
+        ))
+    if not args.upstream_url:
+        args.upstream_url = f"http://127.0.0.1:{args.upstream_port}/v1"
+        upstream_args = [sys.executable, os.path.join(BASE_DIR, "fake_siliconflow.py"),
+                         "--port", str(args.upstream_port), "--keys", args.upstream_key,
+                         "--per-mb", str(args.per_mb), "--per-kchar", str(args.per_kchar),
+                         "--errors", args.errors, "--max-concurrency", str(args.max_concurrency),
+                         "--seed", str(args.seed)]
+        for spec in args.latency:
+            upstream_args += ["--latency", spec]
+        services.append(ServiceProcess("fake_siliconflow", upstream_args, workdir, {},
+                                       f"http://127.0.0.1:{args.upstream_port}/stats"))
+    for service in services:
+        service.wait_ready()
+    return services
+
+
+# ---------------------- 内存采样 ----------------------
+def read_rss_mb(pid: int) -> Optional[float]:
+    """读取进程常驻内存（MB），依赖 Linux 的 /proc，其他平台返回 None"""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pids: Dict[str, int], interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.interval = interval
+        self.samples: Dict[str, List[float]] = {name: [] for name in pids}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            for name, pid in self.pids.items():
+                rss = read_rss_mb(pid)
+                if rss is not None:
+                    self.samples[name].append(rss)
+            self.stopped.wait(self.interval)
+
+    def summary(self) -> Dict:
+        result = {}
+        for name, values in self.samples.items():
+            if values:
+                result[name] = {"peak_rss_mb": round(max(values), 1),
+                                "mean_rss_mb": round(sum(values) / len(values), 1),
+                                "final_rss_mb": round(values[-1], 1)}
+            else:
+                result[name] = {"peak_rss_mb": None, "mean_rss_mb": None, "final_rss_mb": None}
+        return result
+
+
+# ---------------------- KMS 指标 ----------------------
+def scrape_metrics(kms_url: str) -> Dict[str, float]:
+    """抓取 /metrics，按指标名（含标签）返回数值；失败时返回空字典"""
+    try:
+        text = requests.get(f"{kms_url}/metrics", timeout=5).text
+    except requests.RequestException:
+        return {}
+    values = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        try:
+            values[name] = float(value.replace("+Inf", "inf"))
+        except ValueError:
+            continue
+    return values
+
+
+def metric_delta(before: Dict, after: Dict, prefix: str) -> float:
+    """某个指标（所有标签合计）在压测期间的增量"""
+    return sum(value - before.get(name, 0.0) for name, value in after.items()
+               if name == prefix or name.startswith(prefix + "{"))
+
+
+# ---------------------- 虚拟用户 ----------------------
+class Workload:
+    """按种子生成任务：类型比例、文本长度和音频大小都服从对数正态分布"""
+
+    def __init__(self, args, rng: random.Random):
+        self.rng = rng
+        self.mix = [(kind, float(weight)) for kind, weight in
+                    (item.split("=") for item in args.mix.split(","))]
+        self.text_median = args.text_median
+        self.audio_median_mb = args.audio_median_mb
+        self.max_audio_mb = args.max_audio_mb
+
+    def next_kind(self) -> str:
+        roll = self.rng.random() * sum(weight for _, weight in self.mix)
+        for kind, weight in self.mix:
+            if roll < weight:
+                return kind
+            roll -= weight
+        return self.mix[-1][0]
+
+    def text_length(self) -> int:
+        return int(min(20000, max(5, self.rng.lognormvariate(math.log(self.text_median), 1.0))))
+
+    def audio_bytes(self) -> int:
+        mb = min(self.max_audio_mb, max(0.02, self.rng.lognormvariate(math.log(self.audio_median_mb), 0.9)))
+        return int(mb * 1024 * 1024)
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index: int, args, sub_key: str, audio_pool: bytes, deadline: float,
+                 start_delay: float, results: List[Dict], results_lock: threading.Lock):
+        super().__init__(daemon=True)
+        self.args = args
+        self.sub_key = sub_key
+        self.audio_pool = audio_pool
+        self.deadline = deadline
+        self.start_delay = start_delay
+        self.results = results
+        self.results_lock = results_lock
+        self.rng = random.Random(args.seed * 1000 + index)
+        self.workload = Workload(args, self.rng)
+        self.session = requests.Session()
+
+    def kms_call(self, endpoint: str, payload: Dict, record: Dict) -> Optional[Dict]:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.args.kms_url}/api/{endpoint}", json=payload, timeout=self.args.kms_timeout)
+            return response.json()
+        except (requests.RequestException, ValueError):
+            return None
+        finally:
+            record.setdefault("kms_ms", {})[endpoint] = round((time.perf_counter() - start) * 1000, 3)
+
+    def charge(self, amount: float, record: Dict) -> bool:
+        result = self.kms_call("validate_and_deduct", {
+            "sub_key": self.sub_key, "amount": amount, "idempotency_key": uuid.uuid4().hex
+        }, record)
+        return bool(result and result.get("success"))
+
+    def refund(self, amount: float, record: Dict):
+        self.kms_call("validate_and_deduct", {
+            "sub_key": self.sub_key, "amount": -amount, "idempotency_key": uuid.uuid4().hex
+        }, record)
+        record["refunded"] = True
+
+    def call_upstream(self, record: Dict, **kwargs) -> str:
+        headers = {"Authorization": f"Bearer {self.args.upstream_key}"}
+        headers.update(kwargs.pop("headers", {}))
+        start = time.perf_counter()
+        try:
+            response = self.session.post(headers=headers, timeout=self.args.upstream_timeout, **kwargs)
+            record["response_bytes"] = len(response.content)
+            return "ok" if response.status_code == 200 else f"upstream_{response.status_code}"
+        except requests.Timeout:
+            return "timeout"
+        except requests.RequestException:
+            return "connection_error"
+        finally:
+            record["upstream_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+    def run_stt(self, record: Dict) -> str:
+        size = self.workload.audio_bytes()
+        # 与前端相同的计费规则：¥0.50/MB，最低 ¥0.10
+        cost = max(size / (1024 * 1024) * 0.50, 0.10)
+        record.update(bytes=size, cost=round(cost, 2))
+        if not self.charge(cost, record):
+            return "kms_rejected"
+        multipart = MultipartEncoder(fields={
+            "file": ("loadtest.mp3", self.audio_pool[:size], "audio/mpeg"),
+            "model": "FunAudioLLM/SenseVoiceSmall"
+        })
+        status = self.call_upstream(record, url=f"{self.args.upstream_url}/audio/transcriptions",
+                                    data=multipart, headers={"Content-Type": multipart.content_type})
+        if status != "ok":
+            self.refund(cost, record)
+        return status
+
+    def run_tts(self, record: Dict) -> str:
+        length = self.workload.text_length()
+        text = (SAMPLE_TEXT * (length // len(SAMPLE_TEXT) + 1))[:length]
+        # 与前端相同的计费规则：¥50/百万 UTF-8 字节，最低 ¥0.10
+        cost = max(len(text.encode("utf-8")) / 1_000_000 * 50, 0.10)
+        record.update(chars=length, cost=round(cost, 2))
+        if not self.charge(cost, record):
+            return "kms_rejected"
+        payload = {"model": "FunAudioLLM/CosyVoice2-0.5B", "input": text,
+                   "voice": "FunAudioLLM/CosyVoice2-0.5B:alex", "speed": 1.0,
+                   "response_format": self.rng.choice(["mp3", "mp3", "wav"])}
+        status = self.call_upstream(record, url=f"{self.args.upstream_url}/audio/speech",
+                                    data=json.dumps(payload), headers={"Content-Type": "application/json"})
+        if status != "ok":
+            self.refund(cost, record)
+        return status
+
+    def run_balance(self, record: Dict) -> str:
+        result = self.kms_call("get_balance", {"sub_key": self.sub_key}, record)
+        return "ok" if result and result.get("success") else "kms_error"
+
+    def run(self):
+        time.sleep(self.start_delay)
+        while time.monotonic() < self.deadline:
+            kind = self.workload.next_kind()
+            record = {"kind": kind, "start": time.monotonic()}
+            try:
+                record["status"] = getattr(self, f"run_{kind}")(record)
+            except Exception as e:
+                record["status"] = "error"
+                record["error"] = str(e)
+            record["end"] = time.monotonic()
+            with self.results_lock:
+                self.results.append(record)
+            if self.args.think > 0:
+                time.sleep(self.rng.expovariate(1.0 / self.args.think))
+
+
+# ---------------------- 统计与对比 ----------------------
+def latency_summary(values: List[float]) -> Dict:
+    ordered = sorted(values)
+    summary = {f"p{p}": round(percentile(ordered, p), 3) for p in PERCENTILES}
+    summary["max"] = round(ordered[-1], 3) if ordered else 0.0
+    summary["mean"] = round(sum(ordered) / len(ordered), 3) if ordered else 0.0
+    return summary
+
+
+def summarize(records: List[Dict], elapsed: float) -> Dict:
+    result = {"elapsed_s": round(elapsed, 3), "jobs": len(records),
+              "throughput_jobs_per_s": round(len(records) / elapsed, 3) if elapsed else 0.0, "by_kind": {}}
+    for kind in sorted({record["kind"] for record in records}):
+        group = [record for record in records if record["kind"] == kind]
+        ok = [record for record in group if record["status"] == "ok"]
+        statuses: Dict[str, int] = {}
+        for record in group:
+            statuses[record["status"]] = statuses.get(record["status"], 0) + 1
+        result["by_kind"][kind] = {
+            "jobs": len(group),
+            "ok": len(ok),
+            "throughput_ok_per_s": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+            "error_rate": round(1 - len(ok) / len(group), 4),
+            "statuses": statuses,
+            "refunds": sum(1 for record in group if record.get("refunded")),
+            "latency_ms": latency_summary([(record["end"] - record["start"]) * 1000 for record in ok]),
+        }
+    kms_calls: Dict[str, List[float]] = {}
+    for record in records:
+        for endpoint, ms in record.get("kms_ms", {}).items():
+            kms_calls.setdefault(endpoint, []).append(ms)
+    result["kms_client_latency_ms"] = {endpoint: {"calls": len(values), **latency_summary(values)}
+                                       for endpoint, values in sorted(kms_calls.items())}
+    return result
+
+
+def kms_server_summary(before: Dict, after: Dict, elapsed: float) -> Dict:
+    """服务端视角的密钥服务竞争情况：持久化在全局锁内执行，其累计耗时占比近似锁的忙碌度"""
+    if not after:
+        return {}
+    requests_total = metric_delta(before, after, "kms_http_request_duration_seconds_count")
+    handler_seconds = metric_delta(before, after, "kms_http_request_duration_seconds_sum")
+    persist_seconds = metric_delta(before, after, "kms_persist_duration_seconds_sum")
+    persist_count = metric_delta(before, after, "kms_persist_duration_seconds_count")
+    deductions = metric_delta(before, after, "kms_deductions_total")
+    refunds = metric_delta(before, after, "kms_refunds_total")
+    return {
+        "requests": int(requests_total),
+        "mean_handler_ms": round(handler_seconds / requests_total * 1000, 3) if requests_total else 0.0,
+        "persist_writes": int(persist_count),
+        "mean_persist_ms": round(persist_seconds / persist_count * 1000, 3) if persist_count else 0.0,
+        "lock_busy_fraction": round(persist_seconds / elapsed, 4) if elapsed else 0.0,
+        "persist_bytes_per_write": round(metric_delta(before, after, "kms_persist_bytes_total") / persist_count)
+        if persist_count else 0,
+        "deductions": int(deductions),
+        "refunds": int(refunds),
+        "deduct_failures": int(metric_delta(before, after, "kms_deduct_failures_total")),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def comparable_metrics(report: Dict) -> Dict[str, float]:
+    """对比时使用的扁平指标：名称 -> (数值)，名称以 higher:/lower: 标明哪个方向更好"""
+    summary = report["summary"]
+    flat = {"higher:throughput_jobs_per_s": summary["throughput_jobs_per_s"]}
+    for kind, stats in summary["by_kind"].items():
+        flat[f"higher:{kind}.throughput_ok_per_s"] = stats["throughput_ok_per_s"]
+        flat[f"lower:{kind}.error_rate"] = stats["error_rate"]
+        for key in ("p50", "p95", "p99"):
+            flat[f"lower:{kind}.latency_ms.{key}"] = stats["latency_ms"][key]
+    for endpoint, stats in summary["kms_client_latency_ms"].items():
+        flat[f"lower:kms.{endpoint}.p95_ms"] = stats["p95"]
+    if report.get("kms_server"):
+        flat["lower:kms.lock_busy_fraction"] = report["kms_server"]["lock_busy_fraction"]
+    for name, stats in report["memory"].items():
+        if stats["peak_rss_mb"] is not None:
+            flat[f"lower:memory.{name}.peak_rss_mb"] = stats["peak_rss_mb"]
+    return flat
+
+
+def compare_reports(baseline: Dict, current: Dict, tolerance: float) -> List[str]:
+    """逐项对比两份报告，打印差异并返回超出容差的退化项"""
+    if baseline.get("schema_version") != current.get("schema_version"):
+        print("警告: 报告格式版本不同，对比结果仅供参考")
+    changed = sorted(key for key in set(baseline["config"]) | set(current["config"])
+                     if baseline["config"].get(key) != current["config"].get(key))
+    if changed:
+        print(f"警告: 压测配置不同（{', '.join(changed)}），对比结果仅供参考")
+    old, new = comparable_metrics(baseline), comparable_metrics(current)
+    regressions = []
+    print(f"\n对比基线 {baseline.get('git_revision') or '-'} -> {current.get('git_revision') or '-'}"
+          f"（容差 {tolerance:.0%}）")
+    print(f"{'指标':<44}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for name in sorted(set(old) & set(new), key=lambda name: name.split(":", 1)[1]):
+        direction, label = name.split(":", 1)
+        before, after = old[name], new[name]
+        change = (after - before) / before if before else (0.0 if after == before else float("inf"))
+        worse = change < -tolerance if direction == "higher" else change > tolerance
+        # 错误率、锁占用等接近零的指标用绝对差判断，避免 0.001 -> 0.002 被当作翻倍
+        if label.endswith("error_rate") or label.endswith("lock_busy_fraction"):
+            worse = after - before > 0.01
+        flag = "  ✗" if worse else ""
+        change_text = f"{change:+.1%}" if change != float("inf") else "new"
+        print(f"{label:<44}{before:>12.3f}{after:>12.3f}{change_text:>10}{flag}")
+        if worse:
+            regressions.append(label)
+    return regressions
+
+
+def print_report(report: Dict):
+    summary = report["summary"]
+    config = report["config"]
+    print(f"\n虚拟用户: {config['users']}  时长: {summary['elapsed_s']:.1f}s  任务: {summary['jobs']}  "
+          f"吞吐: {summary['throughput_jobs_per_s']:.2f} 任务/秒")
+    print(f"{'类型':<10}{'任务':>8}{'成功/秒':>10}{'错误率':>9}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  (ms)")
+    for kind, stats in summary["by_kind"].items():
+        latency = stats["latency_ms"]
+        print(f"{kind:<10}{stats['jobs']:>8}{stats['throughput_ok_per_s']:>10.2f}{stats['error_rate']:>9.2%}"
+              f"{latency['p50']:>10.1f}{latency['p95']:>10.1f}{latency['p99']:>10.1f}{latency['max']:>10.1f}")
+        errors = {status: count for status, count in stats["statuses"].items() if status != "ok"}
+        if errors:
+            print(f"{'':<10}错误: {errors}  退款: {stats['refunds']}")
+    print("密钥服务调用（客户端视角）:")
+    for endpoint, stats in summary["kms_client_latency_ms"].items():
+        print(f"  {endpoint:<22}{stats['calls']:>8} 次  p50 {stats['p50']:.1f}ms  p95 {stats['p95']:.1f}ms  "
+              f"p99 {stats['p99']:.1f}ms")
+    server = report.get("kms_server")
+    if server:
+        print(f"密钥服务（服务端视角）: 平均处理 {server['mean_handler_ms']:.2f}ms  持久化 {server['persist_writes']} 次 "
+              f"平均 {server['mean_persist_ms']:.2f}ms  锁忙碌占比 {server['lock_busy_fraction']:.1%}  "
+              f"每次写入 {server['persist_bytes_per_write']} 字节")
+    print("进程内存:")
+    for name, stats in report["memory"].items():
+        if stats["peak_rss_mb"] is None:
+            print(f"  {name:<20}不可用（需要 Linux /proc）")
+        else:
+            print(f"  {name:<20}峰值 {stats['peak_rss_mb']:.1f}MB  平均 {stats['mean_rss_mb']:.1f}MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TTS/STT 端到端并发压测")
+    parser.add_argument("--users", type=int, default=20, help="并发虚拟用户数")
+    parser.add_argument("--duration", type=float, default=60.0, help="压测时长（秒），到时后等待进行中的任务结束")
+    parser.add_argument("--ramp-up", type=float, default=5.0, help="在该时间内逐个启动虚拟用户（秒）")
+    parser.add_argument("--think", type=float, default=1.0, help="任务间平均思考时间（秒，指数分布，0 为不等待）")
+    parser.add_argument("--mix", default="tts=0.5,stt=0.4,balance=0.1", help="任务类型比例")
+    parser.add_argument("--text-median", type=int, default=300, help="TTS 文本长度中位数（字符）")
+    parser.add_argument("--audio-median-mb", type=float, default=2.0, help="STT 音频大小中位数（MB）")
+    parser.add_argument("--max-audio-mb", type=float, default=25.0, help="STT 音频大小上限（MB）")
+    parser.add_argument("--sub-keys", type=int, default=0, help="子密钥数量，用户轮流共用（0 为每个用户一个）")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--kms-url", default="", help="已运行的密钥服务地址（为空时自动在临时目录启动）")
+    parser.add_argument("--kms-port", type=int, default=18503, help="自动启动密钥服务时使用的端口")
+    parser.add_argument("--master-key", default=MASTER_KEY, help="创建子密钥使用的主密钥")
+    parser.add_argument("--upstream-url", default="", help="已运行的上游地址（为空时自动启动替身服务器）")
+    parser.add_argument("--upstream-port", type=int, default=18504, help="自动启动替身服务器时使用的端口")
+    parser.add_argument("--upstream-key", default="sk-loadtest-upstream", help="调用上游使用的主密钥")
+    parser.add_argument("--latency", action="append", default=[],
+                        help="替身服务器的延迟分布，见 fake_siliconflow.py（默认 speech=lognormal:0.8:0.4 与 transcriptions=lognormal:1.0:0.5）")
+    parser.add_argument("--per-mb", type=float, default=0.2, help="替身服务器每MB音频额外耗时（秒）")
+    parser.add_argument("--per-kchar", type=float, default=0.5, help="替身服务器每千字符额外耗时（秒）")
+    parser.add_argument("--errors", default="429:0.01,503:0.005", help="替身服务器错误注入概率")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="替身服务器最大并发（0 为不限）")
+    parser.add_argument("--kms-timeout", type=float, default=10.0, help="密钥服务请求超时（秒）")
+    parser.add_argument("--upstream-timeout", type=float, default=300.0, help="上游请求超时（秒）")
+    parser.add_argument("--monitor", action="append", default=[], help="额外记录内存的进程，格式 名称=pid")
+    parser.add_argument("--output", default="", help="结果 JSON 路径（默认 benchmarks/results/load_<时间>.json）")
+    parser.add_argument("--compare", default="", help="与之前的结果 JSON 对比，超出容差时以非零状态退出")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="对比时允许的相对退化")
+    args = parser.parse_args()
+    args.latency = args.latency or ["speech=lognormal:0.8:0.4", "transcriptions=lognormal:1.0:0.5"]
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare", "monitor")}
+
+    workdir = tempfile.mkdtemp(prefix="kms_load_")
+    services = start_services(args, workdir)
+    try:
+        # 准备子密钥，余额足够整个压测使用
+        sub_key_count = args.sub_keys or args.users
+        sub_keys = []
+        for i in range(sub_key_count):
+            result = requests.post(f"{args.kms_url}/api/create_key", json={
+                "master_key": args.master_key, "balance": 1_000_000, "description": f"loadtest-{i}"
+            }, timeout=10).json()
+            if not result.get("success"):
+                raise RuntimeError(f"创建子密钥失败: {result.get('error')}")
+            sub_keys.append(result["sub_key"])
+
+        pids = {service.name: service.pid for service in services}
+        pids["load_test"] = os.getpid()
+        for item in args.monitor:
+            name, pid = item.split("=", 1)
+            pids[name] = int(pid)
+        sampler = MemorySampler(pids)
+        sampler.start()
+
+        # 所有用户共用一块音频数据，按需要的大小切片
+        audio_pool = random.Random(args.seed).randbytes(int(args.max_audio_mb * 1024 * 1024))
+        metrics_before = scrape_metrics(args.kms_url)
+        results: List[Dict] = []
+        results_lock = threading.Lock()
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [VirtualUser(i, args, sub_keys[i % sub_key_count], audio_pool, deadline,
+                             args.ramp_up * i / max(1, args.users), results, results_lock)
+                 for i in range(args.users)]
+        print(f"启动 {args.users} 个虚拟用户，压测 {args.duration:.0f} 秒（密钥服务 {args.kms_url}，上游 {args.upstream_url}）")
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.monotonic() - started
+        metrics_after = scrape_metrics(args.kms_url)
+        sampler.stopped.set()
+        sampler.join()
+    finally:
+        for service in services:
+            service.stop()
+
+    report = {
+        "schema_version": SCHEMA_VERSION,
+        "tool": "load_test",
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpu_count": os.cpu_count()},
+        "config": config,
+        "summary": summarize(results, elapsed),
+        "kms_server": kms_server_summary(metrics_before, metrics_after, elapsed),
+        "memory": sampler.summary(),
+    }
+    print_report(report)
+
+    output = args.output or os.path.join(BASE_DIR, "benchmarks", "results",
+                                         f"load_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_reports(baseline, report, args.tolerance)
+        if regressions:
+            print(f"性能退化 {len(regressions)} 项: {', '.join(regressions)}")
+            sys.exit(1)
+        print("未发现超出容差的退化")
+
+
+if __name__ == "__main__":
+    main()
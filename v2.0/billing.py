@@ -0,0 +1,15 @@
+# billing.py - 金额换算：元与整数分之间的转换；前端本地租约扣费、密钥服务扣费/退款和断点续传的单元计费共用同一种舍入（四舍五入），
+# 同一笔费用在各条路径上换算出的分数一致
+from decimal import Decimal, ROUND_HALF_UP
+
+
+def yuan_to_cents(value) -> int:
+    """将元金额（float/str/Decimal）四舍五入到分，返回整数分"""
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return int((value * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+def cents_to_yuan(cents: int) -> float:
+    """将整数分转换为两位小数的元金额"""
+    return cents / 100
@@ -0,0 +1,136 @@
+# deadlines.py - 任务期限与自适应超时：每个任务一个总期限，转换、密钥服务和上游调用都只使用剩余时间；
+# 上游超时按负载大小和各主密钥最近的实测吞吐推算，预计无法在期限内完成时直接失败
+# 参数可通过环境变量 JOB_DEADLINE / UPSTREAM_CONNECT_TIMEOUT / UPSTREAM_MIN_TIMEOUT / UPSTREAM_MAX_TIMEOUT / UPSTREAM_TIMEOUT_FACTOR 配置
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+JOB_DEADLINE = float(os.environ.get("JOB_DEADLINE", "600"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "10"))
+UPSTREAM_MIN_TIMEOUT = float(os.environ.get("UPSTREAM_MIN_TIMEOUT", "15"))
+UPSTREAM_MAX_TIMEOUT = float(os.environ.get("UPSTREAM_MAX_TIMEOUT", "300"))
+UPSTREAM_TIMEOUT_FACTOR = float(os.environ.get("UPSTREAM_TIMEOUT_FACTOR", "3"))
+
+
+class DeadlineExceeded(RuntimeError):
+    """任务已超过期限，或预计无法在剩余时间内完成"""
+
+
+class Deadline:
+    """一个任务的总期限（单调时钟）；各阶段用 remaining() 限制自己的超时"""
+
+    def __init__(self, seconds: float = JOB_DEADLINE):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str, needed: float = 0.0):
+        """剩余时间不足 needed 秒（默认为已过期）时抛出 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"任务已超过 {self.seconds:.0f} 秒期限（{stage}）")
+        if needed > remaining:
+            raise DeadlineExceeded(f"{stage}预计需要 {needed:.0f} 秒，任务期限只剩 {remaining:.0f} 秒")
+
+    def cap(self, timeout: float) -> float:
+        """把阶段超时限制在剩余时间内"""
+        return max(0.001, min(timeout, self.remaining()))
+
+
+class _LinearFit:
+    """耗时 = 固定开销 + 大小 / 吞吐 的指数加权最小二乘拟合，较早的样本按 alpha 逐步淡出"""
+    __slots__ = ("w", "x", "y", "xx", "xy", "samples")
+
+    def __init__(self):
+        self.w = self.x = self.y = self.xx = self.xy = 0.0
+        self.samples = 0
+
+    def add(self, size: float, seconds: float, alpha: float):
+        decay = 1.0 - alpha
+        self.w = self.w * decay + 1.0
+        self.x = self.x * decay + size
+        self.y = self.y * decay + seconds
+        self.xx = self.xx * decay + size * size
+        self.xy = self.xy * decay + size * seconds
+        self.samples += 1
+
+    def params(self) -> Tuple[float, float]:
+        """返回 (固定开销秒数, 每字节秒数)；样本大小都相近时按平均速率折算"""
+        mean_x, mean_y = self.x / self.w, self.y / self.w
+        variance = self.xx / self.w - mean_x * mean_x
+        if variance <= (0.05 * mean_x) ** 2 or mean_x <= 0:
+            return 0.0, mean_y / mean_x if mean_x > 0 else 0.0
+        slope = max(0.0, (self.xy / self.w - mean_x * mean_y) / variance)
+        return max(0.0, mean_y - slope * mean_x), slope
+
+
+class ThroughputModel:
+    """按 (主密钥, 请求类型) 记录最近的实测耗时，推算给定负载大小的预计耗时和连接/读取超时；
+    某个主密钥的样本不足 min_samples 时使用所有主密钥的汇总，仍不足时返回 None（使用最大超时，不提前判定失败）"""
+
+    def __init__(self, alpha: float = 0.2, min_samples: int = 3, factor: float = UPSTREAM_TIMEOUT_FACTOR,
+                 connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT, min_timeout: float = UPSTREAM_MIN_TIMEOUT,
+                 max_timeout: float = UPSTREAM_MAX_TIMEOUT):
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.factor = factor
+        self.connect_timeout = connect_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self._lock = threading.Lock()
+        self._fits: Dict[Tuple[str, str], _LinearFit] = {}
+        self._stats = {"fail_fast": 0, "timeouts": 0}
+
+    def observe(self, master_key: str, kind: str, size: int, seconds: float):
+        """记录一次成功调用的负载大小和耗时"""
+        with self._lock:
+            for scope in (master_key, "*"):
+                self._fits.setdefault((scope, kind), _LinearFit()).add(size, seconds, self.alpha)
+
+    def estimate(self, master_key: str, kind: str, size: int) -> Optional[float]:
+        with self._lock:
+            for scope in (master_key, "*"):
+                fit = self._fits.get((scope, kind))
+                if fit and fit.samples >= self.min_samples:
+                    overhead, per_byte = fit.params()
+                    return overhead + size * per_byte
+        return None
+
+    def timeouts(self, master_key: str, kind: str, size: int, deadline: Optional[Deadline] = None) -> Tuple[float, float]:
+        """返回 requests 使用的 (连接超时, 读取超时)；预计耗时超过期限剩余时间时抛出 DeadlineExceeded"""
+        expected = self.estimate(master_key, kind, size)
+        if deadline is not None:
+            try:
+                deadline.check("上游调用", expected or 0.0)
+            except DeadlineExceeded:
+                self.count("fail_fast")
+                raise
+        read = self.max_timeout if expected is None else \
+            min(self.max_timeout, max(self.min_timeout, expected * self.factor))
+        if deadline is None:
+            return self.connect_timeout, read
+        return deadline.cap(self.connect_timeout), deadline.cap(read)
+
+    def count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict:
+        """各主密钥（只显示末 4 位）的样本数、固定开销和吞吐（字节/秒）"""
+        with self._lock:
+            stats = dict(self._stats)
+            fits = {key: (fit.samples, fit.params()) for key, fit in self._fits.items()}
+        stats["keys"] = {
+            f"{'*' if scope == '*' else '…' + scope[-4:]}/{kind}": {
+                "samples": samples, "overhead_s": round(overhead, 3),
+                "bytes_per_s": round(1 / per_byte) if per_byte > 0 else None
+            }
+            for (scope, kind), (samples, (overhead, per_byte)) in fits.items()
+        }
+        return stats
@@ -0,0 +1,251 @@
+# fake_siliconflow.py - 本地 SiliconFlow 替身服务器，用于离线的确定性负载/延迟测试
+# 用法示例:
+#   python fake_siliconflow.py --port 8504 --latency speech=lognormal:0.8:0.4 --latency transcriptions=uniform:0.3:1.5 \
+#       --per-mb 0.2 --errors 429:0.02,503:0.01 --max-concurrency 32 --quota 1000 --stall 0.02:120
+# 前端指向替身: SILICONFLOW_BASE_URL=http://localhost:8504/v1 streamlit run tts_or_stt.py
+import argparse
+import io
+import math
+import random
+import struct
+import threading
+import time
+import wave
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask, request, jsonify
+
+MODELS = [
+    "FunAudioLLM/SenseVoiceSmall",
+    "FunAudioLLM/CosyVoice2-0.5B",
+    "fnlp/MOSS-TTSD-v0.5"
+]
+
+# 一个 MPEG-1 Layer III 128kbps/44.1kHz 的静音帧（帧头 + 全零数据），约 26ms
+_MP3_SILENT_FRAME = b"\xff\xfb\x90\x64" + b"\x00" * 413
+
+
+def parse_distribution(spec: str):
+    """解析延迟分布（秒）：fixed:x | uniform:a:b | normal:mu:sigma | lognormal:median:sigma | exp:mean"""
+    parts = spec.split(":")
+    kind, args = parts[0], [float(x) for x in parts[1:]]
+    if kind == "fixed":
+        return lambda rng: args[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(args[0], args[1]))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1.0 / args[0])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+def parse_errors(spec: str) -> List[Tuple[int, float]]:
+    """解析错误注入配置：'429:0.02,503:0.01' -> [(429, 0.02), (503, 0.01)]"""
+    result = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        code, rate = item.split(":")
+        result.append((int(code), float(rate)))
+    return result
+
+
+class FakeUpstream:
+    """替身服务器的状态：延迟模型、限流、错误注入、按密钥配额和统计"""
+
+    def __init__(self, keys: Optional[List[str]] = None, latency: Optional[Dict[str, str]] = None,
+                 per_mb: float = 0.0, per_kchar: float = 0.0, errors: str = "",
+                 max_concurrency: int = 0, rps: float = 0.0, quota: int = 0, seed: Optional[int] = None,
+                 stall: str = ""):
+        self.keys = set(keys or [])
+        self.latency = {name: parse_distribution(spec) for name, spec in (latency or {}).items()}
+        self.per_mb = per_mb
+        self.per_kchar = per_kchar
+        self.errors = parse_errors(errors)
+        self.max_concurrency = max_concurrency
+        self.rps = rps
+        self.quota = quota
+        # 卡顿注入：按 stall_rate 的概率让请求额外挂起 stall_seconds 秒（模拟偶发的长时间无响应）
+        self.stall_rate, self.stall_seconds = (float(x) for x in stall.split(":")) if stall else (0.0, 0.0)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.tokens = rps
+        self.last_refill = time.monotonic()
+        self.usage: Dict[str, int] = {}
+        self.stats: Dict[str, int] = {}
+
+    def _count(self, name: str):
+        self.stats[name] = self.stats.get(name, 0) + 1
+
+    def admit(self, endpoint: str):
+        """鉴权、配额、限流和错误注入；返回 (错误响应或 None)"""
+        auth = request.headers.get("Authorization", "")
+        key = auth[7:] if auth.startswith("Bearer ") else ""
+        with self.lock:
+            self._count(f"{endpoint}.requests")
+            if not key or (self.keys and key not in self.keys):
+                self._count("status.401")
+                return error_response(401, "Invalid token")
+            if self.quota and self.usage.get(key, 0) >= self.quota:
+                self._count("status.403")
+                return error_response(403, "Insufficient quota for this key")
+            if self.rps:
+                now = time.monotonic()
+                self.tokens = min(self.rps, self.tokens + (now - self.last_refill) * self.rps)
+                self.last_refill = now
+                if self.tokens < 1:
+                    self._count("status.429")
+                    return error_response(429, "Request was rejected due to rate limiting")
+                self.tokens -= 1
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                self._count("status.429")
+                return error_response(429, "Too many concurrent requests")
+            roll = self.rng.random()
+            for code, rate in self.errors:
+                if roll < rate:
+                    self._count(f"status.{code}")
+                    return error_response(code, f"Injected error {code}")
+                roll -= rate
+            self.usage[key] = self.usage.get(key, 0) + 1
+            self.in_flight += 1
+        return None
+
+    def release(self, status: int):
+        with self.lock:
+            self.in_flight -= 1
+            self._count(f"status.{status}")
+
+    def delay(self, endpoint: str, extra: float):
+        """按配置的分布加上与负载大小成正比的耗时后休眠"""
+        dist = self.latency.get(endpoint)
+        with self.lock:
+            base = dist(self.rng) if dist else 0.0
+            if self.stall_rate and self.rng.random() < self.stall_rate:
+                self._count(f"{endpoint}.stalled")
+                base += self.stall_seconds
+        if base + extra > 0:
+            time.sleep(base + extra)
+
+
+def error_response(status: int, message: str):
+    response = jsonify({"code": status, "message": message, "error": {"message": message, "code": status}})
+    response.status_code = status
+    return response
+
+
+def synth_wav(seconds: float, sample_rate: int = 16000) -> bytes:
+    """生成指定时长的 440Hz 正弦波 WAV（按整秒波形平铺，避免逐样本计算拖慢响应）"""
+    one_second = b"".join(struct.pack("<h", int(8000 * math.sin(2 * math.pi * 440 * i / sample_rate)))
+                          for i in range(sample_rate))
+    frames = int(seconds * sample_rate)
+    pcm = (one_second * (frames // sample_rate + 1))[:frames * 2]
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def synth_mp3(seconds: float) -> bytes:
+    return _MP3_SILENT_FRAME * max(1, int(seconds / 0.026))
+
+
+def create_app(upstream: FakeUpstream) -> Flask:
+    app = Flask(__name__)
+
+    @app.route('/v1/models', methods=['GET'])
+    def models():
+        rejected = upstream.admit("models")
+        if rejected:
+            return rejected
+        upstream.delay("models", 0.0)
+        upstream.release(200)
+        return jsonify({"object": "list", "data": [{"id": model, "object": "model"} for model in MODELS]})
+
+    @app.route('/v1/audio/transcriptions', methods=['POST'])
+    def transcriptions():
+        rejected = upstream.admit("transcriptions")
+        if rejected:
+            return rejected
+        status = 200
+        try:
+            audio = request.files.get("file")
+            model = request.form.get("model")
+            if audio is None or model not in MODELS:
+                status = 400
+                return error_response(400, "Missing file or unsupported model")
+            size = len(audio.read())
+            upstream.delay("transcriptions", size / (1024 * 1024) * upstream.per_mb)
+            return jsonify({"text": f"[fake transcription] {audio.filename} {size} bytes"})
+        finally:
+            upstream.release(status)
+
+    @app.route('/v1/audio/speech', methods=['POST'])
+    def speech():
+        rejected = upstream.admit("speech")
+        if rejected:
+            return rejected
+        status = 200
+        try:
+            payload = request.get_json(force=True, silent=True) or {}
+            text = payload.get("input", "")
+            if not text or payload.get("model") not in MODELS:
+                status = 400
+                return error_response(400, "Missing input or unsupported model")
+            upstream.delay("speech", len(text) / 1000 * upstream.per_kchar)
+            # 约每秒 5 个字符，语速参数缩短时长
+            seconds = min(600.0, max(0.5, len(text) / 5 / float(payload.get("speed", 1.0) or 1.0)))
+            if payload.get("response_format") == "wav":
+                return app.response_class(synth_wav(seconds), mimetype="audio/wav")
+            return app.response_class(synth_mp3(seconds), mimetype="audio/mpeg")
+        finally:
+            upstream.release(status)
+
+    @app.route('/stats', methods=['GET'])
+    def stats():
+        with upstream.lock:
+            return jsonify({"in_flight": upstream.in_flight, "stats": dict(upstream.stats), "usage": dict(upstream.usage)})
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 SiliconFlow 替身服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8504)
+    parser.add_argument("--keys", default="", help="允许的主密钥，逗号分隔；为空时接受任意 Bearer 密钥")
+    parser.add_argument("--latency", action="append", default=[],
+                        help="端点延迟分布，如 speech=lognormal:0.8:0.4（端点: speech/transcriptions/models）")
+    parser.add_argument("--per-mb", type=float, default=0.0, help="转录每MB音频额外耗时（秒）")
+    parser.add_argument("--per-kchar", type=float, default=0.0, help="语音合成每千字符额外耗时（秒）")
+    parser.add_argument("--errors", default="", help="错误注入概率，如 401:0.01,429:0.02,503:0.01")
+    parser.add_argument("--max-concurrency", type=int, default=0, help="最大并发数，超出返回429（0为不限）")
+    parser.add_argument("--rps", type=float, default=0.0, help="每秒请求数上限，超出返回429（0为不限）")
+    parser.add_argument("--quota", type=int, default=0, help="每个密钥的请求配额，用尽返回403（0为不限）")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子，固定后延迟和错误序列可复现")
+    parser.add_argument("--stall", default="", help="卡顿注入，如 0.02:120 表示 2%% 的请求额外挂起 120 秒")
+    args = parser.parse_args()
+
+    latency = dict(item.split("=", 1) for item in args.latency)
+    upstream = FakeUpstream(
+        keys=[key for key in args.keys.split(",") if key],
+        latency=latency,
+        per_mb=args.per_mb,
+        per_kchar=args.per_kchar,
+        errors=args.errors,
+        max_concurrency=args.max_concurrency,
+        rps=args.rps,
+        quota=args.quota,
+        seed=args.seed,
+        stall=args.stall
+    )
+    print(f"SiliconFlow 替身服务器: http://{args.host}:{args.port}/v1")
+    create_app(upstream).run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
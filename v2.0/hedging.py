@@ -0,0 +1,197 @@
+# hedging.py - 对冲请求：短请求超过近期延迟的百分位仍未响应时，用另一个主密钥再发一份，先返回的响应胜出，落败的请求被取消
+# 开关和参数可通过环境变量 HEDGE_ENABLED / HEDGE_PERCENTILE / HEDGE_MIN_DELAY / HEDGE_MAX_DELAY / HEDGE_BUDGET / HEDGE_MAX_BYTES 配置
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tracing
+from job_timing import percentile
+
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "1.0"))
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "30.0"))
+HEDGE_BUDGET = float(os.environ.get("HEDGE_BUDGET", "0.1"))
+HEDGE_MAX_BYTES = int(os.environ.get("HEDGE_MAX_BYTES", str(1024 * 1024)))
+
+
+class HedgeCancelled(Exception):
+    """对冲中落败的请求被取消"""
+
+
+class Attempt:
+    """同一请求的一次发送；cancelled 置位后上传回调和收到的响应都会被中止"""
+
+    def __init__(self, index: int, master_key: str):
+        self.index = index
+        self.master_key = master_key
+        self.span_id = tracing.new_span_id()
+        self.cancelled = threading.Event()
+        self.started_at = time.perf_counter()
+        self.finished_at: Optional[float] = None
+        self.response = None
+        self.error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    @property
+    def hedge(self) -> bool:
+        return self.index > 0
+
+    @property
+    def ok(self) -> bool:
+        """有可用的响应（5xx 和 429 视为失败，等另一份请求的结果）"""
+        return self.error is None and self.response is not None and \
+            self.response.status_code < 500 and self.response.status_code != 429
+
+    def check(self):
+        """在上传回调等位置调用，请求已落败时抛出 HedgeCancelled 中止发送"""
+        if self.cancelled.is_set():
+            raise HedgeCancelled("对冲请求已落败")
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            response = self.response
+        _close(response)
+
+    def _complete(self, response=None, error: Optional[BaseException] = None):
+        with self._lock:
+            self.finished_at = time.perf_counter()
+            self.response, self.error = response, error
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            _close(response)
+
+
+def _close(response):
+    """关闭落败的响应；流式响应的正文尚未读取，关闭后直接断开连接"""
+    close = getattr(response, "close", None)
+    if close:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+class HedgePolicy:
+    """按请求类型记录最近的响应耗时，请求超过其 percentile 分位（限制在 min_delay~max_delay 之间）仍未响应时发出对冲请求；
+    每个请求积累 budget 个额度，每次对冲消耗 1 个，对冲数因此不超过请求数的 budget 比例"""
+
+    def __init__(self, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 min_delay: float = HEDGE_MIN_DELAY, max_delay: float = HEDGE_MAX_DELAY,
+                 budget: float = HEDGE_BUDGET, max_bytes: int = HEDGE_MAX_BYTES,
+                 window: int = 200, min_samples: int = 20, burst: float = 5.0):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.max_bytes = max_bytes
+        self.window = window
+        self.min_samples = min_samples
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, deque] = {}
+        self._credits = burst
+        self._stats = {"requests": 0, "eligible": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0,
+                       "budget_denied": 0, "no_alternate": 0, "cancelled": 0}
+
+    def delay(self, kind: str) -> float:
+        """发出对冲前的等待时间；样本不足 min_samples 时使用 max_delay"""
+        with self._lock:
+            samples = sorted(self._latencies.get(kind, ()))
+        if len(samples) < self.min_samples:
+            return self.max_delay
+        return min(self.max_delay, max(self.min_delay, percentile(samples, self.percentile)))
+
+    def record(self, kind: str, seconds: float):
+        with self._lock:
+            self._latencies.setdefault(kind, deque(maxlen=self.window)).append(seconds)
+
+    def call(self, kind: str, size: int, send: Callable[[Attempt], object], master_key: str,
+             alternate_key: Callable[[str], Optional[str]]) -> Tuple[object, Attempt, List[Attempt]]:
+        """发送请求，返回 (胜出的响应, 胜出的发送, 全部发送)；send(attempt) 用 attempt.master_key 发出请求并返回响应。
+        未启用或请求超过 max_bytes 时直接在当前线程发送；所有发送都失败时抛出最后一个异常或返回最后一个失败响应"""
+        eligible = self.enabled and size <= self.max_bytes
+        with self._lock:
+            self._stats["requests"] += 1
+            if eligible:
+                self._stats["eligible"] += 1
+                self._credits = min(self.burst, self._credits + self.budget)
+
+        primary = Attempt(0, master_key)
+        if not eligible:
+            primary._complete(send(primary))
+            return primary.response, primary, [primary]
+
+        finished: "queue.Queue[Attempt]" = queue.Queue()
+        attempts = [self._start(primary, send, finished)]
+        outstanding = list(attempts)
+        hedge_at = time.perf_counter() + self.delay(kind)
+        winner = None
+        while winner is None:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.perf_counter())
+            try:
+                attempt = finished.get(timeout=timeout)
+            except queue.Empty:
+                hedge_at = None
+                hedge = self._hedge(primary, alternate_key)
+                if hedge is not None:
+                    attempts.append(self._start(hedge, send, finished))
+                    outstanding.append(hedge)
+                continue
+            outstanding.remove(attempt)
+            # 对冲前主请求就失败时不再对冲，失败交给调用方按原有逻辑处理；已对冲时等另一份请求的结果
+            if attempt.ok or not outstanding:
+                winner = attempt
+            else:
+                _close(attempt.response)
+
+        for attempt in outstanding:
+            attempt.cancel()
+        with self._lock:
+            self._stats["cancelled"] += len(outstanding)
+            if len(attempts) > 1 and winner.ok:
+                self._stats["hedge_wins" if winner.hedge else "primary_wins"] += 1
+        if winner.ok:
+            self.record(kind, winner.finished_at - winner.started_at)
+        if winner.error is not None:
+            raise winner.error
+        return winner.response, winner, attempts
+
+    def _hedge(self, primary: Attempt, alternate_key: Callable[[str], Optional[str]]) -> Optional[Attempt]:
+        with self._lock:
+            if self._credits < 1:
+                self._stats["budget_denied"] += 1
+                return None
+        key = alternate_key(primary.master_key)
+        with self._lock:
+            if key is None:
+                self._stats["no_alternate"] += 1
+                return None
+            self._credits -= 1
+            self._stats["hedged"] += 1
+        return Attempt(1, key)
+
+    def _start(self, attempt: Attempt, send: Callable, finished: "queue.Queue[Attempt]") -> Attempt:
+        def run():
+            try:
+                attempt._complete(send(attempt))
+            except BaseException as e:
+                attempt._complete(error=e)
+            finished.put(attempt)
+        threading.Thread(target=run, name=f"hedge-{attempt.index}", daemon=True).start()
+        return attempt
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            kinds = list(self._latencies)
+        stats["hedge_rate"] = round(stats["hedged"] / stats["eligible"], 4) if stats["eligible"] else 0.0
+        stats["hedge_win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+        stats["delays"] = {kind: round(self.delay(kind), 3) for kind in kinds}
+        stats["enabled"] = self.enabled
+        return stats
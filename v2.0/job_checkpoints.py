@@ -0,0 +1,353 @@
+# job_checkpoints.py - 长任务断点续传：长文本/长音频拆成若干单元，每个单元完成后把结果和计费状态写入磁盘；
+# 刷新页面、进程崩溃或上游超时后重新提交相同的任务，只处理（和扣费）尚未完成的单元
+# 每个任务一个目录 <JOB_CHECKPOINT_DIR>/<job_id>/：manifest.json 记录各单元的状态和费用，unit-NNNN.* 为单元的输入和结果
+# 环境变量: JOB_CHECKPOINT_DIR（默认 checkpoints）、JOB_CHECKPOINT_MAX_AGE（未完成任务的保留秒数，默认 86400，与密钥服务幂等键的有效期一致）、
+#          TTS_UNIT_CHARS（语音合成每个单元的最大字符数，默认 500）、STT_UNIT_SECONDS（转录每个单元的最长音频时长，默认 300）
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+import wave
+from typing import Callable, Dict, List, Optional
+
+from billing import cents_to_yuan
+
+JOB_CHECKPOINT_DIR = os.environ.get("JOB_CHECKPOINT_DIR", "checkpoints")
+JOB_CHECKPOINT_MAX_AGE = float(os.environ.get("JOB_CHECKPOINT_MAX_AGE", "86400"))
+TTS_UNIT_CHARS = int(os.environ.get("TTS_UNIT_CHARS", "500"))
+STT_UNIT_SECONDS = float(os.environ.get("STT_UNIT_SECONDS", "300"))
+
+MANIFEST_VERSION = 1
+# 在这些字符之后断句；英文句号只在后面跟空白时断开，避免拆开小数和缩写
+_SENTENCE_BREAK = re.compile(r"(?<=[。！？!?；;…\n])|(?<=\.)(?=\s)")
+
+
+class UnitFailed(RuntimeError):
+    """单元处理失败（上游返回错误等），消息直接展示给用户"""
+
+
+def split_text(text: str, max_chars: int = TTS_UNIT_CHARS) -> List[str]:
+    """按句子边界把文本拆成不超过 max_chars 个字符的单元；单句过长时按字符硬切，只含空白的单元丢弃"""
+    units, current = [], ""
+    for sentence in _SENTENCE_BREAK.split(text):
+        if len(current) + len(sentence) <= max_chars:
+            current += sentence
+            continue
+        if current:
+            units.append(current)
+        while len(sentence) > max_chars:
+            units.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        current = sentence
+    if current:
+        units.append(current)
+    return [unit for unit in units if unit.strip()]
+
+
+def allocate_cents(total_cents: int, weights: List[int]) -> List[int]:
+    """把任务总费用按权重（文本字节数或音频大小）分摊到各单元，各单元之和恰好等于总费用（最大余数法）"""
+    if not sum(weights):
+        weights = [1] * len(weights)
+    exact = [total_cents * weight / sum(weights) for weight in weights]
+    cents = [int(value) for value in exact]
+    by_remainder = sorted(range(len(weights)), key=lambda i: exact[i] - cents[i], reverse=True)
+    for index in by_remainder[:total_cents - sum(cents)]:
+        cents[index] += 1
+    return cents
+
+
+def audio_duration(path: str) -> Optional[float]:
+    """音频时长（秒）：WAV 直接读文件头，其他格式用 ffprobe；无法识别时返回 None"""
+    if path.lower().endswith(".wav"):
+        try:
+            with wave.open(path, "rb") as source:
+                return source.getnframes() / float(source.getframerate())
+        except (wave.Error, EOFError, OSError):
+            return None
+    try:
+        output = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+                                capture_output=True, text=True, timeout=30).stdout.strip()
+        return float(output)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def split_audio(path: str, unit_seconds: float, out_dir: str) -> List[str]:
+    """把音频按时长切成等长的若干段（不重新编码）：WAV 按采样帧切分，其他格式用 ffmpeg 的 segment 复用器；返回各段路径"""
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    if ext == "wav":
+        paths = []
+        with wave.open(path, "rb") as source:
+            frames_per_unit = max(1, int(unit_seconds * source.getframerate()))
+            index = 0
+            while True:
+                frames = source.readframes(frames_per_unit)
+                if not frames:
+                    break
+                unit_path = os.path.join(out_dir, f"unit-{index:04d}.in.wav")
+                with wave.open(unit_path, "wb") as target:
+                    target.setparams(source.getparams())
+                    target.writeframes(frames)
+                paths.append(unit_path)
+                index += 1
+        return paths
+    pattern = os.path.join(out_dir, f"unit-%04d.in.{ext}")
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-nostdin", "-i", path, "-vn", "-c", "copy", "-f", "segment",
+         "-segment_time", f"{unit_seconds:.3f}", "-reset_timestamps", "1", pattern],
+        capture_output=True, timeout=600)
+    if result.returncode != 0:
+        raise RuntimeError(f"拆分音频失败: {result.stderr.decode('utf-8', 'replace').strip()[-300:]}")
+    return sorted(os.path.join(out_dir, name) for name in os.listdir(out_dir)
+                  if name.startswith("unit-") and name.endswith(f".in.{ext}"))
+
+
+class CheckpointJob:
+    """一个拆分后的任务。单元状态：pending（未扣费）→ charged（已扣费，结果未保存）→ done（结果已保存）；
+    扣费幂等键由任务、单元序号和尝试次数组成，尝试次数只在退款成功后加一，因此扣费后进程中断时重试会重放原扣费"""
+
+    def __init__(self, directory: str, manifest: Dict):
+        self.directory = directory
+        self.manifest = manifest
+
+    @property
+    def job_id(self) -> str:
+        return self.manifest["job_id"]
+
+    @property
+    def kind(self) -> str:
+        return self.manifest["kind"]
+
+    @property
+    def units(self) -> List[Dict]:
+        return self.manifest["units"]
+
+    def progress(self):
+        """返回 (已完成单元数, 总单元数)"""
+        return sum(1 for unit in self.units if unit["status"] == "done"), len(self.units)
+
+    def path(self, name: Optional[str]) -> Optional[str]:
+        return os.path.join(self.directory, name) if name else None
+
+    def save(self):
+        """原子地写入 manifest.json：先写临时文件再改名，中途崩溃不会留下半个文件"""
+        self.manifest["updated_at"] = time.time()
+        temp_path = os.path.join(self.directory, "manifest.json.tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(temp_path, os.path.join(self.directory, "manifest.json"))
+
+    def idempotency_key(self, unit: Dict) -> str:
+        return f"ckpt:{self.job_id}:{unit['index']}:{unit['attempt']}"
+
+    def run(self, send_unit: Callable[[Dict, Optional[str], str], None],
+            charge: Callable[[float, str], Dict], refund: Callable[[float, str], bool],
+            on_progress: Optional[Callable[[int, int], None]] = None) -> Dict:
+        """按顺序处理未完成的单元：扣费 → send_unit(单元, 输入文件, 输出文件) 写出结果 → 保存断点。
+        某个单元失败时退还该单元的费用并停止（已完成的单元保留），返回
+        {"success", "done", "total", "charged_cents", "error", "exception", "unit", "refunded", "charge_failed"}"""
+        result = {"success": False, "charged_cents": 0, "error": None, "exception": None, "unit": None,
+                  "refunded": None, "charge_failed": False}
+        for unit in self.units:
+            if unit["status"] == "done":
+                continue
+            if on_progress:
+                on_progress(*self.progress())
+            result["unit"] = unit["index"]
+            cost = cents_to_yuan(unit["cost_cents"])
+            if unit["status"] == "pending":
+                if unit["cost_cents"] > 0:
+                    charged = charge(cost, self.idempotency_key(unit) + ":charge")
+                    if not charged.get("success"):
+                        result["error"] = charged.get("error", "扣费失败")
+                        result["charge_failed"] = True
+                        break
+                unit["status"] = "charged"
+                self.manifest["charged_cents"] += unit["cost_cents"]
+                result["charged_cents"] += unit["cost_cents"]
+                self.save()
+
+            output_name = f"unit-{unit['index']:04d}.out.{self.manifest['output_ext']}"
+            temp_path = self.path(output_name) + ".part"
+            try:
+                send_unit(unit, self.path(unit.get("input")), temp_path)
+                os.replace(temp_path, self.path(output_name))
+            except Exception as e:
+                result["error"], result["exception"] = str(e), e
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                # 退款成功后该单元回到未扣费状态，下次使用新的幂等键重新扣费；退款失败则保持已扣费，下次不再扣费
+                result["refunded"] = unit["cost_cents"] == 0 or refund(cost, self.idempotency_key(unit) + ":refund")
+                if result["refunded"]:
+                    unit["status"] = "pending"
+                    unit["attempt"] += 1
+                    self.manifest["charged_cents"] -= unit["cost_cents"]
+                    result["charged_cents"] -= unit["cost_cents"]
+                self.save()
+                break
+            unit["status"] = "done"
+            unit["output"] = output_name
+            if unit.get("input") and self.kind == "stt":
+                # 转录完成的音频段不再需要
+                os.unlink(self.path(unit["input"]))
+                unit["input"] = None
+            self.save()
+        else:
+            result["success"] = True
+        result["done"], result["total"] = self.progress()
+        if on_progress:
+            on_progress(result["done"], result["total"])
+        return result
+
+    def assemble(self) -> str:
+        """合并各单元的结果，返回结果文件路径：转录结果按段换行拼接，MP3 直接首尾相接，WAV 合并采样帧"""
+        outputs = [self.path(unit["output"]) for unit in self.units]
+        ext = self.manifest["output_ext"]
+        result_path = self.path(f"result.{ext}")
+        if ext == "txt":
+            texts = []
+            for output in outputs:
+                with open(output, "r", encoding="utf-8") as f:
+                    texts.append(f.read().strip())
+            with open(result_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(text for text in texts if text))
+        elif ext == "wav":
+            with wave.open(result_path, "wb") as target:
+                for index, output in enumerate(outputs):
+                    with wave.open(output, "rb") as source:
+                        if index == 0:
+                            target.setparams(source.getparams())
+                        target.writeframes(source.readframes(source.getnframes()))
+        else:
+            with open(result_path, "wb") as target:
+                for output in outputs:
+                    with open(output, "rb") as source:
+                        shutil.copyfileobj(source, target)
+        return result_path
+
+    def delete(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class CheckpointStore:
+    """断点任务目录的创建、加载和过期清理；同一任务同一时间只允许一个会话处理"""
+
+    def __init__(self, root: str = JOB_CHECKPOINT_DIR, max_age: float = JOB_CHECKPOINT_MAX_AGE):
+        self.root = root
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._busy = set()
+        os.makedirs(root, exist_ok=True)
+        self.sweep()
+
+    @staticmethod
+    def job_id(kind: str, sub_key: str, params: Dict, content: bytes) -> str:
+        """任务标识：同一子密钥以相同参数提交相同内容时得到相同标识，据此找到已有的断点"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps([kind, sub_key, params], sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        digest.update(hashlib.sha256(content).digest())
+        return digest.hexdigest()[:32]
+
+    def _directory(self, job_id: str) -> str:
+        return os.path.join(self.root, job_id)
+
+    def load(self, job_id: str) -> Optional[CheckpointJob]:
+        """加载已有的断点，不存在、已损坏或已过期时返回 None"""
+        directory = self._directory(job_id)
+        try:
+            with open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("version") != MANIFEST_VERSION or time.time() - manifest.get("updated_at", 0) > self.max_age:
+            shutil.rmtree(directory, ignore_errors=True)
+            return None
+        return CheckpointJob(directory, manifest)
+
+    def stage(self, job_id: str, data: bytes, ext: str) -> str:
+        """把源音频写入任务目录，供探测时长和拆分使用"""
+        directory = self._directory(job_id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"source.{ext}")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def discard(self, job_id: str):
+        shutil.rmtree(self._directory(job_id), ignore_errors=True)
+
+    def _create(self, job_id: str, kind: str, params: Dict, output_ext: str, units: List[Dict],
+                weights: List[int], total_cents: int) -> CheckpointJob:
+        for unit, cents in zip(units, allocate_cents(total_cents, weights)):
+            unit.update(cost_cents=cents, status="pending", attempt=0, output=None)
+        now = time.time()
+        job = CheckpointJob(self._directory(job_id), {
+            "version": MANIFEST_VERSION, "job_id": job_id, "kind": kind, "params": params, "output_ext": output_ext,
+            "total_cents": total_cents, "charged_cents": 0, "created_at": now, "updated_at": now, "units": units})
+        os.makedirs(job.directory, exist_ok=True)
+        job.save()
+        self.sweep()
+        return job
+
+    def create_tts(self, job_id: str, text: str, params: Dict, total_cents: int,
+                   max_chars: int = TTS_UNIT_CHARS) -> Optional[CheckpointJob]:
+        """文本超过一个单元时建立断点，否则返回 None（按普通任务处理）"""
+        pieces = split_text(text, max_chars)
+        if len(pieces) <= 1:
+            return None
+        units = [{"index": index, "text": piece, "input": None} for index, piece in enumerate(pieces)]
+        return self._create(job_id, "tts", params, params["format"], units,
+                            [len(piece.encode("utf-8")) for piece in pieces], total_cents)
+
+    def create_stt(self, job_id: str, source_path: str, params: Dict, total_cents: int,
+                   unit_seconds: float = STT_UNIT_SECONDS) -> Optional[CheckpointJob]:
+        """音频长于一个单元时拆分并建立断点（各段等长），否则删除暂存的源文件并返回 None"""
+        duration = audio_duration(source_path)
+        if not duration or duration <= unit_seconds:
+            self.discard(job_id)
+            return None
+        directory = self._directory(job_id)
+        try:
+            paths = split_audio(source_path, duration / math.ceil(duration / unit_seconds), directory)
+        except (OSError, RuntimeError, subprocess.SubprocessError, wave.Error) as e:
+            print(f"拆分音频失败，按普通任务处理: {e}")
+            self.discard(job_id)
+            return None
+        os.unlink(source_path)
+        if len(paths) <= 1:
+            self.discard(job_id)
+            return None
+        units = [{"index": index, "input": os.path.basename(path)} for index, path in enumerate(paths)]
+        return self._create(job_id, "stt", params, "txt", units,
+                            [os.path.getsize(path) for path in paths], total_cents)
+
+    def acquire(self, job_id: str) -> bool:
+        """标记任务正在处理；已被其他会话占用时返回 False"""
+        with self._lock:
+            if job_id in self._busy:
+                return False
+            self._busy.add(job_id)
+            return True
+
+    def release(self, job_id: str):
+        with self._lock:
+            self._busy.discard(job_id)
+
+    def sweep(self) -> int:
+        """删除超过保留期未更新的任务目录"""
+        removed = 0
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.root):
+            directory = self._directory(name)
+            try:
+                if os.path.getmtime(directory) < cutoff and name not in self._busy:
+                    shutil.rmtree(directory, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
@@ -0,0 +1,132 @@
+# job_timing.py - TTS/STT 任务的分阶段计时，每个任务的耗时明细追加写入 JSONL 日志
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import tracing
+
+# 计时日志路径，可通过环境变量 JOB_TIMING_LOG 修改
+TIMING_LOG_FILE = os.environ.get("JOB_TIMING_LOG", os.path.join("logs", "job_timings.jsonl"))
+
+_log_lock = threading.Lock()
+
+
+class JobTimer:
+    """记录单个任务各阶段的单调时钟耗时；每个任务一个 trace_id，各阶段导出为子 span"""
+
+    def __init__(self, kind: str, log_file: Optional[str] = None, **attrs):
+        self.kind = kind
+        self.job_id = uuid.uuid4().hex
+        self.trace_id = tracing.new_trace_id()
+        self.root_span_id = tracing.new_span_id()
+        self.log_file = log_file or TIMING_LOG_FILE
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        self.stages: List[Dict] = []
+
+    @staticmethod
+    def now() -> float:
+        return time.perf_counter()
+
+    def traceparent(self, span_id: Optional[str] = None) -> str:
+        """出站请求使用的 traceparent 头，默认挂在任务根 span 下"""
+        return tracing.format_traceparent(self.trace_id, span_id or self.root_span_id)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """计时一个阶段：with timer.span("convert"): ...；期间发往密钥服务的请求会带上该阶段的 traceparent"""
+        span_id = tracing.new_span_id()
+        start = time.perf_counter()
+        try:
+            with tracing.activate(self.trace_id, span_id):
+                yield
+        finally:
+            self.add_stage(name, start, time.perf_counter(), span_id=span_id, **attrs)
+
+    def add_stage(self, name: str, start: float, end: float, span_id: Optional[str] = None, **attrs):
+        """按 perf_counter 时间点记录阶段（用于无法用 with 包住的阶段，如上传与服务端处理的拆分）"""
+        stage = {
+            "name": name,
+            "span_id": span_id or tracing.new_span_id(),
+            "start_ms": round((start - self._origin) * 1000, 3),
+            "duration_ms": round((end - start) * 1000, 3)
+        }
+        stage.update(attrs)
+        self.stages.append(stage)
+
+    def summary(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "trace_id": self.trace_id,
+            "kind": self.kind,
+            "started_at": self.started_at,
+            "total_ms": round((time.perf_counter() - self._origin) * 1000, 3),
+            "stages": list(self.stages),
+            **self.attrs
+        }
+
+    def finish(self, status: str, **attrs) -> Dict:
+        """结束计时，追加写入日志并导出 span，写日志失败不影响任务本身"""
+        self.attrs.update(attrs)
+        record = self.summary()
+        record["status"] = status
+        self._export_spans(record)
+        try:
+            directory = os.path.dirname(self.log_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            line = json.dumps(record, ensure_ascii=False)
+            with _log_lock:
+                with open(self.log_file, "a", encoding="utf-8") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"写入计时日志失败: {e}")
+        return record
+
+    def _export_spans(self, record: Dict):
+        service = "tts_or_stt"
+        error = record["status"] != "ok"
+        spans = [tracing.make_span(
+            f"{self.kind}_job", self.trace_id, self.root_span_id, None,
+            self.started_at, self.started_at + record["total_ms"] / 1000, service,
+            kind="INTERNAL", attributes={"job.id": self.job_id, "job.status": record["status"], **self.attrs},
+            error=error
+        )]
+        for stage in self.stages:
+            start = self.started_at + stage["start_ms"] / 1000
+            attributes = {k: v for k, v in stage.items() if k not in ("name", "span_id", "start_ms", "duration_ms")}
+            spans.append(tracing.make_span(
+                stage["name"], self.trace_id, stage["span_id"], self.root_span_id,
+                start, start + stage["duration_ms"] / 1000, service,
+                kind="CLIENT", attributes=attributes
+            ))
+        tracing.get_exporter().export(spans)
+
+
+def load_records(log_file: str) -> List[Dict]:
+    """读取计时日志，跳过损坏的行"""
+    records = []
+    with open(log_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """最近秩百分位数，sorted_values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
@@ -1,13 +1,49 @@
 # kms_api_server.py - 独立的密钥管理API服务器
+# 默认用带准入控制的线程池服务器（pooled_wsgi.py）运行，KMS_SERVER=dev 时使用 Flask 开发服务器
+# KMS_WORKERS 工作线程数，KMS_QUEUE_DEPTH 排队上限，KMS_QUEUE_TIMEOUT 排队超时（秒），KMS_READ_TIMEOUT 工作线程读写连接的超时（秒），
+# KMS_RETRY_AFTER 503 响应的 Retry-After（秒）
+# KMS_PROCESSES 工作进程数（默认 1）：大于 1 时多个进程共用同一端口，通过 keys.json.journal 和文件锁共享存储
+# KMS_SHARDS 子密钥存储分片数（默认 1）：按子密钥哈希拆成多个文件，各自加锁和保存，分片数变化需先离线运行 kms_shards.py
+# KMS_ROLE 主从复制中的角色：leader 主节点（接受写入，向副本提供日志），follower 只读副本（从 KMS_LEADER_URL 复制，
+# 用 KMS_REPLICATION_KEY 中的主密钥访问主节点，只处理查询，可在故障时提升为主节点）；默认不参与复制
 import uuid
 import time
 import hashlib
 import json
 import os
-from decimal import Decimal, ROUND_HALF_UP
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import atexit
+import itertools
+from collections import ChainMap, OrderedDict
+from contextlib import ExitStack, contextmanager
 from typing import Dict, Optional, List
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_cors import CORS
+from metrics import MetricsRegistry
+from billing import cents_to_yuan, yuan_to_cents
+import tracing
+from pooled_wsgi import PooledWSGIServer
+from kms_journal import FileLock, StateJournal
+from kms_replication import Replicator
+from kms_shards import ShardLayout, shard_index
+
+# 运行指标，通过 GET /metrics 导出
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter("kms_http_requests_total", "HTTP请求数", ("endpoint", "method", "status"))
+HTTP_LATENCY = metrics.histogram("kms_http_request_duration_seconds", "HTTP请求处理耗时", ("endpoint",))
+PERSIST_LATENCY = metrics.histogram("kms_persist_duration_seconds", "持久化写文件耗时", ("file",))
+PERSIST_BYTES = metrics.counter("kms_persist_bytes_total", "持久化写入字节数", ("file",))
+DEDUCTIONS = metrics.counter("kms_deductions_total", "成功扣款次数")
+DEDUCTED_CENTS = metrics.counter("kms_deducted_cents_total", "累计扣款金额（分）")
+DEDUCT_FAILURES = metrics.counter("kms_deduct_failures_total", "扣款失败次数", ("reason",))
+REFUNDS = metrics.counter("kms_refunds_total", "退款次数")
+REFUNDED_CENTS = metrics.counter("kms_refunded_cents_total", "累计退款金额（分）")
+IDEMPOTENT_REPLAYS = metrics.counter("kms_idempotent_replays_total", "幂等键重放次数")
+REPLICATION_DELAY = metrics.histogram("kms_replication_delay_seconds", "副本应用日志条目时距主节点提交的时间")
 
 class MasterKeyManager:
     def __init__(self, keys_file: str = "master_keys.json"):
@@ -65,150 +101,1003 @@ class MasterKeyManager:
             print(f"保存主密钥文件失败: {e}")
             return False
 
+class KeyRecord:
+    """子密钥记录，余额和已用金额以整数分存储，避免热路径上的Decimal转换"""
+    __slots__ = ("balance_cents", "used_cents", "created_time", "description", "is_active", "last_used", "version")
+
+    def __init__(self, balance_cents: int = 0, used_cents: int = 0, created_time: float = 0.0,
+                 description: str = "", is_active: bool = True, last_used: Optional[float] = None):
+        self.balance_cents = balance_cents
+        self.used_cents = used_cents
+        self.created_time = created_time
+        self.description = description
+        self.is_active = is_active
+        self.last_used = last_used
+        # 最后一次修改时的存储版本号，不写入 keys.json
+        self.version = 0
+
+    @classmethod
+    def from_dict(cls, info: Dict) -> "KeyRecord":
+        """从 keys.json 中的字典格式构建记录"""
+        return cls(
+            balance_cents=yuan_to_cents(info.get("balance", 0)),
+            used_cents=yuan_to_cents(info.get("used_amount", 0)),
+            created_time=info.get("created_time", 0.0),
+            description=info.get("description", ""),
+            is_active=info.get("is_active", True),
+            last_used=info.get("last_used")
+        )
+
+    def to_dict(self) -> Dict:
+        """转换为 keys.json / API 使用的字典格式"""
+        return {
+            "balance": cents_to_yuan(self.balance_cents),
+            "created_time": self.created_time,
+            "description": self.description,
+            "is_active": self.is_active,
+            "used_amount": cents_to_yuan(self.used_cents),
+            "last_used": self.last_used
+        }
+
+class CreditLease:
+    """预付额度租约：从子密钥余额中划出的一段额度，由前端本地扣费后批量结算。
+    关闭后保留为结算记录（closed_at 非零）直到 SETTLED_RETENTION 秒后清理，重放的结算请求返回首次的结算结果"""
+    __slots__ = ("lease_id", "sub_key", "granted_cents", "used_cents", "expires_at", "closed_at")
+
+    def __init__(self, lease_id: str, sub_key: str, granted_cents: int, used_cents: int = 0, expires_at: float = 0.0,
+                 closed_at: float = 0.0):
+        self.lease_id = lease_id
+        self.sub_key = sub_key
+        self.granted_cents = granted_cents
+        self.used_cents = used_cents
+        self.expires_at = expires_at
+        self.closed_at = closed_at
+
+    @classmethod
+    def from_dict(cls, info: Dict) -> "CreditLease":
+        return cls(info["lease_id"], info["sub_key"], info["granted_cents"], info["used_cents"], info["expires_at"],
+                   info.get("closed_at", 0.0))
+
+    def to_dict(self) -> Dict:
+        return {
+            "lease_id": self.lease_id,
+            "sub_key": self.sub_key,
+            "granted_cents": self.granted_cents,
+            "used_cents": self.used_cents,
+            "expires_at": self.expires_at,
+            "closed_at": self.closed_at
+        }
+
 class KeyManagementSystem:
-    def __init__(self, storage_file: str = "keys.json"):
+    # 删除记录（墓碑）最多保留的数量，超出后较旧的增量同步需要全量重新拉取
+    MAX_TOMBSTONES = 10000
+    # 单个租约的额度上限（分）和有效期上限（秒）
+    MAX_LEASE_CENTS = 5000
+    MAX_LEASE_TTL = 3600
+    # 已关闭租约的结算记录保留时间（秒），不短于租约有效期上限，客户端在此期间重试结算不会重复计费
+    SETTLED_RETENTION = 2 * MAX_LEASE_TTL
+
+    def __init__(self, storage_file: str = "keys.json", lease_file: str = "leases.json"):
         self.storage_file = storage_file
-        self.keys = self._load_keys()
+        self.lease_file = lease_file
+        self.lock = threading.RLock()
+        self.keys: Dict[str, KeyRecord] = self._load_keys()
+        self.leases: Dict[str, CreditLease] = self._load_leases()
+        # 存储版本号：每次修改单调递增；epoch 区分不同进程生命周期，重启后客户端需全量同步
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.deleted: Dict[str, int] = {}
+        self._tombstone_floor = 0
+        # 停机期间过期的租约，未用额度退回余额
+        self.expire_leases()
     
-    def _load_keys(self) -> Dict:
+    def _load_keys(self) -> Dict[str, KeyRecord]:
         try:
             if os.path.exists(self.storage_file):
                 with open(self.storage_file, 'r', encoding='utf-8') as f:
                     data = json.load(f)
-                    # 转换所有余额为Decimal类型
-                    for key_info in data.values():
-                        if isinstance(key_info.get("balance"), (int, float)):
-                            key_info["balance"] = float(self._round_decimal(Decimal(str(key_info["balance"]))))
-                    return data
+                    # 金额只在加载时转换一次为整数分
+                    return {key: KeyRecord.from_dict(info) for key, info in data.items()}
         except Exception as e:
             print(f"加载密钥文件失败: {e}")
         return {}
     
     def _save_keys(self):
         try:
-            with open(self.storage_file, 'w', encoding='utf-8') as f:
-                json.dump(self.keys, f, ensure_ascii=False, indent=2)
+            with PERSIST_LATENCY.time("keys"):
+                data = {key: record.to_dict() for key, record in self.keys.items()}
+                with open(self.storage_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                    PERSIST_BYTES.inc(f.tell(), "keys")
             return True
         except Exception as e:
             print(f"保存密钥文件失败: {e}")
             return False
     
-    def _generate_sub_key(self) -> str:
-        key_base = f"sk-{uuid.uuid4().hex}{int(time.time())}"
-        return hashlib.sha256(key_base.encode()).hexdigest()[:32]
+    def _load_leases(self) -> Dict[str, CreditLease]:
+        try:
+            if os.path.exists(self.lease_file):
+                with open(self.lease_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                    return {lease_id: CreditLease.from_dict(info) for lease_id, info in data.items()
+                            if info.get("sub_key") in self.keys}
+        except Exception as e:
+            print(f"加载租约文件失败: {e}")
+        return {}
     
-    def _round_decimal(self, value: Decimal) -> Decimal:
-        """四舍五入到小数点后两位"""
-        return value.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+    def _save_leases(self):
+        try:
+            with PERSIST_LATENCY.time("leases"):
+                data = {lease_id: lease.to_dict() for lease_id, lease in self.leases.items()}
+                with open(self.lease_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                    PERSIST_BYTES.inc(f.tell(), "leases")
+            return True
+        except Exception as e:
+            print(f"保存租约文件失败: {e}")
+            return False
     
-    def _to_decimal(self, value) -> Decimal:
-        """转换为Decimal并四舍五入"""
-        if isinstance(value, Decimal):
-            return self._round_decimal(value)
-        return self._round_decimal(Decimal(str(value)))
+    def transaction(self):
+        """读-改-写操作的临界区；单进程时就是线程锁，多进程共享存储时另加文件锁（见 SharedKeyManagementSystem）"""
+        return self.lock
     
-    def create_sub_key(self, balance: float = 100.00, description: str = "") -> Optional[str]:
-        sub_key = self._generate_sub_key()
-        
-        balance_decimal = self._to_decimal(balance)
-        
-        self.keys[sub_key] = {
-            "balance": float(balance_decimal),  # 存储为浮点数，但已经是精确的两位小数
-            "created_time": time.time(),
-            "description": description,
-            "is_active": True,
-            "used_amount": 0.0,
-            "last_used": None
+    def refresh(self):
+        """读取其他工作进程的修改（单进程时无需操作）"""
+    
+    def record_idempotent(self, idempotency_key: str, fingerprint: str, result: Dict, expires_at: float):
+        """幂等键的处理结果需要在工作进程间共享时由子类记录（单进程时无需操作）"""
+    
+    def _next_version(self) -> int:
+        """递增并返回存储版本号"""
+        self.version += 1
+        return self.version
+    
+    def _touch(self, sub_key: str):
+        """递增存储版本号并标记密钥的修改版本"""
+        self.keys[sub_key].version = self._next_version()
+        self.deleted.pop(sub_key, None)
+    
+    def shard_for(self, sub_key: str) -> "KeyManagementSystem":
+        """子密钥所在的存储（未分片时就是自身，见 ShardedKeyManagementSystem）"""
+        return self
+    
+    def etag(self, sub_key: Optional[str] = None) -> str:
+        """整个存储或单个密钥的 ETag"""
+        if sub_key is None:
+            return f"{self.epoch}-{self.version}"
+        record = self.keys.get(sub_key)
+        return f"{self.epoch}-{sub_key[:8]}-{record.version if record else 'none'}"
+    
+    def changes_since(self, since: int, epoch: Optional[str] = None) -> Dict:
+        """返回 since 版本之后修改和删除的密钥；epoch 不匹配或墓碑已丢弃时返回全量"""
+        # 持锁遍历，避免并发写入时字典在遍历中改变大小；版本号在遍历前读取
+        with self.transaction():
+            version = self.version
+            full = epoch != self.epoch or since < self._tombstone_floor
+            if full:
+                since = 0
+            leased = self._leased_by_key()
+            changed = {key: self._key_info(key, record, leased) for key, record in self.keys.items()
+                       if record.version > since}
+            deleted = [key for key, key_version in self.deleted.items() if key_version > since]
+        return {
+            "epoch": self.epoch,
+            "version": version,
+            "full": full,
+            "changed": changed,
+            "deleted": deleted
         }
-        
-        if self._save_keys():
-            return sub_key
-        return None
+    
+    def _leased_by_key(self) -> Dict[str, int]:
+        """各子密钥已租出但未用的额度（分），调用方持有存储锁"""
+        leased: Dict[str, int] = {}
+        for lease in self.leases.values():
+            if not lease.closed_at:
+                leased[lease.sub_key] = leased.get(lease.sub_key, 0) + lease.granted_cents - lease.used_cents
+        return leased
+    
+    def active_leases(self) -> int:
+        """未关闭的租约数量（不含保留的结算记录）"""
+        with self.lock:
+            return sum(1 for lease in self.leases.values() if not lease.closed_at)
+    
+    def _key_info(self, sub_key: str, record: KeyRecord, leased: Dict[str, int]) -> Dict:
+        """API 返回的密钥信息：keys.json 格式之外附上已租出未用的额度 leased（元）"""
+        info = record.to_dict()
+        info["leased"] = cents_to_yuan(leased.get(sub_key, 0))
+        return info
+    
+    def _generate_sub_key(self) -> str:
+        key_base = f"sk-{uuid.uuid4().hex}{int(time.time())}"
+        return hashlib.sha256(key_base.encode()).hexdigest()[:32]
+    
+    def create_sub_key(self, balance: float = 100.00, description: str = "", sub_key: Optional[str] = None) -> Optional[str]:
+        # 持锁插入并保存，避免并发创建时 _save_keys 遍历到正在变化的字典
+        with self.transaction():
+            sub_key = sub_key or self._generate_sub_key()
+            
+            self.keys[sub_key] = KeyRecord(
+                balance_cents=yuan_to_cents(balance),
+                created_time=time.time(),
+                description=description
+            )
+            self._touch(sub_key)
+            
+            if self._save_keys():
+                return sub_key
+            return None
     
     def update_balance(self, sub_key: str, new_balance: float) -> bool:
-        """更新子密钥余额"""
-        if sub_key not in self.keys:
-            return False
-        
-        new_balance_decimal = self._to_decimal(new_balance)
-        self.keys[sub_key]["balance"] = float(new_balance_decimal)
-        return self._save_keys()
+        """更新子密钥余额：new_balance 为包含已租出未用额度在内的总额，
+        租约结算时未用额度会退回余额，因此写入的可用余额要先扣除这部分（可能暂时为负）"""
+        with self.transaction():
+            record = self.keys.get(sub_key)
+            if record is None:
+                return False
+            
+            record.balance_cents = yuan_to_cents(new_balance) - self._leased_by_key().get(sub_key, 0)
+            self._touch(sub_key)
+            return self._save_keys()
     
     def deduct_balance(self, sub_key: str, amount: float) -> bool:
         """扣除余额（支持负数金额用于退款）"""
-        if sub_key not in self.keys:
-            return False
-        
-        if not self.keys[sub_key]["is_active"]:
-            return False
-        
-        current_balance = Decimal(str(self.keys[sub_key]["balance"]))
-        amount_decimal = self._to_decimal(amount)
-        
-        # 支持负数金额（退款）
-        if amount_decimal < 0:
-            new_balance = current_balance - amount_decimal  # 减去负数等于加
-            self.keys[sub_key]["used_amount"] = float(Decimal(str(self.keys[sub_key]["used_amount"])) + amount_decimal)
-        else:
-            # 正常扣款
-            if current_balance < amount_decimal:
+        return self.deduct_cents(sub_key, yuan_to_cents(amount))
+    
+    def deduct_cents(self, sub_key: str, amount_cents: int) -> bool:
+        """按整数分扣除余额（负数为退款）"""
+        with self.transaction():
+            record = self.keys.get(sub_key)
+            if record is None or not record.is_active:
                 return False
-            new_balance = current_balance - amount_decimal
-            self.keys[sub_key]["used_amount"] = float(Decimal(str(self.keys[sub_key]["used_amount"])) + amount_decimal)
-        
-        # 四舍五入并存储
-        self.keys[sub_key]["balance"] = float(self._round_decimal(new_balance))
-        self.keys[sub_key]["last_used"] = time.time()
-        return self._save_keys()
+            
+            # 正常扣款需要余额充足，退款直接加回
+            if amount_cents > 0 and record.balance_cents < amount_cents:
+                return False
+            
+            record.balance_cents -= amount_cents
+            record.used_cents += amount_cents
+            record.last_used = time.time()
+            self._touch(sub_key)
+            return self._save_keys()
+    
+    def acquire_lease(self, sub_key: str, amount_cents: int, ttl: float) -> Optional[CreditLease]:
+        """从余额中划出一段额度作为租约，额度不超过余额和 MAX_LEASE_CENTS"""
+        with self.transaction():
+            record = self.keys.get(sub_key)
+            if record is None or not record.is_active:
+                return None
+            
+            granted = min(amount_cents, self.MAX_LEASE_CENTS, record.balance_cents)
+            if granted <= 0:
+                return None
+            
+            ttl = max(1.0, min(ttl, self.MAX_LEASE_TTL))
+            lease = CreditLease(uuid.uuid4().hex, sub_key, granted, expires_at=time.time() + ttl)
+            record.balance_cents -= granted
+            self.leases[lease.lease_id] = lease
+            self._touch(sub_key)
+            self._save_keys()
+            self._save_leases()
+            return lease
+    
+    def reconcile_lease(self, lease_id: str, used_cents: int, release: bool = False,
+                        ttl: Optional[float] = None) -> Optional[Dict]:
+        """结算租约的累计用量；release 或已过期时将未用额度退回余额。
+        租约已关闭（已释放、过期回收或子密钥停用）时不再修改任何状态，返回结算时的用量并标记 settled，
+        超出结算用量的部分需要由调用方另行扣费"""
+        with self.transaction():
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return None
+            if lease.closed_at:
+                record = self.keys.get(lease.sub_key)
+                return {
+                    "used_cents": lease.used_cents,
+                    "returned_cents": lease.granted_cents - lease.used_cents,
+                    "closed": True,
+                    "settled": True,
+                    "expires_at": lease.expires_at,
+                    "balance_cents": record.balance_cents if record is not None else 0
+                }
+            
+            # 用量是累计值，重复上报不会重复扣费
+            used = max(lease.used_cents, min(used_cents, lease.granted_cents))
+            record = self.keys.get(lease.sub_key)
+            if record is None:
+                # 子密钥已删除，租约作废
+                self.leases.pop(lease_id, None)
+                self._save_leases()
+                return {
+                    "used_cents": lease.used_cents,
+                    "returned_cents": 0,
+                    "closed": True,
+                    "settled": False,
+                    "expires_at": lease.expires_at,
+                    "balance_cents": 0
+                }
+            if used > lease.used_cents:
+                record.used_cents += used - lease.used_cents
+                record.last_used = time.time()
+                lease.used_cents = used
+            
+            # 子密钥已停用时不再续期，租约直接关闭并退回未用额度
+            if not release and record.is_active and ttl is not None:
+                lease.expires_at = time.time() + max(1.0, min(ttl, self.MAX_LEASE_TTL))
+            
+            returned = 0
+            closed = release or not record.is_active or lease.expires_at <= time.time()
+            if closed:
+                returned = self._close_lease(lease)
+            self._touch(lease.sub_key)
+            self._save_keys()
+            self._save_leases()
+            return {
+                "used_cents": lease.used_cents,
+                "returned_cents": returned,
+                "closed": closed,
+                "settled": False,
+                "expires_at": lease.expires_at,
+                "balance_cents": record.balance_cents
+            }
+    
+    def _close_lease(self, lease: CreditLease) -> int:
+        """关闭租约并退回未用额度，返回退回的分数；租约保留为结算记录"""
+        returned = lease.granted_cents - lease.used_cents
+        record = self.keys.get(lease.sub_key)
+        if record is not None:
+            record.balance_cents += returned
+            self._touch(lease.sub_key)
+        lease.closed_at = time.time()
+        return returned
+    
+    def expire_leases(self) -> int:
+        """回收所有已过期的租约并清理超过保留时间的结算记录，返回回收的数量"""
+        with self.transaction():
+            now = time.time()
+            expired = [lease for lease in self.leases.values() if not lease.closed_at and lease.expires_at <= now]
+            for lease in expired:
+                self._close_lease(lease)
+            stale = [lease_id for lease_id, lease in self.leases.items()
+                     if lease.closed_at and lease.closed_at + self.SETTLED_RETENTION <= now]
+            for lease_id in stale:
+                del self.leases[lease_id]
+            if expired:
+                self._save_keys()
+            if expired or stale:
+                self._save_leases()
+            return len(expired)
     
     def get_balance(self, sub_key: str) -> Optional[float]:
-        if sub_key in self.keys and self.keys[sub_key]["is_active"]:
-            # 返回时确保是两位小数
-            balance = self.keys[sub_key]["balance"]
-            return float(self._round_decimal(Decimal(str(balance))))
+        cents = self.get_balance_cents(sub_key)
+        return cents_to_yuan(cents) if cents is not None else None
+    
+    def get_balance_cents(self, sub_key: str) -> Optional[int]:
+        record = self.keys.get(sub_key)
+        if record is not None and record.is_active:
+            return record.balance_cents
         return None
     
     def validate_key(self, sub_key: str) -> bool:
-        return (sub_key in self.keys and 
-                self.keys[sub_key]["is_active"] and 
-                self.keys[sub_key]["balance"] > 0)
+        record = self.keys.get(sub_key)
+        return record is not None and record.is_active and record.balance_cents > 0
     
     def list_keys(self) -> Dict:
-        # 确保返回的余额都是精确到两位小数
-        result = {}
-        for key, info in self.keys.items():
-            result[key] = info.copy()
-            result[key]["balance"] = float(self._round_decimal(Decimal(str(info["balance"]))))
-        return result
+        with self.transaction():
+            leased = self._leased_by_key()
+            return {key: self._key_info(key, record, leased) for key, record in self.keys.items()}
     
     def deactivate_key(self, sub_key: str) -> bool:
         """停用子密钥"""
-        if sub_key in self.keys:
-            self.keys[sub_key]["is_active"] = False
-            return self._save_keys()
-        return False
+        with self.transaction():
+            if sub_key in self.keys:
+                self.keys[sub_key].is_active = False
+                self._touch(sub_key)
+                return self._save_keys()
+            return False
     
     def activate_key(self, sub_key: str) -> bool:
         """激活子密钥"""
-        if sub_key in self.keys:
-            self.keys[sub_key]["is_active"] = True
-            return self._save_keys()
-        return False
+        with self.transaction():
+            if sub_key in self.keys:
+                self.keys[sub_key].is_active = True
+                self._touch(sub_key)
+                return self._save_keys()
+            return False
     
     def delete_key(self, sub_key: str) -> bool:
-        """删除子密钥"""
-        if sub_key in self.keys:
-            del self.keys[sub_key]
-            return self._save_keys()
-        return False
+        """删除子密钥（同时作废其租约）"""
+        with self.transaction():
+            if sub_key in self.keys:
+                del self.keys[sub_key]
+                self.deleted[sub_key] = self._next_version()
+                if len(self.deleted) > self.MAX_TOMBSTONES:
+                    oldest = min(self.deleted, key=self.deleted.get)
+                    self._tombstone_floor = self.deleted.pop(oldest)
+                lease_ids = [lease_id for lease_id, lease in self.leases.items() if lease.sub_key == sub_key]
+                for lease_id in lease_ids:
+                    del self.leases[lease_id]
+                if lease_ids:
+                    self._save_leases()
+                return self._save_keys()
+            return False
+
+class IdempotencyCache:
+    """幂等键去重表：有界且按时间过期，同一幂等键的重放返回首次的处理结果"""
+    def __init__(self, max_entries: int = 100000, ttl: float = 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # 调用方持有存储锁；分片存储中各分片的锁不同，过期清理和淘汰另需互斥
+        self._lock = threading.Lock()
+    
+    def lookup(self, key: str, fingerprint: str):
+        """返回 (是否命中, 结果)；同一幂等键用于不同请求时返回错误结果"""
+        now = time.time()
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest[0] > now:
+                    break
+                self._entries.popitem(last=False)
+            entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[1] != fingerprint:
+            return True, {"success": False, "error": "幂等键已用于其他请求"}
+        result = dict(entry[2])
+        result["replayed"] = True
+        return True, result
+    
+    def store(self, key: str, fingerprint: str, result: Dict, expires_at: Optional[float] = None) -> float:
+        """记录处理结果，返回过期时间；从其他工作进程同步来的结果沿用原过期时间"""
+        expires_at = expires_at if expires_at is not None else time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (expires_at, fingerprint, result)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return expires_at
+    
+    def items(self) -> List:
+        """未过期的 [幂等键, 指纹, 结果, 过期时间] 列表"""
+        now = time.time()
+        with self._lock:
+            return [[key, fingerprint, result, expires_at]
+                    for key, (expires_at, fingerprint, result) in self._entries.items() if expires_at > now]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SharedKeyManagementSystem(KeyManagementSystem):
+    """供同一主机上多个工作进程共享的存储（KMS_PROCESSES > 1）。
+    keys.json / leases.json 是快照，之后的每次修改作为一个条目追加到 keys.json.journal（修改后的完整记录，
+    而不是操作本身），所有读-改-写都在 keys.json.lock 文件锁内先读完其他进程追加的条目再执行，
+    因此扣费、租约和幂等键在进程之间是串行一致的；只读请求在处理前读取新条目，能看到请求开始前已完成的全部修改。
+    日志条目超过 JOURNAL_MAX_BYTES 时由当时的写入方压缩：原子地写出新快照并换成只含头部的新日志（epoch 随之变化）"""
+    JOURNAL_MAX_BYTES = int(os.environ.get("KMS_JOURNAL_MAX_BYTES", str(64 * 1024 * 1024)))
+
+    def __init__(self, storage_file: str = "keys.json", lease_file: str = "leases.json",
+                 idempotency: Optional[IdempotencyCache] = None, fsync: bool = False, read_only: bool = False):
+        # 只读副本（KMS_ROLE=follower）：内容全部来自主节点的日志，本地不产生任何修改
+        self.read_only = read_only
+        self.idempotency = idempotency if idempotency is not None else IdempotencyCache()
+        self.journal = StateJournal(storage_file + ".journal", fsync=fsync)
+        self.file_lock = FileLock(storage_file + ".lock")
+        self._depth = 0
+        self._dirty_keys = set()
+        self._dirty_deleted = set()
+        self._leases_dirty = False
+        self._lease_images: Dict[str, Dict] = {}
+        self._pending_idempotent: List = []
+        # 本进程追加日志后唤醒等待中的复制长轮询（其他工作进程追加的条目靠定时检查发现）
+        self._appended = threading.Condition()
+        # 父类初始化末尾的 expire_leases() 会进入第一个事务，在文件锁内加载快照和日志
+        super().__init__(storage_file, lease_file)
+        if read_only and self.journal.exists():
+            # 副本重启：从本地的快照和日志恢复，之后从日志末尾继续复制
+            self.refresh()
+    
+    def _load_keys(self) -> Dict[str, KeyRecord]:
+        return {}
+    
+    def _load_leases(self) -> Dict[str, CreditLease]:
+        return {}
+    
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            outer = self._depth == 0
+            if outer:
+                self.file_lock.acquire()
+            self._depth += 1
+            try:
+                if outer:
+                    self._catch_up()
+                yield
+                if outer:
+                    self._commit()
+            except BaseException:
+                if outer:
+                    # 内存中可能留有未写入日志的修改，丢弃后下次从快照和日志重新加载
+                    self._discard_changes()
+                raise
+            finally:
+                self._depth -= 1
+                if outer:
+                    self.file_lock.release()
+    
+    def refresh(self):
+        with self.lock:
+            if self._depth:
+                return
+            reset, _, entries = self.journal.read_new()
+            if reset:
+                # 日志已被压缩，需要在文件锁内重新加载快照（避免读到正在写的快照）；
+                # read_new 已经切换到新日志，先作废读取位置，事务开始时才会按 reset 从快照重新加载
+                self.journal.invalidate()
+                with self.transaction():
+                    pass
+                return
+            for entry in entries:
+                self._apply(entry)
+    
+    def record_idempotent(self, idempotency_key: str, fingerprint: str, result: Dict, expires_at: float):
+        self._pending_idempotent.append([idempotency_key, fingerprint, result, expires_at])
+    
+    def expire_leases(self) -> int:
+        # 副本上的租约由主节点回收，回收结果随日志复制过来
+        if self.read_only:
+            return 0
+        return super().expire_leases()
+    
+    # ---------------------- 修改跟踪 ----------------------
+    def _touch(self, sub_key: str):
+        super()._touch(sub_key)
+        self._dirty_keys.add(sub_key)
+    
+    def _save_keys(self):
+        # 修改在事务结束时统一追加到日志
+        return True
+    
+    def _save_leases(self):
+        self._leases_dirty = True
+        return True
+    
+    def delete_key(self, sub_key: str) -> bool:
+        with self.transaction():
+            deleted = super().delete_key(sub_key)
+            if deleted:
+                self._dirty_deleted.add(sub_key)
+            return deleted
+    
+    # ---------------------- 日志 ----------------------
+    def _catch_up(self):
+        if not self.journal.exists():
+            # 首次以共享模式启动：现有的 keys.json / leases.json 作为快照
+            self._load_snapshot({"epoch": StateJournal.new_epoch(), "base": 0, "idempotency": []})
+            self.journal.create(self._snapshot_header())
+            return
+        reset, header, entries = self.journal.read_new()
+        if reset:
+            self._load_snapshot(header)
+        for entry in entries:
+            self._apply(entry)
+    
+    def _load_snapshot(self, header: Dict):
+        self.keys = KeyManagementSystem._load_keys(self)
+        self.leases = KeyManagementSystem._load_leases(self)
+        self._lease_images = {lease_id: lease.to_dict() for lease_id, lease in self.leases.items()}
+        self.epoch = header["epoch"]
+        self.version = header["base"]
+        self.deleted = {}
+        self._tombstone_floor = header["base"]
+        self.idempotency.clear()
+        for key, fingerprint, result, expires_at in header.get("idempotency", []):
+            self.idempotency.store(key, fingerprint, result, expires_at)
+    
+    def _apply(self, entry: Dict):
+        """应用一个日志条目（其他进程的修改）"""
+        for sub_key, (info, version) in entry.get("keys", {}).items():
+            fresh = KeyRecord.from_dict(info)
+            record = self.keys.get(sub_key)
+            if record is None:
+                self.keys[sub_key] = record = fresh
+            else:
+                # 原地更新，请求处理中已取得的记录引用仍然有效
+                for field in KeyRecord.__slots__:
+                    setattr(record, field, getattr(fresh, field))
+            record.version = version
+            self.deleted.pop(sub_key, None)
+        for sub_key, version in entry.get("deleted", {}).items():
+            self.keys.pop(sub_key, None)
+            self.deleted[sub_key] = version
+        while len(self.deleted) > self.MAX_TOMBSTONES:
+            oldest = min(self.deleted, key=self.deleted.get)
+            self._tombstone_floor = self.deleted.pop(oldest)
+        for lease_id, info in entry.get("leases", {}).items():
+            self.leases[lease_id] = CreditLease.from_dict(info)
+            self._lease_images[lease_id] = info
+        for lease_id in entry.get("leases_removed", []):
+            self.leases.pop(lease_id, None)
+            self._lease_images.pop(lease_id, None)
+        for key, fingerprint, result, expires_at in entry.get("idempotency", []):
+            self.idempotency.store(key, fingerprint, result, expires_at)
+        self.version = entry["version"]
+    
+    def _commit(self):
+        """把本次事务的修改作为一个条目追加到日志"""
+        if not (self._dirty_keys or self._dirty_deleted or self._leases_dirty or self._pending_idempotent):
+            return
+        if self.read_only:
+            raise RuntimeError("只读副本不能修改存储")
+        # time 为提交时间，副本据此统计复制延迟
+        entry = {"version": self.version, "time": time.time()}
+        if self._dirty_keys:
+            entry["keys"] = {sub_key: [self.keys[sub_key].to_dict(), self.keys[sub_key].version]
+                             for sub_key in self._dirty_keys if sub_key in self.keys}
+        if self._dirty_deleted:
+            entry["deleted"] = {sub_key: self.deleted[sub_key] for sub_key in self._dirty_deleted if sub_key in self.deleted}
+        if self._leases_dirty:
+            current = {lease_id: lease.to_dict() for lease_id, lease in self.leases.items()}
+            entry["leases"] = {lease_id: info for lease_id, info in current.items() if self._lease_images.get(lease_id) != info}
+            entry["leases_removed"] = [lease_id for lease_id in self._lease_images if lease_id not in current]
+            self._lease_images = current
+        if self._pending_idempotent:
+            entry["idempotency"] = self._pending_idempotent
+        self._reset_changes()
+        with PERSIST_LATENCY.time("journal"):
+            PERSIST_BYTES.inc(self.journal.append(entry), "journal")
+        with self._appended:
+            self._appended.notify_all()
+        if self.journal.entries_size() > self.JOURNAL_MAX_BYTES:
+            self._compact()
+    
+    def _snapshot_header(self) -> Dict:
+        return {"epoch": self.epoch, "base": self.version, "idempotency": self.idempotency.items()}
+    
+    def _compact(self):
+        """原子地写出新快照，再换成只含头部的新日志；epoch 变化，客户端的增量同步会转为全量"""
+        for path, data in ((self.storage_file, {key: record.to_dict() for key, record in self.keys.items()}),
+                           (self.lease_file, {lease_id: lease.to_dict() for lease_id, lease in self.leases.items()})):
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, path)
+        self.epoch = StateJournal.new_epoch()
+        for record in self.keys.values():
+            record.version = 0
+        self.deleted = {}
+        self._tombstone_floor = self.version
+        self.journal.create(self._snapshot_header())
+        print(f"状态日志已压缩: 版本 {self.version}，{len(self.keys)} 个子密钥")
+    
+    # ---------------------- 复制 ----------------------
+    def replication_snapshot(self) -> Dict:
+        """主节点：当前快照文件和日志头部的原始内容（在文件锁内读取，三者对应同一时刻）；
+        副本写入后再从日志头部之后开始拉取条目"""
+        with self.transaction():
+            contents = {}
+            for name, path in (("keys", self.storage_file), ("leases", self.lease_file)):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        contents[name] = f.read()
+                except FileNotFoundError:
+                    contents[name] = "{}"
+            with open(self.journal.path, "rb") as f:
+                contents["header"] = f.readline().decode("utf-8")
+            return contents
+    
+    def replication_log(self, epoch: str, offset: int, wait: float = 0.0) -> Optional[Dict]:
+        """主节点：返回日志 offset 之后的条目；暂无新条目时最多等待 wait 秒（长轮询）。
+        日志已被压缩或 offset 无效时返回 None"""
+        deadline = time.monotonic() + wait
+        while True:
+            chunk = self.journal.read_raw(epoch, offset)
+            if chunk is None:
+                return None
+            data, size = chunk
+            remaining = deadline - time.monotonic()
+            if data or remaining <= 0:
+                return {"epoch": epoch, "offset": offset, "next_offset": offset + len(data), "size": size,
+                        "data": data.decode("utf-8")}
+            with self._appended:
+                self._appended.wait(min(remaining, 0.02))
+    
+    def replication_position(self) -> Optional[Dict]:
+        """副本：已复制到的 epoch 和日志位置（尚无日志时为 None）"""
+        with self.lock:
+            if self.journal.header is None:
+                return None
+            return {"epoch": self.journal.header["epoch"], "offset": self.journal.offset}
+    
+    def install_snapshot(self, header_text: str, keys_text: str, leases_text: str):
+        """副本：用主节点的快照替换本地存储，之后的条目从头部之后开始复制"""
+        header_line = header_text.encode("utf-8")
+        header = json.loads(header_line)
+        with self.lock, self.file_lock:
+            for path, text in ((self.storage_file, keys_text), (self.lease_file, leases_text)):
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(temp_path, path)
+            self.journal.create(header, header_line)
+            self._load_snapshot(header)
+    
+    def mirror(self, offset: int, data: bytes) -> Optional[List[Dict]]:
+        """副本：把主节点日志 offset 处开始的原始条目追加到本地日志并应用，返回应用的条目；
+        本地位置与 offset 不一致时返回 None，需要重新拉取快照"""
+        with self.lock, self.file_lock:
+            if self.journal.header is None or self.journal.offset != offset:
+                return None
+            entries = [json.loads(line) for line in data.splitlines() if line.strip()]
+            self.journal.append_raw(data)
+            for entry in entries:
+                self._apply(entry)
+            return entries
+    
+    def promote(self):
+        """副本提升为主节点：开始接受写入，并立即压缩换成新的 epoch，
+        其他副本改为跟随本节点时会按新 epoch 重新拉取快照，不会混入旧主节点之后的日志"""
+        with self.transaction():
+            self.read_only = False
+            self._compact()
+    
+    def _reset_changes(self):
+        self._dirty_keys = set()
+        self._dirty_deleted = set()
+        self._leases_dirty = False
+        self._pending_idempotent = []
+    
+    def _discard_changes(self):
+        self._reset_changes()
+        self.journal.invalidate()
+
+class KeyShard(KeyManagementSystem):
+    """分片存储中的一个分片：自己的文件和锁，版本号取自所有分片共用的计数器，各分片的修改版本可以统一比较"""
+    def __init__(self, storage_file: str, lease_file: str, versions):
+        self._versions = versions
+        super().__init__(storage_file, lease_file)
+    
+    def _next_version(self) -> int:
+        self.version = next(self._versions)
+        return self.version
+
+class ShardedKeyManagementSystem:
+    """按子密钥哈希分成 count 个分片（KMS_SHARDS > 1）的存储，接口与 KeyManagementSystem 相同。
+    每个分片有自己的 keys/leases 文件和锁，扣费只重写所在分片的文件，不同分片的请求互不等待；
+    按子密钥的操作只访问所在分片，列表和增量同步合并全部分片。分片数变化需离线运行 kms_shards.py"""
+    def __init__(self, storage_file: str = "keys.json", lease_file: str = "leases.json", count: int = 1):
+        self.layout = ShardLayout(storage_file, lease_file)
+        self.count = count
+        self.epoch = uuid.uuid4().hex[:8]
+        # itertools.count 的 next() 在 CPython 中是原子的，各分片持自己的锁也能取到不重复的版本号
+        versions = itertools.count(1)
+        self.shards = [KeyShard(key_path, lease_path, versions) for key_path, lease_path in self.layout.paths(count)]
+        for shard in self.shards:
+            shard.epoch = self.epoch
+        self.layout.write_manifest(count)
+    
+    def shard_for(self, sub_key: str) -> KeyShard:
+        return self.shards[shard_index(sub_key, self.count)]
+    
+    @property
+    def keys(self):
+        """全部分片的只读合并视图（按子密钥的读写请用 shard_for）"""
+        return ChainMap(*[shard.keys for shard in self.shards])
+    
+    @property
+    def leases(self):
+        return ChainMap(*[shard.leases for shard in self.shards])
+    
+    @property
+    def version(self) -> int:
+        return max(shard.version for shard in self.shards)
+    
+    @contextmanager
+    def transaction(self):
+        """整个存储的临界区：按固定顺序获取全部分片的锁"""
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.transaction())
+            yield
+    
+    def refresh(self):
+        pass
+    
+    def record_idempotent(self, idempotency_key: str, fingerprint: str, result: Dict, expires_at: float):
+        pass
+    
+    def etag(self, sub_key: Optional[str] = None) -> str:
+        if sub_key is None:
+            return f"{self.epoch}-{self.version}"
+        return self.shard_for(sub_key).etag(sub_key)
+    
+    def changes_since(self, since: int, epoch: Optional[str] = None) -> Dict:
+        version = self.version
+        full = epoch != self.epoch or since < max(shard._tombstone_floor for shard in self.shards)
+        if full:
+            since = 0
+        changed, deleted = {}, []
+        for shard in self.shards:
+            with shard.transaction():
+                leased = shard._leased_by_key()
+                changed.update((key, shard._key_info(key, record, leased)) for key, record in shard.keys.items()
+                               if record.version > since)
+                deleted.extend(key for key, key_version in shard.deleted.items() if key_version > since)
+        return {"epoch": self.epoch, "version": version, "full": full, "changed": changed, "deleted": deleted}
+    
+    def create_sub_key(self, balance: float = 100.00, description: str = "") -> Optional[str]:
+        sub_key = self.shards[0]._generate_sub_key()
+        return self.shard_for(sub_key).create_sub_key(balance, description, sub_key)
+    
+    def update_balance(self, sub_key: str, new_balance: float) -> bool:
+        return self.shard_for(sub_key).update_balance(sub_key, new_balance)
+    
+    def deduct_balance(self, sub_key: str, amount: float) -> bool:
+        return self.shard_for(sub_key).deduct_balance(sub_key, amount)
+    
+    def deduct_cents(self, sub_key: str, amount_cents: int) -> bool:
+        return self.shard_for(sub_key).deduct_cents(sub_key, amount_cents)
+    
+    def acquire_lease(self, sub_key: str, amount_cents: int, ttl: float) -> Optional[CreditLease]:
+        return self.shard_for(sub_key).acquire_lease(sub_key, amount_cents, ttl)
+    
+    def reconcile_lease(self, lease_id: str, used_cents: int, release: bool = False,
+                        ttl: Optional[float] = None) -> Optional[Dict]:
+        # 租约号不含子密钥，逐个分片查找（字典查找，开销可以忽略）
+        for shard in self.shards:
+            if lease_id in shard.leases:
+                return shard.reconcile_lease(lease_id, used_cents, release, ttl)
+        return None
+    
+    def expire_leases(self) -> int:
+        return sum(shard.expire_leases() for shard in self.shards)
+    
+    def active_leases(self) -> int:
+        return sum(shard.active_leases() for shard in self.shards)
+    
+    def get_balance(self, sub_key: str) -> Optional[float]:
+        return self.shard_for(sub_key).get_balance(sub_key)
+    
+    def get_balance_cents(self, sub_key: str) -> Optional[int]:
+        return self.shard_for(sub_key).get_balance_cents(sub_key)
+    
+    def validate_key(self, sub_key: str) -> bool:
+        return self.shard_for(sub_key).validate_key(sub_key)
+    
+    def list_keys(self) -> Dict:
+        keys = {}
+        for shard in self.shards:
+            keys.update(shard.list_keys())
+        return keys
+    
+    def deactivate_key(self, sub_key: str) -> bool:
+        return self.shard_for(sub_key).deactivate_key(sub_key)
+    
+    def activate_key(self, sub_key: str) -> bool:
+        return self.shard_for(sub_key).activate_key(sub_key)
+    
+    def delete_key(self, sub_key: str) -> bool:
+        return self.shard_for(sub_key).delete_key(sub_key)
+
+def create_store(storage_file: str = "keys.json", lease_file: str = "leases.json",
+                 idempotency: Optional[IdempotencyCache] = None, role: str = ""):
+    """KMS_PROCESSES > 1、参与主从复制（日志就是复制流），或目录中已有共享模式留下的日志时使用共享存储
+    （否则日志中的修改会丢失）；KMS_SHARDS > 1 或目录中已是分片布局时使用分片存储"""
+    layout = ShardLayout(storage_file, lease_file)
+    current_shards = layout.read_count()
+    shards = int(os.environ.get("KMS_SHARDS", str(current_shards)))
+    shared = role or int(os.environ.get("KMS_PROCESSES", "1")) > 1 or os.path.exists(storage_file + ".journal")
+    if shards > 1 or current_shards > 1:
+        if shared:
+            raise ValueError("分片存储（KMS_SHARDS）暂不能与多进程（KMS_PROCESSES）或主从复制（KMS_ROLE）同时使用")
+        if shards != current_shards and layout.has_data(current_shards):
+            raise ValueError(f"现有数据为 {current_shards} 个分片，请先停止服务并运行 python kms_shards.py --shards {shards}")
+        return ShardedKeyManagementSystem(storage_file, lease_file, shards)
+    if shared:
+        return SharedKeyManagementSystem(storage_file, lease_file, idempotency,
+                                         fsync=os.environ.get("KMS_JOURNAL_FSYNC") == "1",
+                                         read_only=role == "follower")
+    return KeyManagementSystem(storage_file, lease_file)
 
 # 初始化主密钥管理器和密钥管理系统
 master_key_manager = MasterKeyManager()
-kms = KeyManagementSystem()
+idempotency_cache = IdempotencyCache()
+KMS_ROLE = os.environ.get("KMS_ROLE", "").strip().lower()
+kms = create_store(idempotency=idempotency_cache, role=KMS_ROLE)
+# 只读副本的复制器（在 __main__ 中启动）；副本超过 REPLICATION_MAX_LAG 秒未与主节点通信时不再回答查询
+REPLICATION_MAX_LAG = float(os.environ.get("KMS_REPLICATION_MAX_LAG", "10"))
+replicator: Optional[Replicator] = None
+if KMS_ROLE == "follower":
+    replicator = Replicator(kms, os.environ.get("KMS_LEADER_URL", "http://localhost:8503"),
+                            os.environ.get("KMS_REPLICATION_KEY", ""), delay_histogram=REPLICATION_DELAY)
+# 线程池服务器实例（KMS_SERVER=dev 或被其他模块导入时为 None）
+server: Optional[PooledWSGIServer] = None
 
 # 创建Flask应用
 app = Flask(__name__)
-CORS(app)  # 允许跨域请求
+CORS(app, expose_headers=["ETag"])  # 允许跨域请求
+
+metrics.gauge("kms_sub_keys", "子密钥数量", lambda: len(kms.keys))
+metrics.gauge("kms_active_leases", "未结算的租约数量", lambda: kms.active_leases())
+metrics.gauge("kms_store_version", "存储版本号", lambda: kms.version)
+metrics.gauge("kms_replication_lag_bytes", "副本落后主节点的日志字节数",
+              lambda: (replicator.stats["lag_bytes"] or 0) if replicator and kms_read_only() else 0)
+
+# 只读副本上拒绝的写操作，以及需要副本已同步才能回答的查询
+WRITE_ENDPOINTS = {"api_validate_and_deduct", "api_create_key", "api_update_balance", "api_delete_key",
+                   "api_acquire_lease", "api_reconcile_lease"}
+REPLICA_READ_ENDPOINTS = {"api_get_balance", "api_list_keys", "api_changes"}
+
+def kms_read_only() -> bool:
+    return getattr(kms, "read_only", False)
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # 带 traceparent 的请求记录为对应链路的服务端 span
+    g.trace = tracing.parse_traceparent(request.headers.get("traceparent"))
+    # 多进程共享存储时先读取其他工作进程的修改
+    kms.refresh()
+    if kms_read_only():
+        if request.endpoint in WRITE_ENDPOINTS:
+            return jsonify({"success": False, "error": "只读副本不接受写操作，请发往主节点",
+                            "leader": replicator.leader_url if replicator else None})
+        if request.endpoint in REPLICA_READ_ENDPOINTS and not (replicator and replicator.synced_within(REPLICATION_MAX_LAG)):
+            # 尚未同步或与主节点失联过久，503 让客户端改读主节点
+            response = jsonify({"success": False, "error": "副本未同步"})
+            response.status_code = 503
+            response.headers["Retry-After"] = "1"
+            return response
+
+@app.after_request
+def record_request_metrics(response):
+    # 按路由模板而非实际路径聚合，避免标签基数膨胀
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    duration = time.perf_counter() - g.request_start
+    HTTP_LATENCY.observe(duration, endpoint)
+    HTTP_REQUESTS.inc(1, endpoint, request.method, response.status_code)
+    if g.trace:
+        record_server_span(endpoint, duration, response.status_code)
+    return response
+
+def record_server_span(endpoint: str, duration: float, status_code: int):
+    trace_id, parent_span_id = g.trace
+    span_id = tracing.new_span_id()
+    end_time = time.time()
+    print(f"[trace={trace_id} span={span_id} parent={parent_span_id}] "
+          f"{request.method} {endpoint} {status_code} {duration * 1000:.2f}ms")
+    tracing.get_exporter().export([tracing.make_span(
+        f"{request.method} {endpoint}", trace_id, span_id, parent_span_id,
+        end_time - duration, end_time, "kms_api_server", kind="SERVER",
+        attributes={"http.method": request.method, "http.route": endpoint, "http.status_code": status_code},
+        error=status_code >= 500
+    )])
+
+def conditional_json(etag: str, build):
+    """支持 If-None-Match 的JSON响应：ETag 未变化时返回 304，不再构建响应体"""
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    return response
+
+def run_idempotent(idempotency_key: Optional[str], fingerprint: str, execute, store=None) -> Dict:
+    """执行带幂等键的写操作：检查、执行、记录在同一把锁内完成，客户端超时重试不会重复扣费；
+    store 为子密钥所在的分片（kms.shard_for），只锁该分片"""
+    if not idempotency_key:
+        return execute()
+    store = store or kms
+    with store.transaction():
+        found, result = idempotency_cache.lookup(idempotency_key, fingerprint)
+        if found:
+            IDEMPOTENT_REPLAYS.inc()
+            return result
+        result = execute()
+        store.record_idempotent(idempotency_key, fingerprint, result,
+                                idempotency_cache.store(idempotency_key, fingerprint, result))
+        return result
 
 @app.route('/api/validate_and_deduct', methods=['POST'])
 def api_validate_and_deduct():
@@ -224,28 +1113,42 @@ def api_validate_and_deduct():
         if not sub_key:
             return jsonify({"success": False, "error": "缺少子密钥"})
         
-        # 检查密钥是否存在和是否活跃
-        if sub_key not in kms.keys or not kms.keys[sub_key]["is_active"]:
-            return jsonify({"success": False, "error": "密钥无效"})
-        
-        # 使用Decimal进行精确比较
-        current_balance = Decimal(str(kms.keys[sub_key]["balance"]))
-        amount_decimal = Decimal(str(amount)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
-        
-        # 如果是扣款（正数），检查余额是否足够
-        if amount_decimal > 0 and current_balance < amount_decimal:
-            return jsonify({"success": False, "error": "余额不足"})
-        
-        # 执行扣款或退款
-        if kms.deduct_balance(sub_key, float(amount_decimal)):
-            new_balance = kms.get_balance(sub_key)
-            return jsonify({
-                "success": True, 
-                "new_balance": new_balance,
-                "action": "refund" if amount_decimal < 0 else "deduct"
-            })
-        else:
-            return jsonify({"success": False, "error": "操作失败"})
+        # 金额只在API边界转换一次为整数分
+        amount_cents = yuan_to_cents(amount)
+        shard = kms.shard_for(sub_key)
+        
+        def execute():
+            # 检查和扣款在同一事务内完成（带幂等键时 run_idempotent 已持有该事务，事务可重入），
+            # 与并发删除等操作竞争失败时返回具体原因
+            with shard.transaction():
+                # 检查密钥是否存在和是否活跃
+                record = shard.keys.get(sub_key)
+                if record is None or not record.is_active:
+                    DEDUCT_FAILURES.inc(1, "invalid_key")
+                    return {"success": False, "error": "密钥无效"}
+                
+                # 如果是扣款（正数），检查余额是否足够
+                if amount_cents > 0 and record.balance_cents < amount_cents:
+                    DEDUCT_FAILURES.inc(1, "insufficient_balance")
+                    return {"success": False, "error": "余额不足"}
+                
+                # 执行扣款或退款
+                if shard.deduct_cents(sub_key, amount_cents):
+                    if amount_cents < 0:
+                        REFUNDS.inc()
+                        REFUNDED_CENTS.inc(-amount_cents)
+                    else:
+                        DEDUCTIONS.inc()
+                        DEDUCTED_CENTS.inc(amount_cents)
+                    return {
+                        "success": True, 
+                        "new_balance": cents_to_yuan(record.balance_cents),
+                        "action": "refund" if amount_cents < 0 else "deduct"
+                    }
+                DEDUCT_FAILURES.inc(1, "persist_failed")
+                return {"success": False, "error": "操作失败"}
+        
+        return jsonify(run_idempotent(data.get('idempotency_key'), f"deduct:{sub_key}:{amount_cents}", execute, shard))
             
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
@@ -265,7 +1168,7 @@ def api_get_balance():
         
         balance = kms.get_balance(sub_key)
         if balance is not None:
-            return jsonify({"success": True, "balance": balance})
+            return conditional_json(kms.etag(sub_key), lambda: {"success": True, "balance": balance})
         else:
             return jsonify({"success": False, "error": "密钥不存在或已停用"})
             
@@ -288,11 +1191,11 @@ def api_create_key():
             return jsonify({"success": False, "error": "主密钥验证失败"})
         
         # 确保余额是两位小数
-        balance_decimal = Decimal(str(balance)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        balance_cents = yuan_to_cents(balance)
         
-        sub_key = kms.create_sub_key(float(balance_decimal), description)
+        sub_key = kms.create_sub_key(cents_to_yuan(balance_cents), description)
         if sub_key:
-            return jsonify({"success": True, "sub_key": sub_key, "balance": float(balance_decimal)})
+            return jsonify({"success": True, "sub_key": sub_key, "balance": cents_to_yuan(balance_cents)})
         else:
             return jsonify({"success": False, "error": "密钥创建失败"})
             
@@ -312,8 +1215,43 @@ def api_list_keys():
         if not master_key_manager.validate_master_key(master_key):
             return jsonify({"success": False, "error": "主密钥验证失败"})
         
-        keys = kms.list_keys()
-        return jsonify({"success": True, "keys": keys})
+        def build():
+            # 版本号在遍历前读取：遍历期间的写入版本更高，客户端下次增量同步时仍会拉取
+            version = kms.version
+            return {
+                "success": True,
+                "keys": kms.list_keys(),
+                "epoch": kms.epoch,
+                "version": version
+            }
+        
+        return conditional_json(kms.etag(), build)
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+@app.route('/api/changes', methods=['POST'])
+def api_changes():
+    """增量同步：返回 since 版本之后修改/删除的密钥"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"success": False, "error": "缺少请求数据"})
+        
+        master_key = data.get('master_key')
+        
+        if not master_key_manager.validate_master_key(master_key):
+            return jsonify({"success": False, "error": "主密钥验证失败"})
+        
+        try:
+            since = int(request.args.get('since', data.get('since', 0)))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "since 参数无效"})
+        epoch = request.args.get('epoch', data.get('epoch'))
+        
+        result = kms.changes_since(since, epoch)
+        result["success"] = True
+        return jsonify(result)
             
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
@@ -337,10 +1275,10 @@ def api_update_balance():
             return jsonify({"success": False, "error": "缺少必要参数"})
         
         # 确保新余额是两位小数
-        new_balance_decimal = Decimal(str(new_balance)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        new_balance_cents = yuan_to_cents(new_balance)
         
-        if kms.update_balance(sub_key, float(new_balance_decimal)):
-            return jsonify({"success": True, "new_balance": float(new_balance_decimal)})
+        if kms.update_balance(sub_key, cents_to_yuan(new_balance_cents)):
+            return jsonify({"success": True, "new_balance": cents_to_yuan(new_balance_cents)})
         else:
             return jsonify({"success": False, "error": "更新失败"})
             
@@ -372,6 +1310,178 @@ def api_delete_key():
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
 
+@app.route('/api/leases/acquire', methods=['POST'])
+def api_acquire_lease():
+    """申请预付额度租约，前端在额度内本地扣费"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"success": False, "error": "缺少请求数据"})
+        
+        sub_key = data.get('sub_key')
+        amount_cents = yuan_to_cents(data.get('amount', 1.0))
+        ttl = float(data.get('ttl', 300))
+        
+        if not sub_key:
+            return jsonify({"success": False, "error": "缺少子密钥"})
+        
+        shard = kms.shard_for(sub_key)
+        
+        def execute():
+            record = shard.keys.get(sub_key)
+            if record is None or not record.is_active:
+                return {"success": False, "error": "密钥无效"}
+            
+            lease = shard.acquire_lease(sub_key, amount_cents, ttl)
+            if lease is None:
+                return {"success": False, "error": "余额不足"}
+            
+            return {
+                "success": True,
+                "lease_id": lease.lease_id,
+                "granted": cents_to_yuan(lease.granted_cents),
+                "expires_at": lease.expires_at,
+                "new_balance": cents_to_yuan(record.balance_cents)
+            }
+        
+        result = run_idempotent(data.get('idempotency_key'), f"lease:{sub_key}:{amount_cents}", execute, shard)
+        if result.get("success"):
+            # 重放时按原到期时间重新计算剩余有效期
+            result["ttl"] = result["expires_at"] - time.time()
+        return jsonify(result)
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+@app.route('/api/leases/reconcile', methods=['POST'])
+def api_reconcile_lease():
+    """结算租约累计用量，可选续期或释放"""
+    try:
+        data = request.json
+        if not data:
+            return jsonify({"success": False, "error": "缺少请求数据"})
+        
+        lease_id = data.get('lease_id')
+        if not lease_id:
+            return jsonify({"success": False, "error": "缺少租约ID"})
+        
+        ttl = data.get('ttl')
+        result = kms.reconcile_lease(
+            lease_id,
+            yuan_to_cents(data.get('used', 0)),
+            release=bool(data.get('release', False)),
+            ttl=float(ttl) if ttl is not None else None
+        )
+        if result is None:
+            return jsonify({"success": False, "error": "租约不存在或已过期"})
+        
+        # settled 为 True 表示租约此前已经结算（重放的释放请求或已过期回收），本次未做任何修改，
+        # used 是结算时记录的用量；客户端只需为超出这部分的用量另行扣费
+        return jsonify({
+            "success": True,
+            "used": cents_to_yuan(result["used_cents"]),
+            "returned": cents_to_yuan(result["returned_cents"]),
+            "closed": result["closed"],
+            "settled": result["settled"],
+            "expires_at": result["expires_at"],
+            "new_balance": cents_to_yuan(result["balance_cents"])
+        })
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+# 主从复制API
+def replication_request():
+    """校验复制请求，返回 (请求数据, 错误响应)"""
+    data = request.json
+    if not data:
+        return None, jsonify({"success": False, "error": "缺少请求数据"})
+    if not master_key_manager.validate_master_key(data.get('master_key')):
+        return None, jsonify({"success": False, "error": "主密钥验证失败"})
+    if not isinstance(kms, SharedKeyManagementSystem):
+        return None, jsonify({"success": False, "error": "未启用复制（需以 KMS_ROLE=leader 启动）"})
+    return data, None
+
+@app.route('/api/replication/snapshot', methods=['POST'])
+def api_replication_snapshot():
+    """副本拉取快照：keys.json、leases.json 和日志头部的原始内容"""
+    try:
+        data, error = replication_request()
+        if error:
+            return error
+        return jsonify(dict(kms.replication_snapshot(), success=True))
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+@app.route('/api/replication/log', methods=['POST'])
+def api_replication_log():
+    """副本拉取日志条目（长轮询，wait 最多 10 秒）；日志已被压缩时返回 reset，副本需要重新拉取快照"""
+    try:
+        data, error = replication_request()
+        if error:
+            return error
+        
+        try:
+            offset = int(data.get('offset', 0))
+            wait = min(max(float(data.get('wait', 0)), 0.0), 10.0)
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "offset 或 wait 参数无效"})
+        
+        result = kms.replication_log(str(data.get('epoch')), offset, wait)
+        if result is None:
+            return jsonify({"success": True, "reset": True})
+        result["success"] = True
+        return jsonify(result)
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+@app.route('/api/replication/promote', methods=['POST'])
+def api_replication_promote():
+    """把本副本提升为主节点（旧主节点故障时）"""
+    try:
+        data, error = replication_request()
+        if error:
+            return error
+        if not kms_read_only():
+            return jsonify({"success": False, "error": "本节点已是主节点"})
+        
+        if replicator:
+            replicator.stop()
+        kms.promote()
+        print(f"已提升为主节点: epoch {kms.epoch}，版本 {kms.version}，{len(kms.keys)} 个子密钥")
+        return jsonify({"success": True, "epoch": kms.epoch, "version": kms.version})
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
+@app.route('/api/replication/follow', methods=['POST'])
+def api_replication_follow():
+    """改为跟随 leader 指定的主节点（故障切换后其余副本改跟新主节点，或旧主节点恢复后降为副本）。
+    本节点尚未复制出去的修改会被新主节点的快照覆盖"""
+    global replicator
+    try:
+        data, error = replication_request()
+        if error:
+            return error
+        
+        leader = (data.get('leader') or '').rstrip('/')
+        if not leader:
+            return jsonify({"success": False, "error": "缺少主节点地址"})
+        if int(os.environ.get("KMS_PROCESSES", "1")) > 1:
+            return jsonify({"success": False, "error": "多进程节点不能在线切换角色，请以 KMS_ROLE=follower 重启"})
+        
+        with kms.transaction():
+            kms.read_only = True
+        if replicator is None:
+            replicator = Replicator(kms, leader, data['master_key'], delay_histogram=REPLICATION_DELAY)
+        replicator.follow(leader)
+        return jsonify({"success": True, "leader": leader})
+            
+    except Exception as e:
+        return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
+
 # 主密钥管理API
 @app.route('/api/master_keys/list', methods=['POST'])
 def api_list_master_keys():
@@ -395,6 +1505,11 @@ def api_list_master_keys():
     except Exception as e:
         return jsonify({"success": False, "error": f"服务器错误: {str(e)}"})
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式的运行指标"""
+    return app.response_class(metrics.render(), mimetype=None, content_type=MetricsRegistry.CONTENT_TYPE)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查"""
@@ -403,23 +1518,150 @@ def health_check():
         "service": "Key Management API",
         "timestamp": time.time(),
         "total_keys": len(kms.keys),
-        "master_keys_count": len(master_key_manager.master_keys)
+        "store_version": kms.version,
+        "active_leases": kms.active_leases(),
+        "master_keys_count": len(master_key_manager.master_keys),
+        "pid": os.getpid(),
+        "shards": getattr(kms, "count", 1),
+        "admission": server.stats() if server else None,
+        "role": "follower" if kms_read_only() else ("leader" if KMS_ROLE else "standalone"),
+        "replication": replicator.status() if replicator and kms_read_only() else None
     })
 
+@app.route('/ready', methods=['GET'])
+def readiness_check():
+    """就绪检查：排队接近上限或刚拒绝过请求时返回 503，负载均衡应暂时把流量转给其他实例"""
+    ready = server.ready() if server else True
+    # 副本在同步之前或与主节点失联过久时不就绪
+    if kms_read_only() and not (replicator and replicator.synced_within(REPLICATION_MAX_LAG)):
+        ready = False
+    response = jsonify({"ready": ready, "admission": server.stats() if server else None})
+    if not ready:
+        response.status_code = 503
+        response.headers["Retry-After"] = str(server.retry_after if server else 1)
+    return response
+
+class WorkerSupervisor:
+    """多进程模式的父进程：用同一个监听套接字启动 count 个子工作进程，子进程退出时自动重启，父进程退出时一并结束"""
+    def __init__(self, listen_socket: socket.socket, count: int):
+        self.listen_socket = listen_socket
+        self.count = count
+        self.children: Dict[int, subprocess.Popen] = {}
+        self.stopping = False
+    
+    def _spawn(self, index: int):
+        fd = self.listen_socket.fileno()
+        env = dict(os.environ, KMS_LISTEN_FD=str(fd), KMS_WORKER_INDEX=str(index))
+        self.children[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, pass_fds=(fd,))
+    
+    def start(self):
+        for index in range(1, self.count + 1):
+            self._spawn(index)
+        atexit.register(self.stop)
+        threading.Thread(target=self._watch, daemon=True).start()
+    
+    def _watch(self):
+        while not self.stopping:
+            time.sleep(1)
+            for index, child in list(self.children.items()):
+                if child.poll() is not None and not self.stopping:
+                    print(f"工作进程 {index}（pid {child.pid}）已退出（{child.returncode}），重新启动")
+                    self._spawn(index)
+    
+    def stop(self):
+        self.stopping = True
+        for child in self.children.values():
+            if child.poll() is None:
+                child.terminate()
+        for child in self.children.values():
+            try:
+                child.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+
+def exit_with_parent():
+    """子工作进程在父进程退出后自行退出，不留下孤儿进程"""
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(1)
+    os._exit(0)
+
 if __name__ == '__main__':
-    print("=" * 50)
-    print("密钥管理API服务器启动")
-    print("=" * 50)
-    print("地址: http://localhost:8503")
-    print(f"主密钥池: {len(master_key_manager.master_keys)} 个密钥")
-    print("API端点:")
-    print("  - POST /api/validate_and_deduct - 验证并扣除余额")
-    print("  - POST /api/get_balance - 查询余额")
-    print("  - POST /api/create_key - 创建新密钥")
-    print("  - POST /api/list_keys - 列出所有密钥")
-    print("  - POST /api/update_balance - 更新余额")
-    print("  - POST /api/delete_key - 删除密钥")
-    print("  - POST /api/master_keys/list - 列出主密钥数量")
-    print("  - GET  /health - 健康检查")
-    print("=" * 50)
-    app.run(host='0.0.0.0', port=8503, debug=False)
\ No newline at end of file
+    port = int(os.environ.get("KMS_PORT", "8503"))
+    processes = int(os.environ.get("KMS_PROCESSES", "1"))
+    if KMS_ROLE == "follower" and processes > 1:
+        # 复制和提升都在单个进程内完成；读吞吐通过增加副本扩展
+        print("只读副本按单进程运行（忽略 KMS_PROCESSES）")
+        processes = 1
+        os.environ["KMS_PROCESSES"] = "1"
+    is_child = bool(os.environ.get("KMS_LISTEN_FD"))
+    listen_socket = None
+    if is_child:
+        # 由父进程启动的工作进程：直接使用继承的监听套接字
+        listen_socket = socket.socket(fileno=int(os.environ["KMS_LISTEN_FD"]))
+        threading.Thread(target=exit_with_parent, daemon=True).start()
+        print(f"工作进程 {os.environ.get('KMS_WORKER_INDEX')} 已启动（pid {os.getpid()}）")
+    else:
+        print("=" * 50)
+        print("密钥管理API服务器启动")
+        print("=" * 50)
+        print(f"地址: http://localhost:{port}")
+        print(f"主密钥池: {len(master_key_manager.master_keys)} 个密钥")
+        if isinstance(kms, ShardedKeyManagementSystem):
+            print(f"存储分片: {kms.count} 个（{kms.layout.manifest_path}）")
+        print("API端点:")
+        print("  - POST /api/validate_and_deduct - 验证并扣除余额")
+        print("  - POST /api/get_balance - 查询余额")
+        print("  - POST /api/create_key - 创建新密钥")
+        print("  - POST /api/list_keys - 列出所有密钥")
+        print("  - POST /api/changes?since=<version> - 增量同步密钥变更")
+        print("  - POST /api/update_balance - 更新余额")
+        print("  - POST /api/delete_key - 删除密钥")
+        print("  - POST /api/leases/acquire - 申请预付额度租约")
+        print("  - POST /api/leases/reconcile - 结算/释放租约")
+        print("  - POST /api/master_keys/list - 列出主密钥数量")
+        print("  - POST /api/replication/snapshot|log - 副本拉取快照/日志")
+        print("  - POST /api/replication/promote|follow - 提升为主节点/改为跟随其他主节点")
+        print("  - GET  /metrics - 运行指标（Prometheus 格式）")
+        print("  - GET  /health - 健康检查")
+        print("  - GET  /ready - 就绪检查（饱和时返回 503）")
+        print("=" * 50)
+        if processes > 1 and (os.name == "nt" or os.environ.get("KMS_SERVER", "pool") == "dev"):
+            print("多进程模式需要 Linux/macOS 且 KMS_SERVER=pool，按单进程运行（仍使用共享存储）")
+        elif processes > 1:
+            listen_socket = socket.create_server(('0.0.0.0', port), backlog=1024)
+            listen_socket.set_inheritable(True)
+            # 收到 SIGTERM 时正常退出，由 atexit 结束子进程
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+            WorkerSupervisor(listen_socket, processes - 1).start()
+            print(f"工作进程: {processes} 个（共享 {kms.journal.path}）")
+        if KMS_ROLE == "follower":
+            print(f"只读副本，主节点: {replicator.leader_url}")
+            replicator.start()
+        elif KMS_ROLE == "leader":
+            print(f"主节点，复制日志: {kms.journal.path}")
+    
+    # 定期回收过期租约
+    def lease_sweeper():
+        while True:
+            time.sleep(30)
+            kms.expire_leases()
+    threading.Thread(target=lease_sweeper, daemon=True).start()
+    
+    if os.environ.get("KMS_SERVER", "pool") == "dev":
+        app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
+    else:
+        server = PooledWSGIServer(
+            ('0.0.0.0', port), app,
+            workers=int(os.environ.get("KMS_WORKERS", "8")),
+            queue_depth=int(os.environ.get("KMS_QUEUE_DEPTH", "64")),
+            queue_timeout=float(os.environ.get("KMS_QUEUE_TIMEOUT", "1")),
+            retry_after=int(os.environ.get("KMS_RETRY_AFTER", "1")),
+            registry=metrics, metric_prefix="kms_admission",
+            listen_socket=listen_socket,
+            read_timeout=float(os.environ.get("KMS_READ_TIMEOUT", "5"))
+        )
+        if not is_child:
+            print(f"工作线程: {server.workers} | 排队上限: {server.queue_depth} | 排队超时: {server.queue_timeout}s | "
+                  f"读写超时: {server.read_timeout}s")
+        server.serve_forever()
\ No newline at end of file
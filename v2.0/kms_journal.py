@@ -0,0 +1,189 @@
+# kms_journal.py - 跨进程文件锁和追加式状态日志，供多个密钥服务工作进程共享同一份存储
+# 日志文件首行为头部（epoch、起始版本号和快照时的附加状态），之后每行一个 JSON 条目；
+# 写入方持有文件锁追加，读取方从上次读到的位置继续读取，只处理以换行结尾的完整条目
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """基于锁文件的跨进程互斥锁（POSIX 用 flock，Windows 用 msvcrt.locking）；
+    同一进程内的多个线程需要另外用线程锁互斥"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.name == "nt":
+                while True:
+                    try:
+                        # LK_LOCK 最多等待约 10 秒后抛出 OSError，继续等待
+                        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.01)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        try:
+            if os.name == "nt":
+                os.lseek(fd, 0, os.SEEK_SET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class StateJournal:
+    """追加式状态日志。read_new() 返回上次读取之后新增的条目；日志被压缩（整体替换为新文件）后
+    头部的 epoch 会变化，此时返回 reset=True 和新日志中的全部条目，调用方需要先从快照重新加载"""
+
+    def __init__(self, path: str, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self.header: Optional[Dict] = None
+        # 已处理到的字节位置（总是某个完整条目的末尾）和当时文件的 (inode, 大小, 修改时间)
+        self.offset = 0
+        self.header_size = 0
+        self._stat: Optional[Tuple] = None
+
+    @staticmethod
+    def new_epoch() -> str:
+        return uuid.uuid4().hex[:8]
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def entries_size(self) -> int:
+        """头部之后各条目的总字节数（头部带有幂等键表，本身可能很大，不计入压缩阈值）"""
+        return max(self.size() - self.header_size, 0)
+
+    def create(self, header: Dict, line: Optional[bytes] = None):
+        """写入只含头部的新日志并原子替换旧日志（调用方持有文件锁）；
+        line 为复制来的原始头部行，使副本的日志与主节点逐字节相同"""
+        if line is None:
+            line = (json.dumps(header, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self.header = header
+        self.offset = self.header_size = len(line)
+        self._stat = self._current_stat()
+
+    def _current_stat(self) -> Optional[Tuple]:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def read_new(self) -> Tuple[bool, Optional[Dict], List[Dict]]:
+        """返回 (是否需要从快照重新加载, 头部, 新条目)；文件未变化时不打开文件"""
+        current = self._current_stat()
+        if current is None:
+            return False, self.header, []
+        if current == self._stat:
+            return False, self.header, []
+        with open(self.path, "rb") as f:
+            header_line = f.readline()
+            if not header_line.endswith(b"\n"):
+                # 头部尚未写完（不会发生：新日志都是先写临时文件再替换）
+                return False, self.header, []
+            header = json.loads(header_line)
+            reset = self.header is None or header.get("epoch") != self.header.get("epoch")
+            if reset:
+                self.offset = self.header_size = len(header_line)
+            f.seek(self.offset)
+            data = f.read()
+        entries = []
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line.strip():
+                entries.append(json.loads(line))
+        self.header = header
+        self.offset += end
+        # 末尾有未写完的条目时不记录文件状态，下次仍然重新读取
+        self._stat = current if end == len(data) else None
+        return reset, header, entries
+
+    def invalidate(self):
+        """下次 read_new 时从头重新读取（返回 reset=True）"""
+        self.header = None
+        self._stat = None
+
+    def append(self, entry: Dict) -> int:
+        """追加一个条目（调用方持有文件锁且已通过 read_new 读到末尾），返回写入的字节数"""
+        return self.append_raw((json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8"))
+
+    def append_raw(self, data: bytes) -> int:
+        """追加以换行结尾的若干条目（复制时为主节点日志的原始字节）；之前的写入方崩溃留下的半行会先被截断"""
+        with open(self.path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != self.offset:
+                f.truncate(self.offset)
+                f.seek(self.offset)
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.offset += len(data)
+        self._stat = self._current_stat()
+        return len(data)
+
+    def read_raw(self, epoch: str, offset: int, limit: int = 4 * 1024 * 1024) -> Optional[Tuple[bytes, int]]:
+        """读取 offset 之后最多约 limit 字节的完整条目，返回 (原始字节, 当前文件大小)，供副本复制；
+        日志已被压缩（epoch 不同）或 offset 不在日志范围内时返回 None，副本需要重新拉取快照。
+        不需要文件锁：压缩是整体替换文件，打开后读到的总是同一个文件"""
+        try:
+            f = open(self.path, "rb")
+        except OSError:
+            return None
+        with f:
+            header_line = f.readline()
+            if not header_line.endswith(b"\n") or json.loads(header_line).get("epoch") != epoch:
+                return None
+            size = os.fstat(f.fileno()).st_size
+            if offset < len(header_line) or offset > size:
+                return None
+            f.seek(offset)
+            data = f.read(limit)
+            if len(data) == limit and b"\n" not in data:
+                # 单个条目超过 limit 时读完整行
+                data += f.readline()
+        return data[:data.rfind(b"\n") + 1], size
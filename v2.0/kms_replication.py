@@ -0,0 +1,130 @@
+# kms_replication.py - 密钥服务的主从复制（副本端）：从主节点拉取快照，再长轮询主节点的状态日志（keys.json.journal），
+# 把新条目原样追加到本地日志并应用，本地日志与主节点逐字节相同，副本可以直接提升为主节点
+# 主节点的日志被压缩（epoch 变化）或本地位置对不上时重新拉取快照
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+
+class Replicator:
+    """后台线程跟随 leader_url 复制 store（SharedKeyManagementSystem，read_only=True）。
+    master_key 用于访问主节点的复制端点；poll_wait 为每次长轮询在主节点上的最长等待（秒）"""
+
+    def __init__(self, store, leader_url: str, master_key: str, poll_wait: float = 5.0, timeout: float = 10.0,
+                 delay_histogram=None):
+        self.store = store
+        self.leader_url = leader_url.rstrip("/")
+        self.master_key = master_key
+        self.poll_wait = poll_wait
+        self.timeout = timeout
+        self.delay_histogram = delay_histogram
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        # 切换主节点时递增，丢弃仍在进行的、来自旧主节点的响应
+        self._generation = 0
+        self._session = requests.Session()
+        self.stats = {"snapshots": 0, "entries": 0, "bytes": 0, "errors": 0, "lag_bytes": None,
+                      "last_contact": None, "last_error": None}
+
+    # ---------------------- 控制 ----------------------
+    def start(self):
+        # 每个复制线程有自己的停止标志，停止后仍在长轮询中的旧线程不会因为重新启动而继续运行
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop,), name="kms-replicator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """停止复制（提升为主节点前调用）；正在进行的长轮询返回后不再应用"""
+        with self._lock:
+            self._generation += 1
+        self._stop.set()
+
+    def follow(self, leader_url: str):
+        """改为跟随另一个主节点（故障切换后）；新主节点的 epoch 不同，会先重新拉取快照"""
+        with self._lock:
+            self._generation += 1
+            self.leader_url = leader_url.rstrip("/")
+        if not self.running:
+            self.start()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def synced_within(self, max_age: float) -> bool:
+        """已有数据且 max_age 秒内与主节点通信成功"""
+        last_contact = self.stats["last_contact"]
+        return (self.store.replication_position() is not None and last_contact is not None
+                and time.time() - last_contact <= max_age)
+
+    def status(self) -> Dict:
+        position = self.store.replication_position()
+        last_contact = self.stats["last_contact"]
+        return dict(self.stats, leader=self.leader_url, running=self.running,
+                    epoch=position["epoch"] if position else None,
+                    offset=position["offset"] if position else None,
+                    last_contact_age=round(time.time() - last_contact, 3) if last_contact else None)
+
+    # ---------------------- 复制循环 ----------------------
+    def _run(self, stop: threading.Event):
+        backoff = 0.5
+        while not stop.is_set():
+            with self._lock:
+                generation, leader_url = self._generation, self.leader_url
+            try:
+                position = self.store.replication_position()
+                if position is None or not self._poll(leader_url, generation, position):
+                    self._fetch_snapshot(leader_url, generation)
+                backoff = 0.5
+            except (requests.RequestException, ValueError, KeyError) as e:
+                self.stats["errors"] += 1
+                if self.stats["last_error"] != str(e):
+                    print(f"复制 {leader_url} 失败: {e}")
+                self.stats["last_error"] = str(e)
+                stop.wait(backoff)
+                backoff = min(backoff * 2, 5.0)
+
+    def _call(self, leader_url: str, endpoint: str, payload: Dict, timeout: float) -> Dict:
+        response = self._session.post(f"{leader_url}/api/replication/{endpoint}",
+                                      json=dict(payload, master_key=self.master_key), timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+        if not result.get("success"):
+            raise ValueError(result.get("error", "主节点拒绝复制请求"))
+        self.stats["last_contact"] = time.time()
+        self.stats["last_error"] = None
+        return result
+
+    def _poll(self, leader_url: str, generation: int, position: Dict) -> bool:
+        """拉取并应用一批条目；需要重新拉取快照时返回 False"""
+        result = self._call(leader_url, "log", {"epoch": position["epoch"], "offset": position["offset"],
+                                                "wait": self.poll_wait}, self.poll_wait + self.timeout)
+        if result.get("reset"):
+            return False
+        with self._lock:
+            if generation != self._generation:
+                return True
+            data = result["data"].encode("utf-8")
+            entries = self.store.mirror(result["offset"], data) if data else []
+            if entries is None:
+                return False
+        now = time.time()
+        for entry in entries:
+            if self.delay_histogram is not None and "time" in entry:
+                self.delay_histogram.observe(max(now - entry["time"], 0.0))
+        self.stats["entries"] += len(entries)
+        self.stats["bytes"] += len(data)
+        self.stats["lag_bytes"] = result["size"] - result["next_offset"]
+        return True
+
+    def _fetch_snapshot(self, leader_url: str, generation: int):
+        result = self._call(leader_url, "snapshot", {}, self.timeout)
+        with self._lock:
+            if generation != self._generation:
+                return
+            self.store.install_snapshot(result["header"], result["keys"], result["leases"])
+        self.stats["snapshots"] += 1
+        print(f"已从 {leader_url} 载入快照: {len(self.store.keys)} 个子密钥")
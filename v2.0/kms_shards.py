@@ -0,0 +1,124 @@
+# kms_shards.py - 子密钥存储分片的文件布局，同时是离线重新分片工具
+# 按子密钥的 crc32 把 keys.json / leases.json 拆成 N 个文件（keys-000-of-008.json …），分片数记录在 keys.shards.json；
+# 只有一个分片时就是原来的 keys.json / leases.json（没有 keys.shards.json）
+# 用法（先停止密钥服务）: python kms_shards.py --shards 8 [--dir .]      分成 8 片（--shards 1 合并回单个文件）
+#                          python kms_shards.py --status [--dir .]         查看当前分片数和各分片的子密钥数
+# 新布局的文件名带有分片数，与旧布局不会重名：先写完全部新文件，再原子地替换 keys.shards.json（切换点），最后删除旧文件，
+# 中途中断时旧布局仍然完整
+import argparse
+import json
+import os
+import sys
+import zlib
+from typing import Dict, List, Tuple
+
+
+def shard_index(sub_key: str, count: int) -> int:
+    """子密钥所在的分片号；crc32 与进程和 Python 版本无关（内置 hash() 每次启动都不同）"""
+    return zlib.crc32(sub_key.encode("utf-8")) % count
+
+
+class ShardLayout:
+    """storage_file / lease_file 为未分片时的文件名，分片文件和 keys.shards.json 放在同一目录"""
+
+    def __init__(self, storage_file: str = "keys.json", lease_file: str = "leases.json"):
+        self.storage_file = storage_file
+        self.lease_file = lease_file
+        self.manifest_path = os.path.splitext(storage_file)[0] + ".shards.json"
+
+    def read_count(self) -> int:
+        """当前的分片数（没有 keys.shards.json 时为 1）"""
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return int(json.load(f)["shards"])
+        except FileNotFoundError:
+            return 1
+
+    def write_manifest(self, count: int):
+        """原子地记录分片数；count 为 1 时删除 keys.shards.json"""
+        if count == 1:
+            if os.path.exists(self.manifest_path):
+                os.remove(self.manifest_path)
+            return
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"shards": count, "hash": "crc32"}, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def paths(self, count: int) -> List[Tuple[str, str]]:
+        """各分片的 (密钥文件, 租约文件)"""
+        if count == 1:
+            return [(self.storage_file, self.lease_file)]
+        return [tuple(f"{os.path.splitext(path)[0]}-{index:03d}-of-{count:03d}.json"
+                      for path in (self.storage_file, self.lease_file))
+                for index in range(count)]
+
+    def has_data(self, count: int) -> bool:
+        return any(os.path.exists(path) for pair in self.paths(count) for path in pair)
+
+    def load(self, count: int) -> Tuple[Dict, Dict]:
+        """读取布局中全部分片的原始内容，返回 (子密钥, 租约)"""
+        keys, leases = {}, {}
+        for key_path, lease_path in self.paths(count):
+            for path, target in ((key_path, keys), (lease_path, leases)):
+                if os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        target.update(json.load(f))
+        return keys, leases
+
+    def reshard(self, count: int) -> List[int]:
+        """把当前布局改为 count 个分片，返回各分片的子密钥数"""
+        old_count = self.read_count()
+        keys, leases = self.load(old_count)
+        new_paths = self.paths(count)
+        shard_keys = [{} for _ in range(count)]
+        shard_leases = [{} for _ in range(count)]
+        for sub_key, info in keys.items():
+            shard_keys[shard_index(sub_key, count)][sub_key] = info
+        for lease_id, info in leases.items():
+            # 租约跟随其子密钥所在的分片；子密钥已不存在的租约丢弃（与服务器加载时一致）
+            if info.get("sub_key") in keys:
+                shard_leases[shard_index(info["sub_key"], count)][lease_id] = info
+        if count != old_count:
+            for (key_path, lease_path), data_keys, data_leases in zip(new_paths, shard_keys, shard_leases):
+                for path, data in ((key_path, data_keys), (lease_path, data_leases)):
+                    temp_path = path + ".tmp"
+                    with open(temp_path, "w", encoding="utf-8") as f:
+                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    os.replace(temp_path, path)
+            self.write_manifest(count)
+            for pair in self.paths(old_count):
+                for path in pair:
+                    if os.path.exists(path):
+                        os.remove(path)
+        return [len(data) for data in shard_keys]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="密钥存储离线重新分片（先停止密钥服务）")
+    parser.add_argument("--shards", type=int, help="新的分片数（1 为合并回单个 keys.json）")
+    parser.add_argument("--status", action="store_true", help="只查看当前分片情况")
+    parser.add_argument("--dir", default=".", help="密钥服务的工作目录（keys.json 所在目录）")
+    args = parser.parse_args()
+
+    layout = ShardLayout(os.path.join(args.dir, "keys.json"), os.path.join(args.dir, "leases.json"))
+    if os.path.exists(layout.storage_file + ".journal"):
+        print("目录中有 keys.json.journal（多进程/主从复制的共享存储），不支持分片")
+        sys.exit(1)
+    current = layout.read_count()
+    if args.status or not args.shards:
+        keys, leases = layout.load(current)
+        counts = [0] * current
+        for sub_key in keys:
+            counts[shard_index(sub_key, current)] += 1
+        print(f"当前分片数: {current}，子密钥 {len(keys)} 个，租约 {len(leases)} 个")
+        print(f"各分片子密钥数: {counts}")
+        return
+    if args.shards < 1:
+        parser.error("--shards 至少为 1")
+    counts = layout.reshard(args.shards)
+    print(f"分片数 {current} -> {args.shards}，各分片子密钥数: {counts}")
+
+
+if __name__ == "__main__":
+    main()
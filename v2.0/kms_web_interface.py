@@ -5,6 +5,11 @@ import time
 import json
 import os
 import random
+import threading
+
+# 上游 API 和密钥服务地址，可通过环境变量指向本地替身服务器（见 fake_siliconflow.py）
+SILICONFLOW_BASE_URL = os.environ.get("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1").rstrip("/")
+KMS_BASE_URL = os.environ.get("KMS_BASE_URL", "http://localhost:8503").rstrip("/")
 
 # 管理员登录配置 - 从 secrets 读取
 ADMIN_CONFIG = {
@@ -51,6 +56,11 @@ st.set_page_config(
 class KMSClient:
     def __init__(self, base_url="http://localhost:8503"):
         self.base_url = base_url
+        # 本地密钥镜像，通过 /api/changes 增量更新，避免每次重新运行都下载全部密钥
+        self._mirror = {}
+        self._mirror_epoch = ""
+        self._mirror_version = 0
+        self._mirror_lock = threading.Lock()
     
     def create_key(self, master_key: str, balance: float, description: str):
         response = requests.post(
@@ -64,11 +74,26 @@ class KMSClient:
         return response.json()
     
     def list_keys(self, master_key: str):
-        response = requests.post(
-            f"{self.base_url}/api/list_keys",
-            json={"master_key": master_key}
-        )
-        return response.json()
+        """增量同步本地镜像后返回全部密钥"""
+        with self._mirror_lock:
+            response = requests.post(
+                f"{self.base_url}/api/changes",
+                params={"since": self._mirror_version, "epoch": self._mirror_epoch},
+                json={"master_key": master_key}
+            )
+            result = response.json()
+            if not result["success"]:
+                return result
+            
+            # 服务器重启或变更记录已过期时返回全量数据
+            if result["full"]:
+                self._mirror = {}
+            self._mirror.update(result["changed"])
+            for key in result["deleted"]:
+                self._mirror.pop(key, None)
+            self._mirror_epoch = result["epoch"]
+            self._mirror_version = result["version"]
+            return {"success": True, "keys": dict(self._mirror)}
     
     def validate_and_deduct(self, sub_key: str, amount: float = 1.0):
         response = requests.post(
@@ -114,8 +139,12 @@ class KMSClient:
         )
         return response.json()
 
-# 初始化客户端
-kms_client = KMSClient()
+# 初始化客户端（跨重新运行和会话共享，保留本地镜像）
+@st.cache_resource
+def get_kms_client():
+    return KMSClient(KMS_BASE_URL)
+
+kms_client = get_kms_client()
 
 # 持久化会话管理
 class SessionManager:
@@ -275,7 +304,7 @@ def main():
             try:
                 # 简单的API测试
                 test_response = requests.get(
-                    "https://api.siliconflow.cn/v1/models",
+                    f"{SILICONFLOW_BASE_URL}/models",
                     headers={"Authorization": f"Bearer {st.session_state.selected_master_key}"},
                     timeout=5
                 )
@@ -360,7 +389,7 @@ def main():
             # 总体统计
             total_keys = len(keys)
             active_keys = sum(1 for k in keys.values() if k['is_active'])
-            total_balance = sum(float(k['balance']) for k in keys.values())
+            total_balance = sum(float(k['balance']) + float(k.get('leased', 0)) for k in keys.values())
             total_used = sum(float(k.get('used_amount', 0)) for k in keys.values())
             
             col1, col2, col3, col4 = st.columns(4)
@@ -381,14 +410,16 @@ def main():
                         st.write(f"**描述:** {key_info.get('description', '无')}")
                         st.write(f"**创建时间:** {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(key_info['created_time']))}")
                         st.write(f"**已使用:** {float(key_info.get('used_amount', 0)):.2f}")
+                        if key_info.get('leased'):
+                            st.write(f"**已租出未用:** {float(key_info['leased']):.2f}（租约结算后退回余额）")
                         if key_info.get('last_used'):
                             st.write(f"**最后使用:** {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(key_info['last_used']))}")
                     
                     with col2:
-                        # 余额管理
+                        # 余额管理：设置的是包含已租出未用额度在内的总额
                         new_balance = st.number_input(
                             "新余额", 
-                            value=float(key_info['balance']),
+                            value=float(key_info['balance']) + float(key_info.get('leased', 0)),
                             key=f"balance_{key_id}",
                             min_value=0.00,
                             format="%.2f"
@@ -433,7 +464,7 @@ def main():
             
             # 健康检查
             try:
-                health_response = requests.get("http://localhost:8503/health", timeout=5)
+                health_response = requests.get(f"{KMS_BASE_URL}/health", timeout=5)
                 if health_response.status_code == 200:
                     health_data = health_response.json()
                     st.success("✅ API服务器运行正常")
@@ -0,0 +1,221 @@
+# pooled_wsgi.py - 带准入控制的 WSGI 服务器：固定数量的工作线程 + 有界请求队列，饱和时直接返回 503 + Retry-After
+# 替代 Flask 开发服务器（每个连接一个线程、数量不限）：高峰期排队时间有上限，超出部分快速失败而不是让所有请求一起变慢
+# 只用标准库（wsgiref），每个连接处理一个请求后关闭，排队和拒绝都按请求计
+import json
+import queue
+import socket
+import threading
+import time
+from typing import Dict, Optional
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+# 读取被拒绝请求的请求头时的超时（秒），避免慢客户端拖住拒绝线程
+REJECT_READ_TIMEOUT = 0.5
+# 被拒绝请求的请求体最多读取的字节数，读完再回复可避免客户端收到连接重置而看不到 503
+REJECT_DRAIN_BYTES = 64 * 1024
+
+
+class _QuietHandler(WSGIRequestHandler):
+    """不逐条打印访问日志（请求量和延迟由 /metrics 统计）"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """accept 线程只负责把连接放入有界队列，由 workers 个工作线程处理：
+    - 队列已满：立即返回 503 + Retry-After（queue_full）
+    - 按最近的出队速度估算的排队时间超过 queue_timeout：立即返回 503（expected_wait），不必先排队再被丢弃
+    - 排队超过 queue_timeout 秒：工作线程取出时直接返回 503，不再执行（queue_timeout），
+      此时客户端多半已超时，执行只会拖慢后面的请求
+    - 被拒绝的请求不会执行，客户端可以安全地重试（写操作另有幂等键保护）
+    - 工作线程读写连接的超时为 read_timeout 秒，慢速或空闲的客户端不会一直占住工作线程（read_timeout）
+    饱和时 /health 和 /ready 由拒绝线程直接回答，不经过队列，探针不会因排队而超时"""
+
+    allow_reuse_address = True
+    # 监听队列，accept 线程来不及 accept 的连接在内核中等待
+    request_queue_size = 1024
+
+    def __init__(self, address, app, workers: int = 16, queue_depth: int = 64, queue_timeout: float = 2.0,
+                 retry_after: int = 1, ready_threshold: float = 0.8, registry=None, metric_prefix: str = "wsgi",
+                 listen_socket: Optional[socket.socket] = None, read_timeout: float = 5.0):
+        if listen_socket is None:
+            super().__init__(address, _QuietHandler)
+        else:
+            # 多个进程共用父进程创建的监听套接字，由内核把连接分给正在 accept 的进程
+            super().__init__(listen_socket.getsockname(), _QuietHandler, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+            host, port = self.server_address[:2]
+            self.server_name = socket.getfqdn(host)
+            self.server_port = port
+            self.setup_environ()
+        self.set_app(app)
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self.read_timeout = read_timeout
+        self.retry_after = retry_after
+        self.ready_threshold = ready_threshold
+        self._queue = queue.Queue(maxsize=queue_depth)
+        # 拒绝也需要读请求头，交给单独的线程，accept 线程始终不阻塞；拒绝线程也积压时直接关闭连接
+        self._reject_queue = queue.Queue(maxsize=256)
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._stats = {"accepted": 0, "served": 0, "rejected_queue_full": 0, "rejected_queue_timeout": 0,
+                       "rejected_expected_wait": 0, "dropped": 0, "read_timeouts": 0}
+        # 饱和时（完成一个请求时队列仍不为空）相邻两次完成的间隔的指数移动平均，用于估算排队时间
+        self._drain_interval = 0.0
+        self._last_finished_at = 0.0
+        self._last_rejected_at = 0.0
+        self._queue_wait = None
+        self._rejections = None
+        if registry is not None:
+            self._queue_wait = registry.histogram(f"{metric_prefix}_queue_wait_seconds", "请求在队列中的等待时间")
+            self._rejections = registry.counter(f"{metric_prefix}_rejected_total", "准入控制拒绝的请求数", ("reason",))
+            registry.gauge(f"{metric_prefix}_workers_busy", "正在处理请求的工作线程数", lambda: self._busy)
+            registry.gauge(f"{metric_prefix}_queue_length", "排队等待的请求数", self._queue.qsize)
+            registry.gauge(f"{metric_prefix}_ready", "是否接收新流量（1 就绪，0 饱和）", lambda: int(self.ready()))
+        for index in range(workers):
+            threading.Thread(target=self._worker, name=f"wsgi-worker-{index}", daemon=True).start()
+        threading.Thread(target=self._rejecter, name="wsgi-rejecter", daemon=True).start()
+
+    # ---------------------- 准入 ----------------------
+    def process_request(self, request, client_address):
+        """accept 线程：入队，队列满或预计排队超时时交给拒绝线程"""
+        queued = self._queue.qsize()
+        if queued and queued * self._drain_interval > self.queue_timeout:
+            self._reject(request, "expected_wait")
+            return
+        try:
+            self._queue.put_nowait((request, client_address, time.monotonic()))
+            with self._lock:
+                self._stats["accepted"] += 1
+        except queue.Full:
+            self._reject(request, "queue_full")
+
+    def _reject(self, request, reason: str):
+        self._count_rejection(reason)
+        try:
+            self._reject_queue.put_nowait(request)
+        except queue.Full:
+            with self._lock:
+                self._stats["dropped"] += 1
+            self.shutdown_request(request)
+
+    def _worker(self):
+        while True:
+            request, client_address, queued_at = self._queue.get()
+            waited = time.monotonic() - queued_at
+            if self._queue_wait is not None:
+                self._queue_wait.observe(waited)
+            if waited > self.queue_timeout:
+                self._count_rejection("queue_timeout")
+                self._respond_unavailable(request)
+                continue
+            with self._lock:
+                self._busy += 1
+            try:
+                request.settimeout(self.read_timeout)
+                self.finish_request(request, client_address)
+            except socket.timeout:
+                with self._lock:
+                    self._stats["read_timeouts"] += 1
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                now = time.monotonic()
+                with self._lock:
+                    self._busy -= 1
+                    self._stats["served"] += 1
+                    if self._queue.qsize() and self._last_finished_at:
+                        self._drain_interval += 0.1 * (now - self._last_finished_at - self._drain_interval)
+                    elif not self._queue.qsize():
+                        self._drain_interval *= 0.5
+                    self._last_finished_at = now
+                self.shutdown_request(request)
+
+    def _rejecter(self):
+        while True:
+            self._respond_unavailable(self._reject_queue.get())
+
+    def _count_rejection(self, reason: str):
+        with self._lock:
+            self._stats[f"rejected_{reason}"] += 1
+            self._last_rejected_at = time.monotonic()
+        if self._rejections is not None:
+            self._rejections.inc(1, reason)
+
+    # ---------------------- 状态 ----------------------
+    def ready(self) -> bool:
+        """队列占用低于 ready_threshold 且最近 1 秒内没有拒绝请求时为就绪"""
+        with self._lock:
+            recently_rejected = time.monotonic() - self._last_rejected_at < 1.0
+        return not recently_rejected and self._queue.qsize() < self.queue_depth * self.ready_threshold
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats, busy=self._busy)
+        stats.update(workers=self.workers, queued=self._queue.qsize(), queue_depth=self.queue_depth,
+                     queue_timeout=self.queue_timeout, read_timeout=self.read_timeout, ready=self.ready())
+        return stats
+
+    # ---------------------- 快速拒绝 ----------------------
+    def _respond_unavailable(self, request):
+        """读完请求头（和不太大的请求体）后回复：探针返回状态，其他请求返回 503 + Retry-After"""
+        try:
+            request.settimeout(REJECT_READ_TIMEOUT)
+            path, content_length = self._read_head(request)
+            if path is None:
+                return
+            if path == "/health":
+                status, body = "200 OK", {"status": "healthy", "admission": self.stats()}
+            elif path == "/ready":
+                status, body = "503 Service Unavailable", {"ready": False, "admission": self.stats()}
+            else:
+                status, body = "503 Service Unavailable", {"success": False, "error": "服务繁忙，请稍后重试"}
+                if 0 < content_length <= REJECT_DRAIN_BYTES:
+                    self._drain(request, content_length)
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            headers = [f"HTTP/1.1 {status}", "Content-Type: application/json", f"Content-Length: {len(payload)}",
+                       "Connection: close"]
+            if status.startswith("503"):
+                headers.append(f"Retry-After: {self.retry_after}")
+            request.sendall(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + payload)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    @staticmethod
+    def _read_head(request):
+        """返回 (路径, Content-Length)；连接提前关闭或请求头不完整时路径为 None"""
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = request.recv(4096)
+            if not chunk or len(data) > 65536:
+                return None, 0
+            data += chunk
+        head, _, body = data.partition(b"\r\n\r\n")
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+        content_length = 0
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                try:
+                    content_length = int(value.strip())
+                except ValueError:
+                    pass
+        # 随请求头一起收到的部分请求体已经读过了
+        return path, max(content_length - len(body), 0)
+
+    @staticmethod
+    def _drain(request, remaining: int):
+        while remaining > 0:
+            chunk = request.recv(min(remaining, 65536))
+            if not chunk:
+                break
+            remaining -= len(chunk)
@@ -0,0 +1,140 @@
+# result_store.py - 生成/转换结果的磁盘暂存区：会话状态中只保存句柄，播放和下载直接读文件
+# 目录、保留时长和总大小上限可通过环境变量 RESULT_SPOOL_DIR / RESULT_MAX_AGE / RESULT_MAX_BYTES 配置
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, Optional, Union
+
+RESULT_SPOOL_DIR = os.environ.get("RESULT_SPOOL_DIR", "spool")
+RESULT_MAX_AGE = float(os.environ.get("RESULT_MAX_AGE", "3600"))
+RESULT_MAX_BYTES = int(os.environ.get("RESULT_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# 句柄格式：32位十六进制 + 扩展名，用于校验，防止通过句柄访问暂存区以外的路径
+_HANDLE_PATTERN = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]{1,5}$")
+
+
+class ResultStore:
+    """按句柄存取结果文件；超过 max_age 未访问的文件和超出 max_bytes 时最久未访问的文件会被清理"""
+
+    def __init__(self, spool_dir: str = RESULT_SPOOL_DIR, max_age: float = RESULT_MAX_AGE,
+                 max_bytes: int = RESULT_MAX_BYTES, evict_interval: float = 60.0):
+        self.spool_dir = spool_dir
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.evict_interval = evict_interval
+        self._lock = threading.Lock()
+        self._last_evict = 0.0
+        self._stats = {"stored": 0, "stored_bytes": 0, "evicted": 0, "evicted_bytes": 0, "missing": 0}
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.evict()
+
+    def put(self, data: Union[bytes, Iterable[bytes]], extension: str) -> str:
+        """写入结果并返回句柄；data 可以是字节串或分块迭代器（如 response.iter_content）"""
+        handle = f"{uuid.uuid4().hex}.{extension.lower()}"
+        path = os.path.join(self.spool_dir, handle)
+        temp_path = path + ".part"
+        size = 0
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in ([data] if isinstance(data, (bytes, bytearray)) else data):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        with self._lock:
+            self._stats["stored"] += 1
+            self._stats["stored_bytes"] += size
+            due = time.monotonic() - self._last_evict >= self.evict_interval
+        if due:
+            self.evict()
+        return handle
+
+    def clone(self, handle: Optional[str]) -> Optional[str]:
+        """为同一结果创建独立句柄（优先硬链接，不额外占用磁盘），各会话可分别删除自己的句柄"""
+        source = self.path(handle)
+        if source is None:
+            return None
+        new_handle = f"{uuid.uuid4().hex}{os.path.splitext(handle)[1]}"
+        target = os.path.join(self.spool_dir, new_handle)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        return new_handle
+
+    def path(self, handle: Optional[str]) -> Optional[str]:
+        """句柄对应的文件路径，文件已被清理时返回 None；访问会刷新文件的修改时间"""
+        if not handle or not _HANDLE_PATTERN.match(handle):
+            return None
+        path = os.path.join(self.spool_dir, handle)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._stats["missing"] += 1
+            return None
+        return path
+
+    def size(self, handle: Optional[str]) -> int:
+        path = self.path(handle)
+        return os.path.getsize(path) if path else 0
+
+    def delete(self, handle: Optional[str]):
+        path = self.path(handle)
+        if path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def evict(self) -> int:
+        """清理过期文件，然后按最久未访问的顺序删除，直到总大小不超过上限；返回删除的文件数"""
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path, name.endswith(".part")))
+
+        removed, removed_bytes = 0, 0
+        total = sum(size for _, size, _, _ in entries)
+        for mtime, size, path, partial in sorted(entries):
+            # 正在写入的 .part 文件只按时长清理（写入中断时残留）
+            expired = now - mtime > self.max_age
+            if not expired and (partial or total <= self.max_bytes):
+                continue
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+
+        with self._lock:
+            self._last_evict = time.monotonic()
+            self._stats["evicted"] += removed
+            self._stats["evicted_bytes"] += removed_bytes
+        return removed
+
+    def stats(self) -> Dict:
+        files, total = 0, 0
+        for name in os.listdir(self.spool_dir):
+            try:
+                total += os.path.getsize(os.path.join(self.spool_dir, name))
+                files += 1
+            except OSError:
+                continue
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(files=files, bytes=total, max_bytes=self.max_bytes, max_age=self.max_age)
+        return stats
@@ -0,0 +1,98 @@
+# single_flight.py - 相同请求合并：同一时刻签名相同的 TTS/STT 请求只调用一次上游，其余请求等待并共享结果
+import hashlib
+import json
+import threading
+import unicodedata
+from typing import Callable, Dict, Optional, Tuple
+
+
+def request_signature(kind: str, *parts) -> str:
+    """规范化请求参数后计算签名：文本做 NFC 规范化并去掉首尾空白，二进制内容取 SHA-256"""
+    normalized = []
+    for part in parts:
+        if isinstance(part, (bytes, bytearray)):
+            normalized.append("sha256:" + hashlib.sha256(part).hexdigest())
+        elif isinstance(part, str):
+            normalized.append(unicodedata.normalize("NFC", part).strip())
+        else:
+            normalized.append(part)
+    digest = hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+    return f"{kind}:{digest}"
+
+
+class SharedResponse:
+    """可在多个会话间共享的上游响应摘要（requests.Response 不能被多个读者消费）"""
+
+    def __init__(self, status_code: int, text: str = "", handle: Optional[str] = None):
+        self.status_code = status_code
+        self.text = text
+        self.handle = handle
+
+    @classmethod
+    def from_response(cls, response, handle: Optional[str] = None) -> "SharedResponse":
+        return cls(response.status_code, "" if handle else response.text, handle)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "followers")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """按签名合并进行中的调用；只合并同时在途的请求，调用结束后不缓存结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+        self._stats = {"leaders": 0, "hits": 0, "errors": 0}
+
+    def do(self, key: str, fn: Callable) -> Tuple[object, bool]:
+        """执行或加入签名为 key 的调用，返回 (结果, 是否为共享结果)；调用出错时每个等待者都会收到同一个异常"""
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+                    self._stats["leaders"] += 1
+                else:
+                    call.followers += 1
+                    self._stats["hits"] += 1
+
+            if leader:
+                try:
+                    call.result = fn()
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                        if call.error is not None:
+                            self._stats["errors"] += 1
+                    call.done.set()
+                return call.result, False
+
+            call.done.wait()
+            if call.error is None:
+                return call.result, True
+            if isinstance(call.error, Exception):
+                raise call.error
+            # 发起者的脚本被 Streamlit 中止（非普通异常），等待者自己重新发起
+
+    def stats(self) -> Dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["in_flight"] = len(self._calls)
+            stats["waiting"] = sum(call.followers for call in self._calls.values())
+        total = stats["leaders"] + stats["hits"]
+        stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,541 @@
+# speech_gateway.py - 语音网关：对其他服务提供与 SiliconFlow 兼容的 /v1/audio/speech 和 /v1/audio/transcriptions
+# 调用方用子密钥鉴权（Authorization: Bearer <子密钥>），网关经密钥服务扣费后用主密钥池中的密钥转发到上游，上游失败时退款
+# 请求体和响应体都按块转发，不整体读入内存；基于 asyncio，单进程即可同时维持上千个连接
+# 环境变量: GATEWAY_PORT（默认 8505）、GATEWAY_MAX_CONNECTIONS（默认 2000）、GATEWAY_MAX_UPLOAD_MB（默认 200）、
+#          GATEWAY_UPSTREAM_TIMEOUT（上游读取超时秒数，默认 300）、GATEWAY_KEY_COOLDOWN（主密钥被上游拒绝后暂停使用的秒数，默认 30）
+# 上游和密钥服务地址沿用 SILICONFLOW_BASE_URL / KMS_BASE_URL
+import argparse
+import asyncio
+import json
+import os
+import time
+import uuid
+from http import HTTPStatus
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+from async_client import (CHUNK_SIZE, KMS_BASE_URL, SILICONFLOW_BASE_URL, AsyncKMSClient, AsyncResponse,
+                          AsyncSiliconFlowClient, ClientError, ConnectionPool)
+from billing import yuan_to_cents
+from metrics import MetricsRegistry
+from speech_jobs import DEFAULT_TTS_MODEL, SpeechJobs, load_master_keys, stt_cost, tts_cost
+
+GATEWAY_PORT = int(os.environ.get("GATEWAY_PORT", "8505"))
+GATEWAY_MAX_CONNECTIONS = int(os.environ.get("GATEWAY_MAX_CONNECTIONS", "2000"))
+GATEWAY_MAX_UPLOAD_MB = float(os.environ.get("GATEWAY_MAX_UPLOAD_MB", "200"))
+GATEWAY_UPSTREAM_TIMEOUT = float(os.environ.get("GATEWAY_UPSTREAM_TIMEOUT", "300"))
+GATEWAY_KEY_COOLDOWN = float(os.environ.get("GATEWAY_KEY_COOLDOWN", "30"))
+
+MAX_JSON_BYTES = 1024 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 60.0  # keep-alive 连接空闲多久后关闭
+BODY_READ_TIMEOUT = 60.0  # 读取请求体时每块的等待上限
+# 上游对主密钥返回这些状态时暂停使用该密钥（401/403 多为密钥失效或额度用尽，暂停时间加长）
+KEY_REJECTED_STATUSES = (401, 403, 429)
+
+metrics = MetricsRegistry()
+HTTP_REQUESTS = metrics.counter("gateway_http_requests_total", "HTTP请求数", ("endpoint", "status"))
+HTTP_LATENCY = metrics.histogram("gateway_http_request_duration_seconds", "请求处理耗时（含流式传输）", ("endpoint",),
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+FORWARDED_BYTES = metrics.counter("gateway_forwarded_bytes_total", "转发的正文字节数", ("direction",))
+BILLED_CENTS = metrics.counter("gateway_billed_cents_total", "扣费金额（分，不含退款）", ("endpoint",))
+REFUNDS = metrics.counter("gateway_refunds_total", "退款次数", ("endpoint", "reason"))
+REFUNDED_CENTS = metrics.counter("gateway_refunded_cents_total", "退款金额（分），净扣费为 billed - refunded", ("endpoint",))
+KEY_COOLDOWNS = metrics.counter("gateway_master_key_cooldowns_total", "主密钥被暂停使用次数", ("status",))
+
+
+class GatewayError(Exception):
+    """以 OpenAI 兼容的错误格式返回给调用方：{"error": {"message", "type", "code"}}"""
+
+    def __init__(self, status: int, message: str, error_type: str = "invalid_request_error",
+                 headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.error_type = error_type
+        self.headers = headers or {}
+
+
+class MasterKeyPool:
+    """主密钥轮询；被上游拒绝的密钥暂停使用一段时间，全部暂停时仍返回最早恢复的那个（只在事件循环线程中使用，不加锁）"""
+
+    def __init__(self, keys: List[str], cooldown: float = GATEWAY_KEY_COOLDOWN):
+        self.keys = list(keys)
+        self.cooldown = cooldown
+        self._next = 0
+        self._paused_until: Dict[str, float] = {}
+
+    def acquire(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        candidates = [key for key in self.keys if key not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        for offset in range(len(self.keys)):
+            key = self.keys[(self._next + offset) % len(self.keys)]
+            if key in candidates and self._paused_until.get(key, 0.0) <= now:
+                self._next = (self._next + offset + 1) % len(self.keys)
+                return key
+        return min(candidates, key=lambda key: self._paused_until.get(key, 0.0))
+
+    def penalize(self, key: str, status: int, retry_after: Optional[str] = None):
+        try:
+            seconds = float(retry_after) if retry_after else None
+        except ValueError:
+            seconds = None
+        if seconds is None:
+            seconds = self.cooldown * (10 if status in (401, 403) else 1)
+        self._paused_until[key] = time.monotonic() + seconds
+        KEY_COOLDOWNS.inc(1, status)
+        print(f"[网关] 主密钥 ...{key[-4:]} 被上游拒绝（{status}），暂停使用 {seconds:.0f} 秒")
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        return {"keys": len(self.keys), "paused": sum(1 for until in self._paused_until.values() if until > now)}
+
+
+class _Request:
+    """一个 HTTP/1.1 请求；正文通过 iter_body()/read_body() 按需读取"""
+
+    def __init__(self, method: str, target: str, version: str, headers: Dict[str, str],
+                 reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.method = method
+        self.path = target.split("?", 1)[0]
+        self.version = version
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        try:
+            self.content_length = int(headers["content-length"]) if "content-length" in headers else None
+        except ValueError:
+            raise GatewayError(400, "Content-Length 无效") from None
+        if self.content_length is not None and self.content_length < 0:
+            raise GatewayError(400, "Content-Length 无效")
+        # 没有正文或正文已读完时连接才能复用
+        self.body_done = not self.chunked and not self.content_length
+        connection = headers.get("connection", "").lower()
+        self.keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        self.expect_continue = headers.get("expect", "").lower() == "100-continue"
+        self.responded = False
+
+    async def _read(self, coro):
+        try:
+            return await asyncio.wait_for(coro, BODY_READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise GatewayError(408, "读取请求体超时") from None
+
+    async def iter_body(self, limit: int) -> AsyncIterator[bytes]:
+        """按块读取请求体；超过 limit 字节时抛出 413"""
+        if self.body_done:
+            return
+        if self.expect_continue:
+            self.expect_continue = False
+            self.writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await self.writer.drain()
+        received = 0
+        if not self.chunked:
+            if self.content_length > limit:
+                raise GatewayError(413, f"请求体超过 {limit} 字节")
+            remaining = self.content_length
+            while remaining > 0:
+                chunk = await self._read(self.reader.read(min(CHUNK_SIZE, remaining)))
+                if not chunk:
+                    raise ConnectionError("客户端在请求体传完前断开")
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                size_line = await self._read(self.reader.readline())
+                try:
+                    size = int(size_line.split(b";")[0].strip(), 16)
+                except ValueError:
+                    raise GatewayError(400, "chunked 编码格式错误") from None
+                if size == 0:
+                    while (await self._read(self.reader.readline())) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                received += size
+                if received > limit:
+                    raise GatewayError(413, f"请求体超过 {limit} 字节")
+                while size > 0:
+                    chunk = await self._read(self.reader.read(min(CHUNK_SIZE, size)))
+                    if not chunk:
+                        raise ConnectionError("客户端在请求体传完前断开")
+                    size -= len(chunk)
+                    yield chunk
+                await self._read(self.reader.readline())
+        self.body_done = True
+
+    async def read_body(self, limit: int) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_body(limit)])
+
+    async def write_head(self, status: int, headers: Dict[str, str]):
+        self.responded = True
+        head = {"Server": "speech-gateway", "Connection": "keep-alive" if self.keep_alive else "close"}
+        head.update(headers)
+        self.writer.write((f"HTTP/1.1 {status} {_reason(status)}\r\n"
+                           + "".join(f"{name}: {value}\r\n" for name, value in head.items()) + "\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+    async def send(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None):
+        head = {"Content-Type": content_type, "Content-Length": str(len(body))}
+        head.update(headers or {})
+        await self.write_head(status, head)
+        self.writer.write(body)
+        await self.writer.drain()
+
+    async def send_json(self, status: int, payload: Dict, headers: Optional[Dict[str, str]] = None):
+        await self.send(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                        "application/json; charset=utf-8", headers)
+
+
+class SpeechGateway:
+    """把调用方请求转发到 SiliconFlow：子密钥扣费 → 选主密钥 → 流式转发 → 上游失败时退款"""
+
+    def __init__(self, jobs: SpeechJobs, master_keys: MasterKeyPool, max_connections: int = GATEWAY_MAX_CONNECTIONS,
+                 max_upload_bytes: int = int(GATEWAY_MAX_UPLOAD_MB * 1024 * 1024),
+                 upstream_timeout: float = GATEWAY_UPSTREAM_TIMEOUT):
+        self.jobs = jobs
+        self.master_keys = master_keys
+        self.max_connections = max_connections
+        self.max_upload_bytes = max_upload_bytes
+        self.timeout = (10.0, upstream_timeout)
+        self.connections = 0
+        self.in_flight = 0
+        self.routes = {
+            ("POST", "/v1/audio/speech"): self.handle_speech,
+            ("POST", "/v1/audio/transcriptions"): self.handle_transcriptions,
+            ("GET", "/health"): self.handle_health,
+            ("GET", "/metrics"): self.handle_metrics,
+        }
+        metrics.gauge("gateway_open_connections", "当前客户端连接数", lambda: self.connections)
+        metrics.gauge("gateway_in_flight_requests", "正在处理的请求数", lambda: self.in_flight)
+
+    @property
+    def pool(self) -> ConnectionPool:
+        return self.jobs.siliconflow.pool
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                request = _Request("GET", "/", "HTTP/1.1", {"connection": "close"}, reader, writer)
+                await request.send_json(503, _error_body(503, "网关连接数已满，请稍后重试", "overloaded"),
+                                        {"Retry-After": "1"})
+                return
+            while True:
+                try:
+                    request = await self._read_request(reader, writer)
+                except GatewayError as e:
+                    request = _Request("GET", "/", "HTTP/1.1", {"connection": "close"}, reader, writer)
+                    await request.send_json(e.status, _error_body(e.status, e.message, e.error_type))
+                    return
+                if request is None or not await self._dispatch(request):
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass  # 客户端断开或发送请求头太慢
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> Optional[_Request]:
+        """读取请求行和请求头；连接关闭或 keep-alive 空闲超时返回 None"""
+        try:
+            line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:
+            raise GatewayError(431, "请求行过长") from None
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise GatewayError(400, "无效的请求行")
+        headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADERS + 1):
+            try:
+                header_line = await asyncio.wait_for(reader.readline(), BODY_READ_TIMEOUT)
+            except ValueError:
+                raise GatewayError(431, "请求头过长") from None
+            header_line = header_line.decode("latin-1").rstrip("\r\n")
+            if not header_line:
+                return _Request(parts[0], parts[1], parts[2], headers, reader, writer)
+            name, _, value = header_line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        raise GatewayError(431, "请求头过多")
+
+    async def _dispatch(self, request: _Request) -> bool:
+        """处理一个请求，返回连接能否继续用于下一个请求"""
+        handler = self.routes.get((request.method, request.path))
+        endpoint = request.path if handler else "unmatched"
+        started = time.perf_counter()
+        status = 500
+        self.in_flight += 1
+        try:
+            if handler is None:
+                raise GatewayError(404 if request.path not in {path for _, path in self.routes} else 405,
+                                   f"不支持 {request.method} {request.path}")
+            status = await handler(request)
+        except GatewayError as e:
+            status = e.status
+            if request.responded:
+                request.keep_alive = False
+            else:
+                await request.send_json(e.status, _error_body(e.status, e.message, e.error_type), e.headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = 499  # 客户端中途断开
+            request.keep_alive = False
+        except Exception as e:
+            print(f"[网关] 处理 {request.method} {request.path} 出错: {e}")
+            request.keep_alive = False
+            if not request.responded:
+                await request.send_json(500, _error_body(500, f"网关内部错误: {e}", "server_error"))
+        finally:
+            self.in_flight -= 1
+            HTTP_LATENCY.observe(time.perf_counter() - started, endpoint)
+            HTTP_REQUESTS.inc(1, endpoint, status)
+        return request.keep_alive and request.body_done
+
+    def _sub_key(self, request: _Request) -> str:
+        auth = request.headers.get("authorization", "")
+        if not auth.startswith("Bearer ") or not auth[7:].strip():
+            raise GatewayError(401, "缺少子密钥（Authorization: Bearer <子密钥>）", "authentication_error")
+        return auth[7:].strip()
+
+    async def _charge(self, sub_key: str, cost: float, idempotency_key: str):
+        result = await self.jobs.charge(sub_key, cost, idempotency_key)
+        if result.get("success"):
+            return
+        error = result.get("error", "扣费失败")
+        if error == "密钥无效":
+            raise GatewayError(401, "子密钥无效或已停用", "authentication_error")
+        if error == "余额不足":
+            raise GatewayError(402, f"余额不足，本次需要 ¥{cost:.2f}", "insufficient_balance")
+        raise GatewayError(503, error, "billing_unavailable", {"Retry-After": "1"})
+
+    async def _refund(self, endpoint: str, sub_key: str, cost: float, idempotency_key: str, reason: str):
+        REFUNDS.inc(1, endpoint, reason)
+        if not await self.jobs.refund(sub_key, cost, idempotency_key):
+            print(f"[网关] 退款失败 {idempotency_key} ¥{cost:.2f}，需要人工核对")
+            return
+        REFUNDED_CENTS.inc(yuan_to_cents(cost), endpoint)
+
+    def _upstream_headers(self, request: _Request, master_key: str, content_type: str) -> Dict[str, str]:
+        headers = {"Authorization": f"Bearer {master_key}", "Content-Type": content_type}
+        if "traceparent" in request.headers:
+            headers["traceparent"] = request.headers["traceparent"]
+        return headers
+
+    async def handle_speech(self, request: _Request) -> int:
+        sub_key = self._sub_key(request)
+        try:
+            payload = json.loads(await request.read_body(MAX_JSON_BYTES))
+        except ValueError:
+            raise GatewayError(400, "请求体不是有效的 JSON") from None
+        if not isinstance(payload, dict) or not isinstance(payload.get("input"), str) or not payload["input"]:
+            raise GatewayError(400, "缺少 input")
+        payload.setdefault("model", DEFAULT_TTS_MODEL)
+        payload.setdefault("voice", f"{payload['model']}:alex")
+
+        cost = tts_cost(payload["input"])
+        idempotency_key = f"gw:{uuid.uuid4().hex}"
+        await self._charge(sub_key, cost, idempotency_key)
+        BILLED_CENTS.inc(yuan_to_cents(cost), "speech")
+
+        # JSON 请求体可以重放：主密钥被拒绝时换一个密钥重试一次
+        tried: List[str] = []
+        try:
+            for _ in range(2):
+                master_key = self.master_keys.acquire(exclude=tried)
+                if master_key is None:
+                    break
+                tried.append(master_key)
+                body = json.dumps(payload)
+                response = await self.pool.request(
+                    "POST", f"{self.jobs.siliconflow.base_url}/audio/speech",
+                    self._upstream_headers(request, master_key, "application/json"), body,
+                    timeout=self.timeout, stream=True)
+                FORWARDED_BYTES.inc(len(body), "upstream")
+                if response.status_code not in KEY_REJECTED_STATUSES:
+                    break
+                await response.read()
+                self.master_keys.penalize(master_key, response.status_code, response.headers.get("retry-after"))
+        except ClientError as e:
+            await self._refund("speech", sub_key, cost, idempotency_key, "upstream_unreachable")
+            raise GatewayError(502, f"上游连接失败: {e}", "upstream_error") from None
+        return await self._relay(request, response, "speech", sub_key, cost, idempotency_key)
+
+    async def handle_transcriptions(self, request: _Request) -> int:
+        sub_key = self._sub_key(request)
+        content_type = request.headers.get("content-type", "")
+        if not content_type.startswith("multipart/form-data"):
+            raise GatewayError(400, "请求体需要为 multipart/form-data")
+        if request.chunked or request.content_length is None:
+            # 按上传大小计费且上游需要 Content-Length，不接受 chunked 上传
+            raise GatewayError(411, "需要 Content-Length")
+        if request.content_length > self.max_upload_bytes:
+            raise GatewayError(413, f"上传大小超过 {self.max_upload_bytes // (1024 * 1024)} MB")
+
+        # 请求体原样流式转发，按整个上传请求体的大小计费（比音频文件多出几百字节的 multipart 头）
+        cost = stt_cost(request.content_length)
+        idempotency_key = f"gw:{uuid.uuid4().hex}"
+        await self._charge(sub_key, cost, idempotency_key)
+        BILLED_CENTS.inc(yuan_to_cents(cost), "transcriptions")
+
+        master_key = self.master_keys.acquire()
+        if master_key is None:
+            await self._refund("transcriptions", sub_key, cost, idempotency_key, "no_master_key")
+            raise GatewayError(503, "主密钥池为空", "server_error")
+
+        async def upload() -> AsyncIterator[bytes]:
+            async for chunk in request.iter_body(self.max_upload_bytes):
+                FORWARDED_BYTES.inc(len(chunk), "upstream")
+                yield chunk
+
+        try:
+            response = await self.pool.request(
+                "POST", f"{self.jobs.siliconflow.base_url}/audio/transcriptions",
+                self._upstream_headers(request, master_key, content_type), upload(),
+                content_length=request.content_length, timeout=self.timeout, stream=True)
+        except ClientError as e:
+            await self._refund("transcriptions", sub_key, cost, idempotency_key, "upstream_unreachable")
+            raise GatewayError(502, f"上游连接失败: {e}", "upstream_error") from None
+        except (ConnectionError, GatewayError):
+            await self._refund("transcriptions", sub_key, cost, idempotency_key, "client_aborted")
+            raise
+        if response.status_code in KEY_REJECTED_STATUSES:
+            self.master_keys.penalize(master_key, response.status_code, response.headers.get("retry-after"))
+        return await self._relay(request, response, "transcriptions", sub_key, cost, idempotency_key)
+
+    async def _relay(self, request: _Request, response: AsyncResponse, endpoint: str, sub_key: str,
+                     cost: float, idempotency_key: str) -> int:
+        """把上游响应转发给调用方；上游返回错误或中途断开时退款，调用方中途断开时不退款（上游已完成处理）"""
+        status = response.status_code
+        if status != 200:
+            try:
+                body = await response.read()
+            except ClientError:
+                body = b""
+            await self._refund(endpoint, sub_key, cost, idempotency_key, f"upstream_{status}")
+            await request.send(status, body, response.headers.get("content-type", "application/json"),
+                               {"X-Request-Id": idempotency_key})
+            return status
+
+        headers = {"Content-Type": response.headers.get("content-type", "application/octet-stream"),
+                   "X-Request-Id": idempotency_key, "X-Billed-Amount": f"{cost:.2f}"}
+        length = response.headers.get("content-length")
+        if length is not None:
+            headers["Content-Length"] = length
+        elif request.version == "HTTP/1.1":
+            headers["Transfer-Encoding"] = "chunked"
+        else:
+            request.keep_alive = False  # HTTP/1.0 且长度未知：以关闭连接表示正文结束
+        chunked = headers.get("Transfer-Encoding") == "chunked"
+
+        chunks = response.iter_chunks()
+        try:
+            await request.write_head(200, headers)
+            async for chunk in chunks:
+                request.writer.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n" if chunked else chunk)
+                FORWARDED_BYTES.inc(len(chunk), "downstream")
+                # 调用方读得慢时在这里等待，上游读取也随之暂停
+                await request.writer.drain()
+            if chunked:
+                request.writer.write(b"0\r\n\r\n")
+                await request.writer.drain()
+        except ClientError as e:
+            # 响应头已发出，只能关闭连接让调用方看到不完整的正文
+            print(f"[网关] {endpoint} 上游中途断开: {e}")
+            await self._refund(endpoint, sub_key, cost, idempotency_key, "upstream_interrupted")
+            request.keep_alive = False
+            return 502
+        finally:
+            await chunks.aclose()
+            await response.release()
+        return 200
+
+    async def handle_health(self, request: _Request) -> int:
+        await request.send_json(200, {
+            "status": "healthy",
+            "service": "Speech Gateway",
+            "timestamp": time.time(),
+            "connections": self.connections,
+            "in_flight": self.in_flight,
+            "master_keys": self.master_keys.stats(),
+            "upstream_pool": self.pool.stats()
+        })
+        return 200
+
+    async def handle_metrics(self, request: _Request) -> int:
+        await request.send(200, metrics.render().encode("utf-8"), MetricsRegistry.CONTENT_TYPE)
+        return 200
+
+    async def serve(self, host: str = "0.0.0.0", port: int = GATEWAY_PORT) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_connection, host, port, limit=CHUNK_SIZE * 4, backlog=1024)
+
+
+def _reason(status: int) -> str:
+    try:
+        return HTTPStatus(status).phrase
+    except ValueError:
+        return "Unknown"
+
+
+def _error_body(status: int, message: str, error_type: str) -> Dict:
+    return {"error": {"message": message, "type": error_type, "code": status}}
+
+
+def create_gateway(master_keys_file: str = "master_keys.json", siliconflow_url: str = SILICONFLOW_BASE_URL,
+                   kms_url: str = KMS_BASE_URL) -> SpeechGateway:
+    keys = load_master_keys(master_keys_file)
+    pool = ConnectionPool()
+    jobs = SpeechJobs(AsyncSiliconFlowClient(siliconflow_url, pool), AsyncKMSClient(kms_url, pool), keys)
+    return SpeechGateway(jobs, MasterKeyPool(keys))
+
+
+def _raise_open_file_limit():
+    """每个连接占用一个文件描述符，把软上限提高到硬上限"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass  # Windows 没有 resource 模块
+
+
+def main():
+    parser = argparse.ArgumentParser(description="语音网关（子密钥鉴权、计费并转发到 SiliconFlow）")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=GATEWAY_PORT)
+    parser.add_argument("--master-keys", default="master_keys.json", help="主密钥文件")
+    parser.add_argument("--siliconflow-url", default=SILICONFLOW_BASE_URL)
+    parser.add_argument("--kms-url", default=KMS_BASE_URL)
+    args = parser.parse_args()
+
+    _raise_open_file_limit()
+    gateway = create_gateway(args.master_keys, args.siliconflow_url, args.kms_url)
+
+    async def run():
+        server = await gateway.serve(args.host, args.port)
+        async with server:
+            await server.serve_forever()
+
+    print("=" * 50)
+    print("语音网关启动")
+    print("=" * 50)
+    print(f"地址: http://localhost:{args.port}")
+    print(f"主密钥池: {len(gateway.master_keys.keys)} 个密钥，上游: {args.siliconflow_url}，密钥服务: {args.kms_url}")
+    print("API端点（Authorization: Bearer <子密钥>）:")
+    print("  - POST /v1/audio/speech - 语音合成（流式返回音频）")
+    print("  - POST /v1/audio/transcriptions - 语音转文字（multipart/form-data，需要 Content-Length）")
+    print("  - GET  /metrics - 运行指标（Prometheus 格式）")
+    print("  - GET  /health - 健康检查")
+    print("=" * 50)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
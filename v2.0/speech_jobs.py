@@ -0,0 +1,156 @@
+# speech_jobs.py - 不依赖 Streamlit 的转录、语音合成、格式转换和计费逻辑，供批处理命令行（batch_cli.py）等无界面流程调用
+# 计费规则与页面一致：先扣费，上游失败或出错时退款；扣费和退款都带幂等键，进程中断后重跑不会重复扣费
+import asyncio
+import json
+import os
+import random
+from typing import Dict, List, Optional
+
+from async_client import AsyncKMSClient, AsyncSiliconFlowClient, ClientError
+from transcode_pool import TranscodeError, TranscodePool, TranscodeQueueFull
+
+# 计费标准：转录 ¥0.50/MB，语音合成 ¥50/百万 UTF-8 字节，每次最低 ¥0.10
+STT_PRICE_PER_MB = 0.50
+TTS_PRICE_PER_MILLION_BYTES = 50.0
+MIN_CHARGE = 0.10
+
+# 上游对这些格式支持有限，转录前先转换为 MP3
+CONVERT_FORMATS = ("flac", "m4a")
+
+AUDIO_MIME_TYPES = {"mp3": "audio/mpeg", "wav": "audio/wav", "flac": "audio/flac", "m4a": "audio/mp4"}
+
+DEFAULT_STT_MODEL = "FunAudioLLM/SenseVoiceSmall"
+DEFAULT_TTS_MODEL = "FunAudioLLM/CosyVoice2-0.5B"
+
+
+def stt_cost(size_bytes: int) -> float:
+    """按音频大小计算转录费用"""
+    return max(size_bytes / (1024 * 1024) * STT_PRICE_PER_MB, MIN_CHARGE)
+
+
+def tts_cost(text: str) -> float:
+    """按文本 UTF-8 字节数计算语音合成费用"""
+    return max(len(text.encode("utf-8")) / 1_000_000 * TTS_PRICE_PER_MILLION_BYTES, MIN_CHARGE)
+
+
+def load_master_keys(keys_file: str = "master_keys.json") -> List[str]:
+    """读取主密钥池，文件不存在或为空时抛出 ValueError"""
+    if not os.path.exists(keys_file):
+        raise ValueError(f"主密钥文件 {keys_file} 不存在")
+    with open(keys_file, "r", encoding="utf-8") as f:
+        keys = json.load(f).get("master_keys", [])
+    if not keys:
+        raise ValueError("主密钥池为空，请检查 master_keys.json 文件")
+    return keys
+
+
+def _upstream_error(response) -> str:
+    try:
+        return response.json().get("error", {}).get("message") or response.text
+    except (ValueError, AttributeError):
+        return response.text
+
+
+class SpeechJobs:
+    """一次转录或合成 = 扣费 → （转换）→ 调用上游 → 失败时退款；返回 {"success": ..., ...} 字典，不抛出异常"""
+
+    def __init__(self, siliconflow: AsyncSiliconFlowClient, kms: AsyncKMSClient, master_keys: List[str],
+                 transcode_pool: Optional[TranscodePool] = None, timeout: tuple = (10.0, 300.0)):
+        self.siliconflow = siliconflow
+        self.kms = kms
+        self.master_keys = master_keys
+        self.transcode_pool = transcode_pool
+        self.timeout = timeout
+
+    async def charge(self, sub_key: str, cost: float, idempotency_key: Optional[str]) -> Dict:
+        """扣费，返回密钥服务的结果；幂等键加 :charge 后缀"""
+        return await self.kms.validate_and_deduct(
+            sub_key, cost, idempotency_key=f"{idempotency_key}:charge" if idempotency_key else None)
+
+    async def refund(self, sub_key: str, cost: float, idempotency_key: Optional[str]) -> bool:
+        """退还 charge 扣除的金额；幂等键加 :refund 后缀"""
+        result = await self.kms.validate_and_deduct(
+            sub_key, -cost, idempotency_key=f"{idempotency_key}:refund" if idempotency_key else None)
+        return bool(result.get("success"))
+
+    async def convert(self, data: bytes, source_ext: str, target_format: str = "mp3") -> bytes:
+        """在转码池中转换格式，队列满时等待后重试；失败时抛出 TranscodeError"""
+        if self.transcode_pool is None:
+            self.transcode_pool = TranscodePool()
+        while True:
+            try:
+                job = self.transcode_pool.submit(data, source_ext, target_format)
+                break
+            except TranscodeQueueFull:
+                await asyncio.sleep(0.5)
+        try:
+            return await asyncio.to_thread(job.result)
+        finally:
+            job.cancel()
+
+    async def transcribe(self, sub_key: str, audio_path: str, model: str = DEFAULT_STT_MODEL,
+                         convert: bool = True, idempotency_key: Optional[str] = None) -> Dict:
+        """转录一个音频文件，成功时返回 {"success": True, "text", "cost", "converted"}"""
+        size = os.path.getsize(audio_path)
+        cost = stt_cost(size)
+        charge = await self.charge(sub_key, cost, idempotency_key)
+        if not charge.get("success"):
+            return {"success": False, "error": charge.get("error", "扣费失败"), "cost": 0.0}
+
+        ext = os.path.splitext(audio_path)[1].lstrip(".").lower()
+        converted = False
+        try:
+            if convert and ext in CONVERT_FORMATS:
+                with open(audio_path, "rb") as f:
+                    data = await asyncio.to_thread(f.read)
+                audio = await self.convert(data, ext)
+                converted = True
+                response = await self.siliconflow.transcribe(
+                    random.choice(self.master_keys), audio, "converted.mp3", model, "audio/mpeg", timeout=self.timeout)
+            else:
+                # 原始文件按块流式上传
+                with open(audio_path, "rb") as f:
+                    response = await self.siliconflow.transcribe(
+                        random.choice(self.master_keys), f, os.path.basename(audio_path), model,
+                        AUDIO_MIME_TYPES.get(ext, "application/octet-stream"), timeout=self.timeout)
+            if response.status_code != 200:
+                error = f"上游错误 {response.status_code}: {_upstream_error(response)}"
+            else:
+                return {"success": True, "text": response.json().get("text", ""), "cost": cost, "converted": converted}
+        except (ClientError, TranscodeError, OSError, ValueError) as e:
+            error = str(e)
+        refunded = await self.refund(sub_key, cost, idempotency_key)
+        return {"success": False, "error": error, "cost": 0.0 if refunded else cost, "refunded": refunded}
+
+    async def synthesize(self, sub_key: str, text: str, output_path: str, model: str = DEFAULT_TTS_MODEL,
+                         voice: Optional[str] = None, speed: float = 1.0, response_format: str = "mp3",
+                         idempotency_key: Optional[str] = None) -> Dict:
+        """合成语音并流式写入 output_path（先写 .part，完成后改名），成功时返回 {"success": True, "bytes", "cost"}"""
+        cost = tts_cost(text)
+        charge = await self.charge(sub_key, cost, idempotency_key)
+        if not charge.get("success"):
+            return {"success": False, "error": charge.get("error", "扣费失败"), "cost": 0.0}
+
+        payload = {"model": model, "input": text, "voice": voice or f"{model}:alex", "speed": speed,
+                   "response_format": response_format}
+        temp_path = output_path + ".part"
+        try:
+            response = await self.siliconflow.speech(random.choice(self.master_keys), payload, timeout=self.timeout)
+            async with response:
+                if response.status_code != 200:
+                    await response.read()
+                    error = f"上游错误 {response.status_code}: {_upstream_error(response)}"
+                else:
+                    written = 0
+                    with open(temp_path, "wb") as f:
+                        async for chunk in response.iter_chunks():
+                            await asyncio.to_thread(f.write, chunk)
+                            written += len(chunk)
+                    os.replace(temp_path, output_path)
+                    return {"success": True, "bytes": written, "cost": cost}
+        except (ClientError, OSError) as e:
+            error = str(e)
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        refunded = await self.refund(sub_key, cost, idempotency_key)
+        return {"success": False, "error": error, "cost": 0.0 if refunded else cost, "refunded": refunded}
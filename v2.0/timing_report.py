@@ -0,0 +1,60 @@
+# timing_report.py - 离线分析任务计时日志，按阶段输出 p50/p95/p99
+# 用法: python timing_report.py [logs/job_timings.jsonl] [--kind stt|tts] [--status ok] [--hours 24]
+import argparse
+import time
+from collections import defaultdict
+
+from job_timing import TIMING_LOG_FILE, load_records, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按阶段统计 TTS/STT 任务耗时分位数")
+    parser.add_argument("log_file", nargs="?", default=TIMING_LOG_FILE, help="计时日志文件")
+    parser.add_argument("--kind", choices=["stt", "tts"], help="只统计某类任务")
+    parser.add_argument("--status", help="只统计某种结束状态（如 ok / upstream_error）")
+    parser.add_argument("--hours", type=float, help="只统计最近 N 小时的任务")
+    args = parser.parse_args()
+
+    try:
+        records = load_records(args.log_file)
+    except (OSError, UnicodeDecodeError) as e:
+        parser.error(f"无法读取计时日志 {args.log_file}: {getattr(e, 'strerror', None) or e}")
+    if args.kind:
+        records = [r for r in records if r.get("kind") == args.kind]
+    if args.status:
+        records = [r for r in records if r.get("status") == args.status]
+    if args.hours:
+        cutoff = time.time() - args.hours * 3600
+        records = [r for r in records if r.get("started_at", 0) >= cutoff]
+
+    if not records:
+        print("没有匹配的计时记录")
+        return
+
+    # (任务类型, 阶段) -> 耗时列表；同一任务内同名阶段累加
+    durations = defaultdict(list)
+    for record in records:
+        per_stage = defaultdict(float)
+        for stage in record.get("stages", []):
+            per_stage[stage["name"]] += stage["duration_ms"]
+        for name, value in per_stage.items():
+            durations[(record["kind"], name)].append(value)
+        durations[(record["kind"], "total")].append(record.get("total_ms", 0.0))
+
+    print(f"任务数: {len(records)}")
+    print(f"{'类型':<6}{'阶段':<22}{'次数':>8}{'p50(ms)':>12}{'p95(ms)':>12}{'p99(ms)':>12}{'max(ms)':>12}")
+    for (kind, name), values in sorted(durations.items(), key=lambda item: (item[0][0], item[0][1] == "total", item[0][1])):
+        values.sort()
+        print(f"{kind:<6}{name:<22}{len(values):>8}"
+              f"{percentile(values, 50):>12.1f}{percentile(values, 95):>12.1f}"
+              f"{percentile(values, 99):>12.1f}{values[-1]:>12.1f}")
+
+    # 对冲请求（HEDGE_ENABLED=1）的效果：发出对冲的任务中有多少由对冲请求先返回
+    hedged = [r for r in records if r.get("hedged")]
+    if hedged:
+        wins = sum(1 for r in hedged if r.get("hedge_won"))
+        print(f"对冲: {len(hedged)}/{len(records)} 个任务发出了对冲请求，其中 {wins} 个由对冲请求胜出（{wins / len(hedged):.1%}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# tracing.py - 跨进程链路追踪：W3C traceparent 头传递 + 本地 JSONL 文件导出（OpenTelemetry span 字段）
+# 查看某条链路: python tracing.py <trace_id> [logs/spans.jsonl]
+import atexit
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+# span 导出文件，前端和密钥服务默认写入同一个文件，便于按 trace_id 关联
+SPANS_FILE = os.environ.get("TRACE_SPANS_FILE", os.path.join("logs", "spans.jsonl"))
+
+_context = threading.local()
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def format_traceparent(trace_id: str, span_id: str) -> str:
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str]]:
+    """解析 traceparent 头，返回 (trace_id, parent_span_id)，格式不合法时返回 None"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def current_traceparent() -> Optional[str]:
+    """当前线程正在进行的 span 对应的 traceparent，没有时返回 None"""
+    current = getattr(_context, "current", None)
+    return format_traceparent(*current) if current else None
+
+
+@contextmanager
+def activate(trace_id: str, span_id: str):
+    """在 with 块内把 (trace_id, span_id) 设为当前线程的追踪上下文，出站请求会带上它"""
+    previous = getattr(_context, "current", None)
+    _context.current = (trace_id, span_id)
+    try:
+        yield
+    finally:
+        _context.current = previous
+
+
+def make_span(name: str, trace_id: str, span_id: str, parent_span_id: Optional[str],
+              start_time: float, end_time: float, service: str, kind: str = "INTERNAL",
+              attributes: Optional[Dict] = None, error: bool = False) -> Dict:
+    """构建一个 OpenTelemetry 数据模型字段的 span（时间为 unix 纳秒）"""
+    return {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "parentSpanId": parent_span_id or "",
+        "name": name,
+        "kind": f"SPAN_KIND_{kind}",
+        "startTimeUnixNano": int(start_time * 1e9),
+        "endTimeUnixNano": int(end_time * 1e9),
+        "attributes": attributes or {},
+        "status": {"code": "STATUS_CODE_ERROR" if error else "STATUS_CODE_OK"},
+        "resource": {"service.name": service}
+    }
+
+
+class FileSpanExporter:
+    """缓冲批量写入 JSONL 的 span 导出器，攒够一批或超过间隔时一次性追加写入"""
+
+    def __init__(self, path: str = SPANS_FILE, batch_size: int = 100, flush_interval: float = 2.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict] = []
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        atexit.register(self.flush)
+
+    def export(self, spans: List[Dict]):
+        with self._lock:
+            self._buffer.extend(spans)
+            due = len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        if not spans:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            data = "".join(json.dumps(span, ensure_ascii=False) + "\n" for span in spans)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except Exception as e:
+            print(f"写入 span 文件失败: {e}")
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def get_exporter() -> FileSpanExporter:
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = FileSpanExporter()
+        return _exporter
+
+
+def print_trace(trace_id: str, path: str = SPANS_FILE):
+    """按开始时间打印一条链路上所有进程的 span"""
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if span.get("traceId") == trace_id:
+                spans.append(span)
+    if not spans:
+        print(f"未找到链路 {trace_id}")
+        return
+
+    spans.sort(key=lambda span: span["startTimeUnixNano"])
+    children = {}
+    for span in spans:
+        children.setdefault(span["parentSpanId"], []).append(span)
+    known = {span["spanId"] for span in spans}
+    origin = spans[0]["startTimeUnixNano"]
+
+    def walk(span, depth):
+        offset = (span["startTimeUnixNano"] - origin) / 1e6
+        duration = (span["endTimeUnixNano"] - span["startTimeUnixNano"]) / 1e6
+        service = span.get("resource", {}).get("service.name", "")
+        print(f"{offset:>10.1f}ms {duration:>10.1f}ms  {'  ' * depth}{span['name']} [{service}]")
+        for child in children.get(span["spanId"], []):
+            walk(child, depth + 1)
+
+    print(f"链路 {trace_id}: {len(spans)} 个 span")
+    for span in spans:
+        if span["parentSpanId"] not in known:
+            walk(span, 0)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python tracing.py <trace_id> [spans.jsonl]")
+        sys.exit(1)
+    print_trace(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else SPANS_FILE)
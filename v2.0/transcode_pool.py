@@ -0,0 +1,182 @@
+# transcode_pool.py - 音频转码进程池：由固定数量的工作线程管理 ffmpeg 子进程，转码不再占用 Streamlit 脚本线程
+# 并发数、排队上限和超时可通过环境变量 TRANSCODE_WORKERS / TRANSCODE_QUEUE_DEPTH / TRANSCODE_TIMEOUT 配置
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", "0")) or (os.cpu_count() or 1)
+TRANSCODE_QUEUE_DEPTH = int(os.environ.get("TRANSCODE_QUEUE_DEPTH", "16"))
+TRANSCODE_TIMEOUT = float(os.environ.get("TRANSCODE_TIMEOUT", "600"))
+
+
+class TranscodeError(RuntimeError):
+    """转码失败、超时或被取消"""
+
+
+class TranscodeQueueFull(RuntimeError):
+    """排队的任务已达上限"""
+
+
+class TranscodeJob:
+    """一个转码任务：queued → running → done / failed / cancelled"""
+
+    def __init__(self, input_path: str, target_format: str, timeout: Optional[float] = None):
+        self.input_path = input_path
+        self.target_format = target_format
+        self.timeout = timeout
+        self.state = "queued"
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.output: Optional[bytes] = None
+        self.error: Optional[str] = None
+        self._process: Optional[subprocess.Popen] = None
+        self._on_finish = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def result(self, timeout: Optional[float] = None) -> bytes:
+        """等待并返回转码结果，失败时抛出 TranscodeError"""
+        if not self._done.wait(timeout):
+            raise TranscodeError("等待转码结果超时")
+        if self.state != "done":
+            raise TranscodeError(self.error or self.state)
+        return self.output
+
+    def cancel(self) -> bool:
+        """取消任务：排队中的直接丢弃，运行中的终止 ffmpeg 进程；已结束的任务不受影响"""
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self.state = "cancelled"
+            self.error = "转码已取消"
+            process = self._process
+        if process is not None and process.poll() is None:
+            process.kill()
+        self._finish()
+        return True
+
+    def elapsed(self) -> float:
+        return time.monotonic() - (self.started_at or self.submitted_at)
+
+    def _finish(self):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self.finished_at = time.monotonic()
+            self._done.set()
+        try:
+            os.unlink(self.input_path)
+        except OSError:
+            pass
+        if self._on_finish:
+            self._on_finish()
+
+
+class TranscodePool:
+    """固定 workers 个工作线程，每个线程同一时间只运行一个单线程 ffmpeg 进程，
+    因此转码并发受 workers 约束，吞吐随 CPU 核数扩展；未完成的任务超过 workers + queue_depth 时拒绝新任务"""
+
+    def __init__(self, workers: int = TRANSCODE_WORKERS, queue_depth: int = TRANSCODE_QUEUE_DEPTH,
+                 timeout: float = TRANSCODE_TIMEOUT, ffmpeg: str = "ffmpeg"):
+        self.workers = max(1, workers)
+        self.queue_depth = queue_depth
+        self.timeout = timeout
+        self.ffmpeg = ffmpeg
+        self._queue: "queue.Queue[TranscodeJob]" = queue.Queue()
+        self._outstanding = 0
+        self._stats_lock = threading.Lock()
+        self._stats = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0, "cancelled": 0, "running": 0}
+        for index in range(self.workers):
+            threading.Thread(target=self._worker, name=f"transcode-{index}", daemon=True).start()
+
+    def submit(self, data: bytes, source_ext: str, target_format: str = "mp3",
+               timeout: Optional[float] = None) -> TranscodeJob:
+        """提交转码任务；输入写入临时文件（m4a 的 moov 可能在文件末尾，不能从管道读取）；
+        timeout 为该任务的转码超时（如任务期限的剩余时间），不超过池的默认超时"""
+        with self._stats_lock:
+            if self._outstanding >= self.workers + self.queue_depth:
+                self._stats["rejected"] += 1
+                raise TranscodeQueueFull(f"转码队列已满（{self.queue_depth} 个任务排队中）")
+            self._outstanding += 1
+            self._stats["submitted"] += 1
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{source_ext}") as temp_input:
+            temp_input.write(data)
+        job = TranscodeJob(temp_input.name, target_format,
+                           self.timeout if timeout is None else min(timeout, self.timeout))
+        job._on_finish = self._release
+        self._queue.put(job)
+        return job
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["outstanding"] = self._outstanding
+        stats.update(workers=self.workers, queue_depth=self.queue_depth)
+        return stats
+
+    def _release(self):
+        with self._stats_lock:
+            self._outstanding -= 1
+
+    def _count(self, name: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: TranscodeJob):
+        with job._lock:
+            if job.state == "cancelled":
+                self._count("cancelled")
+                return
+            job.state = "running"
+            job.started_at = time.monotonic()
+            try:
+                # -threads 1：并发由工作线程数控制，避免单个任务占满所有核
+                job._process = subprocess.Popen(
+                    [self.ffmpeg, "-v", "error", "-nostdin", "-threads", "1", "-i", job.input_path,
+                     "-vn", "-f", job.target_format, "pipe:1"],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                )
+            except OSError as e:
+                job.state, job.error = "failed", f"无法启动 ffmpeg: {e}"
+        if job._process is None:
+            self._count("failed")
+            job._finish()
+            return
+        self._count("running")
+        try:
+            output, stderr = job._process.communicate(timeout=job.timeout)
+            returncode = job._process.returncode
+        except subprocess.TimeoutExpired:
+            job._process.kill()
+            job._process.communicate()
+            output, stderr, returncode = b"", f"转码超过 {job.timeout:.0f} 秒".encode("utf-8"), -1
+        finally:
+            self._count("running", -1)
+
+        with job._lock:
+            if job.state == "cancelled":
+                outcome = "cancelled"
+            elif returncode == 0 and output:
+                job.state, job.output, outcome = "done", output, "done"
+            else:
+                job.state, outcome = "failed", "failed"
+                job.error = stderr.decode("utf-8", "replace").strip()[-300:] or f"ffmpeg 退出码 {returncode}"
+            job._process = None
+        self._count(outcome)
+        job._finish()
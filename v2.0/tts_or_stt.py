@@ -1,15 +1,31 @@
 import streamlit as st
 import requests
-from requests_toolbelt.multipart.encoder import MultipartEncoder
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 import os
 import subprocess
-from pydub import AudioSegment
 import tempfile
 import json
 import io
 import base64
 import time
 import random
+import threading
+import atexit
+import uuid
+from job_timing import JobTimer
+import tracing
+from transcode_pool import TranscodePool, TranscodeError, TranscodeQueueFull
+from result_store import ResultStore
+from single_flight import SingleFlight, SharedResponse, request_signature
+from hedging import HedgePolicy
+from deadlines import Deadline, DeadlineExceeded, ThroughputModel
+from speech_jobs import AUDIO_MIME_TYPES, stt_cost, tts_cost
+from billing import yuan_to_cents
+from job_checkpoints import CheckpointStore, UnitFailed, STT_UNIT_SECONDS, TTS_UNIT_CHARS, audio_duration
+
+# 上游 API 和密钥服务地址，可通过环境变量指向本地替身服务器（见 fake_siliconflow.py）
+SILICONFLOW_BASE_URL = os.environ.get("SILICONFLOW_BASE_URL", "https://api.siliconflow.cn/v1").rstrip("/")
+KMS_BASE_URL = os.environ.get("KMS_BASE_URL", "http://localhost:8503").rstrip("/")
 
 # ---------------------- 主密钥管理器 ----------------------
 class MasterKeyManager:
@@ -37,47 +53,547 @@ class MasterKeyManager:
             raise ValueError("主密钥池为空，请检查 master_keys.json 文件")
         return random.choice(self.master_keys)
 
+    def get_alternate_master_key(self, exclude: str):
+        """随机获取一个与 exclude 不同的主密钥（用于对冲请求），池中没有其他密钥时返回 None"""
+        candidates = [key for key in self.master_keys if key != exclude]
+        return random.choice(candidates) if candidates else None
+
 # ---------------------- 密钥管理系统集成 ----------------------
 class KeyManagementClient:
-    def __init__(self, base_url="http://localhost:8503"):
+    def __init__(self, base_url="http://localhost:8503", balance_ttl: float = 5.0, balance_max_stale: float = 60.0,
+                 lease_amount: float = 5.0, lease_ttl: float = 300.0, lease_flush_interval: float = 10.0,
+                 timeout: float = 3.0, max_retries: int = 2, read_urls=None):
         self.base_url = base_url
         self.api_url = f"{base_url}/api"
+        # 只读副本地址：余额查询轮流发往副本，副本不可用或未同步时改查主节点；写操作发往当前主节点
+        self.read_urls = [url.rstrip("/") for url in (read_urls or [])]
+        self._read_index = 0
+        # 当前主节点（初始为 base_url）：副本拒绝写操作时按返回的 leader 切换；主节点连接失败时在 base_url 和
+        # 只读副本中重新查找不是 follower 的节点（故障切换后被提升的副本），不需要修改配置或重启前端
+        self.leader_url = base_url.rstrip("/")
+        self._leader_candidates = list(dict.fromkeys([self.leader_url] + self.read_urls))
+        # 写操作都带幂等键，超时后可以安全地快速重试
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # 余额缓存：balance_ttl 秒内直接返回缓存；超过后用 ETag 向服务器确认；
+        # 密钥服务不可用时，balance_max_stale 秒内的缓存仍可作为过期结果返回
+        self.balance_ttl = balance_ttl
+        self.balance_max_stale = balance_max_stale
+        self._balance_cache = {}
+        self._cache_lock = threading.Lock()
+        self._cache_stats = {"hits": 0, "revalidated": 0, "misses": 0, "stale": 0}
+        # 预付额度租约：每个子密钥一个本地租约，额度内的扣费/退款不访问密钥服务，
+        # 由后台线程定期批量上报累计用量；lease_amount 为 0 时关闭
+        self.lease_cents = yuan_to_cents(lease_amount)
+        self.lease_ttl = lease_ttl
+        self.lease_flush_interval = lease_flush_interval
+        self._leases = {}
+        # _lease_lock 只保护 _leases 和 _sub_key_locks 两个字典，持有时不访问网络；
+        # 换租约、上报用量等需要访问密钥服务的操作持有该子密钥自己的锁，密钥服务变慢时不会阻塞其他子密钥
+        self._lease_lock = threading.Lock()
+        self._sub_key_locks = {}
+        if self.lease_cents > 0:
+            threading.Thread(target=self._lease_flusher, daemon=True).start()
+            atexit.register(self.release_all_leases)
+    
+    def _post(self, endpoint: str, payload: dict, headers=None, deadline=None, read=False):
+        """POST 到密钥服务，连接失败或超时时按指数退避重试；任务内的请求带上 traceparent，
+        传入任务期限时超时和重试都不超过剩余时间；read=True 的查询先发往只读副本"""
+        traceparent = tracing.current_traceparent()
+        if traceparent:
+            headers = dict(headers or {}, traceparent=traceparent)
+        if read and self.read_urls:
+            response = self._post_replica(endpoint, payload, headers)
+            if response is not None:
+                return response
+        for attempt in range(self.max_retries + 1):
+            if deadline is not None:
+                deadline.check("密钥服务")
+            leader = self.leader_url
+            try:
+                response = requests.post(
+                    f"{leader}/api/{endpoint}",
+                    json=payload,
+                    headers=headers,
+                    timeout=deadline.cap(self.timeout) if deadline is not None else self.timeout
+                )
+                # 密钥服务饱和时返回 503 + Retry-After，被拒绝的请求没有执行，按提示等待（加随机抖动）后重试
+                if response.status_code == 503 and attempt < self.max_retries:
+                    try:
+                        wait = min(float(response.headers.get("Retry-After", 1)), 5.0) * random.uniform(1.0, 1.5)
+                    except ValueError:
+                        wait = 1.0
+                    if deadline is None or deadline.remaining() > wait:
+                        time.sleep(wait)
+                        continue
+                # 请求落到了副本上（主节点已切换）：副本没有执行该请求，换到它指出的主节点或重新查找后立即重发
+                if attempt < self.max_retries and b'"leader"' in response.content:
+                    hint = self._leader_hint(response)
+                    if hint is not None and ((hint and hint != leader) or self._discover_leader(leader, deadline)):
+                        continue
+                return response
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if isinstance(e, requests.exceptions.ConnectionError):
+                    self._discover_leader(leader, deadline)
+                backoff = 0.1 * (2 ** attempt)
+                if attempt == self.max_retries or (deadline is not None and deadline.remaining() <= backoff):
+                    raise
+                time.sleep(backoff)
+    
+    def _set_leader(self, url: str):
+        url = url.rstrip("/")
+        if url != self.leader_url:
+            print(f"密钥服务主节点切换: {self.leader_url} -> {url}")
+            self.leader_url = url
+            self.api_url = f"{url}/api"
+            if url not in self._leader_candidates:
+                self._leader_candidates.append(url)
+    
+    def _leader_hint(self, response):
+        """副本拒绝写操作时切换到其主节点并返回该地址（副本不知道主节点时为空字符串），其他响应返回 None"""
+        try:
+            result = response.json()
+        except ValueError:
+            return None
+        if not isinstance(result, dict) or result.get("success") or "leader" not in result:
+            return None
+        hint = (result["leader"] or "").rstrip("/")
+        if hint:
+            self._set_leader(hint)
+        return hint
+    
+    def _discover_leader(self, failed: str, deadline=None) -> bool:
+        """当前主节点 failed 不可用或已是副本时，依次检查其他候选节点的 /health，切换到第一个不是 follower 的节点"""
+        for url in self._leader_candidates:
+            if url == failed:
+                continue
+            try:
+                health = requests.get(f"{url}/health",
+                                      timeout=deadline.cap(self.timeout) if deadline is not None else self.timeout).json()
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+            if isinstance(health, dict) and health.get("role") in ("leader", "standalone"):
+                self._set_leader(url)
+                return True
+        return False
+    
+    def _post_replica(self, endpoint: str, payload: dict, headers=None):
+        """向下一个只读副本发送查询，不重试；失败或副本返回 503（未同步/饱和）时返回 None，由调用方改查主节点"""
+        with self._cache_lock:
+            replica = self.read_urls[self._read_index % len(self.read_urls)]
+            self._read_index += 1
+        try:
+            response = requests.post(f"{replica}/api/{endpoint}", json=payload, headers=headers, timeout=self.timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            return None
+        return response if response.status_code != 503 else None
+    
+    def _store_balance(self, sub_key: str, balance: float, etag=None):
+        """写入余额缓存（扣费/退款结果直接写穿）"""
+        with self._cache_lock:
+            self._balance_cache[sub_key] = {
+                "balance": balance,
+                "etag": etag,
+                "fetched_at": time.monotonic()
+            }
+    
+    def _count(self, name: str):
+        with self._cache_lock:
+            self._cache_stats[name] += 1
+    
+    def cache_stats(self) -> dict:
+        """余额缓存命中统计"""
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+        total = sum(stats.values())
+        stats["hit_rate"] = (stats["hits"] + stats["revalidated"]) / total if total else 0.0
+        return stats
     
-    def validate_and_deduct(self, sub_key: str, amount: float = 1.0) -> dict:
-        """验证子密钥并扣除余额"""
+    def _sub_key_lock(self, sub_key: str):
+        with self._lease_lock:
+            lock = self._sub_key_locks.get(sub_key)
+            if lock is None:
+                lock = self._sub_key_locks[sub_key] = threading.Lock()
+            return lock
+    
+    def _lease_remaining(self, sub_key: str) -> int:
+        with self._lease_lock:
+            lease = self._leases.get(sub_key)
+            return lease["granted"] - lease["used"] if lease else 0
+    
+    def _set_lease(self, sub_key: str, lease):
+        with self._lease_lock:
+            if lease is None:
+                self._leases.pop(sub_key, None)
+            else:
+                self._leases[sub_key] = lease
+    
+    def _with_lease(self, sub_key: str, balance: float) -> float:
+        """服务器余额不含本进程持有的租约额度，展示时加回未用部分"""
+        return round(balance + self._lease_remaining(sub_key) / 100, 2)
+    
+    def _acquire_lease(self, sub_key: str, cents: int, deadline=None):
+        try:
+            response = self._post("leases/acquire", {
+                "sub_key": sub_key,
+                "amount": max(cents, self.lease_cents) / 100,
+                "ttl": self.lease_ttl,
+                "idempotency_key": uuid.uuid4().hex
+            }, deadline=deadline)
+            result = response.json()
+        except Exception:
+            return None
+        if not result.get("success"):
+            return None
+        self._store_balance(sub_key, result["new_balance"])
+        return {
+            "lease_id": result["lease_id"],
+            "granted": yuan_to_cents(result["granted"]),
+            "used": 0,
+            "reported": 0,
+            "expires_at": time.monotonic() + result["ttl"]
+        }
+    
+    def _reconcile_lease(self, sub_key: str, lease: dict, release: bool) -> bool:
+        """上报租约累计用量（调用方持有该子密钥的锁）。租约在服务器端已结算（settled：此前的释放请求已生效，
+        或已过期回收）时，服务器返回结算时的用量，只有超出这部分的用量改为直接扣费；
+        扣费失败时保留未上报的用量，下次再试"""
+        used = lease["used"]
         try:
-            response = requests.post(
-                f"{self.api_url}/validate_and_deduct",
-                json={"sub_key": sub_key, "amount": amount},
-                timeout=10
-            )
+            response = self._post("leases/reconcile", {
+                "lease_id": lease["lease_id"],
+                "used": used / 100,
+                "release": release
+            })
+            result = response.json()
+        except Exception:
+            return False
+        if result.get("success") and result.get("settled"):
+            # 不再在本地额度内扣费；重试的释放请求在这里得到首次的结算结果，用量相同，不会再扣一次
+            lease["granted"] = used
+            lease["reported"] = min(used, yuan_to_cents(result["used"]))
+            self._store_balance(sub_key, result["new_balance"])
+            return self._catch_up_unreported(sub_key, lease)
+        if result.get("success"):
+            lease["reported"] = used
+            if result.get("closed"):
+                # 服务器已关闭租约（如子密钥已停用），不再在本地额度内扣费
+                lease["granted"] = used
+            self._store_balance(sub_key, result["new_balance"])
+            return True
+        if "租约不存在" in result.get("error", ""):
+            # 结算记录已清理或子密钥已删除，用量固定下来等待补扣
+            lease["granted"] = used
+            return self._catch_up_unreported(sub_key, lease)
+        return False
+    
+    def _catch_up_unreported(self, sub_key: str, lease: dict) -> bool:
+        """租约已在服务器端关闭后，把未计入租约的用量直接扣费"""
+        used = lease["used"]
+        if used > lease["reported"]:
+            # 连接失败时保留幂等键，下次补扣即使上次已在服务器生效也不会重复扣费；
+            # 服务器明确拒绝（如余额不足）时结果已按该键缓存，下次换新键
+            idempotency_key = lease.setdefault("catchup_key", uuid.uuid4().hex)
+            deducted = self.validate_and_deduct(sub_key, (used - lease["reported"]) / 100,
+                                                idempotency_key=idempotency_key)
+            if not deducted.get("success"):
+                if not deducted.get("error", "").startswith("密钥服务连接失败"):
+                    lease.pop("catchup_key", None)
+                print(f"租约 {lease['lease_id']} 已关闭，补扣 {(used - lease['reported']) / 100:.2f} 元失败: "
+                      f"{deducted.get('error')}")
+                return False
+        lease.pop("catchup_key", None)
+        lease["reported"] = used
+        return True
+    
+    def _lease_flusher(self):
+        """后台批量上报用量，并在到期前释放租约"""
+        while True:
+            time.sleep(self.lease_flush_interval)
+            margin = 2 * self.lease_flush_interval
+            with self._lease_lock:
+                sub_keys = list(self._leases)
+            for sub_key in sub_keys:
+                with self._sub_key_lock(sub_key):
+                    lease = self._leases.get(sub_key)
+                    if lease is None:
+                        continue
+                    if lease["expires_at"] - time.monotonic() < margin:
+                        if self._reconcile_lease(sub_key, lease, release=True):
+                            self._set_lease(sub_key, None)
+                    elif lease["used"] > lease["reported"]:
+                        self._reconcile_lease(sub_key, lease, release=False)
+    
+    def release_all_leases(self):
+        """释放全部租约（进程退出时调用）"""
+        with self._lease_lock:
+            sub_keys = list(self._leases)
+        for sub_key in sub_keys:
+            with self._sub_key_lock(sub_key):
+                lease = self._leases.get(sub_key)
+                if lease and self._reconcile_lease(sub_key, lease, release=True):
+                    self._set_lease(sub_key, None)
+    
+    def charge(self, sub_key: str, amount: float, deadline=None) -> dict:
+        """扣费：优先在本地租约额度内扣除，额度不足或即将到期时换新租约，租约不可用时直接扣费；
+        deadline 为任务期限，访问密钥服务时只使用剩余时间（退款不受期限限制）"""
+        cents = yuan_to_cents(amount)
+        if self.lease_cents <= 0 or cents <= 0:
+            return self.validate_and_deduct(sub_key, amount, deadline=deadline)
+        
+        with self._sub_key_lock(sub_key):
+            lease = self._leases.get(sub_key)
+            if lease and (lease["granted"] - lease["used"] < cents or
+                          lease["expires_at"] - time.monotonic() < 2 * self.lease_flush_interval):
+                if not self._reconcile_lease(sub_key, lease, release=True):
+                    return self.validate_and_deduct(sub_key, amount, deadline=deadline)
+                self._set_lease(sub_key, None)
+                lease = None
+            
+            if lease is None:
+                lease = self._acquire_lease(sub_key, cents, deadline)
+                if lease is None:
+                    return self.validate_and_deduct(sub_key, amount, deadline=deadline)
+                self._set_lease(sub_key, lease)
+                if lease["granted"] < cents:
+                    # 余额不足一个完整租约时退回，由服务器给出准确的错误信息
+                    if self._reconcile_lease(sub_key, lease, release=True):
+                        self._set_lease(sub_key, None)
+                    return self.validate_and_deduct(sub_key, amount, deadline=deadline)
+            
+            with self._lease_lock:
+                lease["used"] += cents
+            lease_id = lease["lease_id"]
+        
+        with self._cache_lock:
+            cached = self._balance_cache.get(sub_key)
+        new_balance = self._with_lease(sub_key, cached["balance"] if cached else 0.0)
+        return {"success": True, "new_balance": new_balance, "action": "deduct", "lease_id": lease_id}
+    
+    def refund(self, sub_key: str, amount: float, charge_result=None) -> dict:
+        """退还 charge 扣除的费用：用量尚未上报时直接冲减本地租约，否则向服务器退款"""
+        cents = yuan_to_cents(amount)
+        lease_id = (charge_result or {}).get("lease_id")
+        if lease_id:
+            with self._sub_key_lock(sub_key):
+                lease = self._leases.get(sub_key)
+                if lease and lease["lease_id"] == lease_id and lease["used"] - cents >= lease["reported"]:
+                    with self._lease_lock:
+                        lease["used"] -= cents
+                    with self._cache_lock:
+                        cached = self._balance_cache.get(sub_key)
+                    new_balance = self._with_lease(sub_key, cached["balance"] if cached else 0.0)
+                    return {"success": True, "new_balance": new_balance, "action": "refund"}
+        return self.validate_and_deduct(sub_key, -amount)
+    
+    def validate_and_deduct(self, sub_key: str, amount: float = 1.0, idempotency_key=None, deadline=None) -> dict:
+        """验证子密钥并扣除余额（重试使用同一幂等键，不会重复扣费）"""
+        try:
+            response = self._post("validate_and_deduct", {
+                "sub_key": sub_key,
+                "amount": amount,
+                "idempotency_key": idempotency_key or uuid.uuid4().hex
+            }, deadline=deadline)
             result = response.json()
             # 确保余额字段是两位小数
             if result.get("success") and "new_balance" in result:
                 result["new_balance"] = float(f"{result['new_balance']:.2f}")
+                self._store_balance(sub_key, result["new_balance"])
+                result["new_balance"] = self._with_lease(sub_key, result["new_balance"])
             return result
         except Exception as e:
             return {"success": False, "error": f"密钥服务连接失败: {str(e)}"}
     
-    def get_balance(self, sub_key: str) -> dict:
-        """查询子密钥余额"""
+    def get_balance(self, sub_key: str, max_age=None) -> dict:
+        """查询子密钥余额（max_age 覆盖默认的缓存有效期，0 表示强制向服务器确认）"""
+        ttl = self.balance_ttl if max_age is None else max_age
+        with self._cache_lock:
+            cached = self._balance_cache.get(sub_key)
+        age = time.monotonic() - cached["fetched_at"] if cached else None
+        
+        if cached and age <= ttl:
+            self._count("hits")
+            return {"success": True, "balance": self._with_lease(sub_key, cached["balance"]), "cached": True}
+        
         try:
-            response = requests.post(
-                f"{self.api_url}/get_balance",
-                json={"sub_key": sub_key},
-                timeout=10
-            )
+            headers = {}
+            if cached and cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            response = self._post("get_balance", {"sub_key": sub_key}, headers=headers, read=True)
+            if response.status_code == 304 and cached:
+                self._count("revalidated")
+                self._store_balance(sub_key, cached["balance"], cached["etag"])
+                return {"success": True, "balance": self._with_lease(sub_key, cached["balance"]), "cached": True}
+            
+            self._count("misses")
             result = response.json()
             # 确保余额字段是两位小数
             if result.get("success") and "balance" in result:
                 result["balance"] = float(f"{result['balance']:.2f}")
+                self._store_balance(sub_key, result["balance"], response.headers.get("ETag"))
+                result["balance"] = self._with_lease(sub_key, result["balance"])
+            else:
+                with self._cache_lock:
+                    self._balance_cache.pop(sub_key, None)
             return result
         except Exception as e:
+            if cached and age <= self.balance_max_stale:
+                self._count("stale")
+                return {"success": True, "balance": self._with_lease(sub_key, cached["balance"]), "cached": True, "stale": True}
+            self._count("misses")
             return {"success": False, "error": f"密钥服务连接失败: {str(e)}"}
 
 # 初始化主密钥管理器和密钥客户端
 master_key_manager = MasterKeyManager()
-kms_client = KeyManagementClient()
+
+@st.cache_resource
+def get_kms_client():
+    """跨重新运行和会话共享密钥客户端及其余额缓存"""
+    return KeyManagementClient(
+        base_url=KMS_BASE_URL,
+        balance_ttl=float(os.environ.get("KMS_BALANCE_TTL", 5.0)),
+        balance_max_stale=float(os.environ.get("KMS_BALANCE_MAX_STALE", 60.0)),
+        lease_amount=float(os.environ.get("KMS_LEASE_AMOUNT", 5.0)),
+        lease_ttl=float(os.environ.get("KMS_LEASE_TTL", 300.0)),
+        read_urls=[url.strip() for url in os.environ.get("KMS_READ_URLS", "").split(",") if url.strip()]
+    )
+
+kms_client = get_kms_client()
+
+@st.cache_resource
+def get_transcode_pool():
+    """所有会话共用的转码池，并发数和排队上限见 transcode_pool.py 的环境变量"""
+    return TranscodePool()
+
+transcode_pool = get_transcode_pool()
+
+@st.cache_resource
+def get_result_store():
+    """生成和转换结果的磁盘暂存区，会话状态中只保存句柄"""
+    return ResultStore()
+
+result_store = get_result_store()
+
+@st.cache_resource
+def get_coalescer():
+    """所有会话共用的请求合并器，相同签名的并发请求只调用一次上游"""
+    return SingleFlight()
+
+coalescer = get_coalescer()
+
+@st.cache_resource
+def get_hedger():
+    """所有会话共用的对冲策略，延迟分位数和对冲额度按全部请求统计（HEDGE_ENABLED=1 时启用）"""
+    return HedgePolicy()
+
+hedger = get_hedger()
+
+@st.cache_resource
+def get_throughput_model():
+    """按主密钥记录上游实测吞吐，用于推算各次调用的超时"""
+    return ThroughputModel()
+
+throughput_model = get_throughput_model()
+
+@st.cache_resource
+def get_checkpoint_store():
+    """长任务的断点目录，所有会话共用；同一任务同一时间只允许一个会话处理"""
+    return CheckpointStore()
+
+checkpoint_store = get_checkpoint_store()
+
+# 合并请求的计费策略：each 每个请求照常计费；leader 只由实际调用上游的请求付费，共享结果的请求退款
+COALESCE_BILLING = os.environ.get("COALESCE_BILLING", "each")
+
+def settle_coalesced(sub_key: str, timer: JobTimer):
+    """按计费策略处理共享了其他会话结果的请求"""
+    if COALESCE_BILLING != "leader":
+        st.info("🔗 相同的请求正在处理中，本次直接共享了其结果")
+        return
+    with st.spinner("🔄 正在退还费用..."), timer.span("refund", reason="coalesced"):
+        refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
+    if refund_result["success"]:
+        st.session_state.current_balance = refund_result.get("new_balance")
+        st.success(f"🔗 已共享相同请求的结果，本次费用已退还！当前余额: {st.session_state.current_balance:.2f}")
+    else:
+        st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
+
+def replace_result(state_key: str, handle=None):
+    """用新句柄替换会话中的旧结果，并删除旧结果文件"""
+    old_handle = st.session_state.get(state_key)
+    if old_handle and old_handle != handle:
+        result_store.delete(old_handle)
+    st.session_state[state_key] = handle
+
+def run_checkpointed_job(job, sub_key: str, timer: JobTimer, send_unit):
+    """逐段处理断点任务中未完成的部分并显示进度，每段单独扣费，失败时只退还该段；
+    返回 (任务状态, 合并后的结果文件路径)，失败时路径为 None，已完成的段保留在断点中"""
+    if not checkpoint_store.acquire(job.job_id):
+        st.warning("⚠️ 相同的任务正在另一个页面中处理，请稍后再试")
+        return "busy", None
+    try:
+        done, total = job.progress()
+        timer.attrs.update(units=total, units_resumed=done)
+        if done:
+            st.info(f"♻️ 发现未完成的任务：已完成 {done}/{total} 段，从第 {done + 1} 段继续，已完成的部分不会重复处理和扣费")
+        else:
+            st.info(f"📦 内容较长，将分 {total} 段处理并逐段保存进度")
+        progress_bar = st.progress(done / total)
+        status_text = st.empty()
+        
+        def charge(amount, idempotency_key):
+            # 断点任务不走租约，直接带幂等键扣费：扣费后中断再继续时重放原扣费而不是再扣一次
+            with timer.span("kms_deduct"):
+                result = kms_client.validate_and_deduct(sub_key, amount, idempotency_key=idempotency_key)
+            if result.get("success"):
+                st.session_state.current_balance = result.get("new_balance")
+            return result
+        
+        def refund(amount, idempotency_key):
+            with timer.span("refund"):
+                result = kms_client.validate_and_deduct(sub_key, -amount, idempotency_key=idempotency_key)
+            if result.get("success"):
+                st.session_state.current_balance = result.get("new_balance")
+            return bool(result.get("success"))
+        
+        def on_progress(done, total):
+            progress_bar.progress(done / total)
+            status_text.text(f"🔄 正在处理第 {done + 1}/{total} 段..." if done < total else "")
+        
+        result = job.run(send_unit, charge, refund, on_progress)
+        timer.attrs.update(units_done=result["done"], units_billed=round(result["charged_cents"] / 100, 2))
+        if result["success"]:
+            with timer.span("assemble"):
+                return "ok", job.assemble()
+        
+        if result["charge_failed"]:
+            status = "charge_failed"
+            st.error(f"❌ {result['error']}")
+            if "余额不足" in result["error"]:
+                st.info("💡 请前往密钥管理系统充值或使用其他有效子密钥")
+        else:
+            error = result["exception"]
+            status = ("deadline" if isinstance(error, DeadlineExceeded) else
+                      "timeout" if isinstance(error, requests.exceptions.Timeout) else
+                      "upstream_error" if isinstance(error, UnitFailed) else "error")
+            st.error(f"❌ 第 {result['unit'] + 1}/{result['total']} 段处理失败：{result['error']}")
+            if result["refunded"]:
+                st.success("💰 该段费用已退还")
+            else:
+                st.warning("⚠️ 该段费用退还失败，继续处理时该段不会再次扣费")
+        if result["done"]:
+            # 页面随后会重新运行，提示保存在会话中，下一次渲染时显示
+            st.session_state.checkpoint_notice = (f"📌 上次任务已完成 {result['done']}/{result['total']} 段并已保存，"
+                                                  f"重新提交相同内容即可从第 {result['done'] + 1} 段继续，已完成的部分不会重复扣费")
+        return status, None
+    finally:
+        checkpoint_store.release(job.job_id)
+
+def show_checkpoint_notice():
+    """显示上一次断点任务失败后留下的继续提示（只显示一次）"""
+    notice = st.session_state.pop("checkpoint_notice", None)
+    if notice:
+        st.info(notice)
 
 # ---------------------- 页面基础配置 ----------------------
 st.set_page_config(
@@ -137,6 +653,8 @@ with st.expander("ℹ️ 关于此工具", expanded=False):
 # 初始化会话状态
 if 'current_cost' not in st.session_state:
     st.session_state.current_cost = 0.0
+if 'current_charge' not in st.session_state:
+    st.session_state.current_charge = None
 if 'transcribed_text' not in st.session_state:
     st.session_state.transcribed_text = ""
 if 'transcription_done' not in st.session_state:
@@ -146,11 +664,11 @@ if 'copy_success' not in st.session_state:
 if 'current_file_name' not in st.session_state:
     st.session_state.current_file_name = None
 if 'converted_audio' not in st.session_state:
-    st.session_state.converted_audio = None
+    st.session_state.converted_audio = None  # 转换结果在暂存区中的句柄
 if 'conversion_performed' not in st.session_state:
     st.session_state.conversion_performed = False
 if 'generated_audio' not in st.session_state:
-    st.session_state.generated_audio = None
+    st.session_state.generated_audio = None  # 生成语音在暂存区中的句柄
 if 'generation_done' not in st.session_state:
     st.session_state.generation_done = False
 if 'current_text' not in st.session_state:
@@ -171,7 +689,37 @@ if 'tts_generation_in_progress' not in st.session_state:
 # 新增会话状态用于存储预估费用
 if 'estimated_cost' not in st.session_state:
     st.session_state.estimated_cost = None
+# 最近一次任务的分阶段耗时
+if 'last_job_timing' not in st.session_state:
+    st.session_state.last_job_timing = None
 
+def render_timing_panel(kind: str):
+    """在可折叠面板中显示最近一次任务的分阶段耗时"""
+    timing = st.session_state.last_job_timing
+    if not st.session_state.get("show_timing_panel") or not timing or timing["kind"] != kind:
+        return
+    with st.expander("⏱️ 性能详情", expanded=False):
+        total = timing["total_ms"] or 1
+        rows = [
+            {"阶段": stage["name"], "开始(ms)": stage["start_ms"], "耗时(ms)": stage["duration_ms"],
+             "占比": f"{stage['duration_ms'] / total:.1%}"}
+            for stage in timing["stages"]
+        ]
+        st.table(rows)
+        st.caption(f"任务 {timing['job_id'][:8]} | 链路 {timing['trace_id']} | 状态: {timing['status']} | 总耗时: {timing['total_ms']:.0f} ms"
+                   + (f" | 期限 {timing['deadline_s']:.0f}s，剩余 {timing['deadline_left_s']:.1f}s" if "deadline_s" in timing else ""))
+        stats = coalescer.stats()
+        st.caption(f"本次{'共享了相同请求的结果' if timing.get('coalesced') else '独立调用上游'} | "
+                   f"请求合并: 共享 {stats['hits']} 次 / 发起 {stats['leaders']} 次（命中率 {stats['hit_rate']:.1%}），"
+                   f"进行中 {stats['in_flight']}")
+        hedge_stats = hedger.stats()
+        if hedge_stats["enabled"]:
+            outcome = "对冲请求胜出" if timing.get("hedge_won") else ("已对冲，原请求胜出" if timing.get("hedged") else "未对冲")
+            delay = hedge_stats["delays"].get(kind)
+            st.caption(f"本次{outcome} | 对冲: {hedge_stats['hedged']} 次 / {hedge_stats['eligible']} 个短请求"
+                       f"（对冲胜出 {hedge_stats['hedge_wins']} 次，胜出率 {hedge_stats['hedge_win_rate']:.1%}；"
+                       f"额度不足 {hedge_stats['budget_denied']} 次）"
+                       + (f" | 当前对冲等待 {delay:.1f}s" if delay is not None else ""))
 
 # ---------------------- 侧边栏导航 ----------------------
 st.sidebar.title("导航栏")
@@ -203,6 +751,8 @@ if sub_key:
             if result["success"]:
                 st.session_state.current_balance = result["balance"]
                 st.session_state.balance_query_result = f"💰 当前余额: {result['balance']:.2f}"
+                if result.get("stale"):
+                    st.session_state.balance_query_result += "（密钥服务暂不可用，显示缓存余额）"
                 st.session_state.balance_error = None
             else:
                 st.session_state.balance_error = f"查询失败: {result['error']}"
@@ -218,6 +768,8 @@ if sub_key:
     if hasattr(st.session_state, 'balance_error') and st.session_state.balance_error:
         st.sidebar.error(st.session_state.balance_error)
 
+st.sidebar.checkbox("显示性能详情", value=False, key="show_timing_panel", help="任务完成后显示各阶段耗时")
+
 # 分割线
 st.sidebar.markdown("---")
 
@@ -294,7 +846,7 @@ if app_mode == "语音转文字":
         st.session_state.transcription_done = False
         st.session_state.copy_success = False
         st.session_state.current_file_name = audio_file.name
-        st.session_state.converted_audio = None
+        replace_result("converted_audio")
         st.session_state.conversion_performed = False
 
     # 显示已上传的音频信息（若有）
@@ -315,9 +867,7 @@ if app_mode == "语音转文字":
         st.write(f"文件大小：{round(audio_file.size / (1024*1024), 2)} MB")
         
         # 提前计算并显示预估费用
-        file_size_mb = audio_file.size / (1024 * 1024)
-        estimated_cost = file_size_mb * 0.50
-        estimated_cost = max(estimated_cost, 0.10)  # 最低 ¥0.10
+        estimated_cost = stt_cost(audio_file.size)
         
         # 保存预估费用到session state
         st.session_state.estimated_cost = estimated_cost
@@ -326,46 +876,68 @@ if app_mode == "语音转文字":
         st.info(f"💰 预估费用: ¥{estimated_cost:.2f} (按文件大小计算：¥0.50/MB，最低 ¥0.10)")
 
     # 格式转换功能
-    def convert_audio_format(audio_file, target_format="mp3"):
-        """将音频文件转换为目标格式"""
+    def convert_audio_format(audio_file, target_format="mp3", deadline=None):
+        """将音频文件交给转码池转换为目标格式，脚本线程只负责等待；排队和转换都不超过任务期限的剩余时间"""
         try:
-            # 创建临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{audio_file.name.split('.')[-1]}") as temp_input:
-                temp_input.write(audio_file.getvalue())
-                temp_input_path = temp_input.name
-            
-            # 创建输出临时文件
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{target_format}") as temp_output:
-                temp_output_path = temp_output.name
-            
-            # 使用pydub进行格式转换
-            audio = AudioSegment.from_file(temp_input_path)
-            audio.export(temp_output_path, format=target_format)
-            
-            # 读取转换后的文件
-            with open(temp_output_path, "rb") as f:
-                converted_data = f.read()
-            
-            # 清理临时文件
-            os.unlink(temp_input_path)
-            os.unlink(temp_output_path)
-                
+            job = transcode_pool.submit(audio_file.getvalue(), audio_file.name.split('.')[-1], target_format,
+                                        timeout=deadline.remaining() if deadline else None)
+        except TranscodeQueueFull:
+            st.error("当前转换任务较多，请稍后重试")
+            return None, None
+        
+        status_text = st.empty()
+        try:
+            # 每次刷新状态都是 Streamlit 的检查点：会话关闭或重新运行时在这里抛出异常，finally 中取消转码
+            while not job.wait(0.5):
+                if deadline and deadline.expired():
+                    raise TranscodeError("转换超过任务期限")
+                if job.state == "queued":
+                    status_text.text(f"⏳ 排队等待转换... {job.elapsed():.0f}s")
+                else:
+                    status_text.text(f"🔄 转换中... {job.elapsed():.0f}s")
+            converted_data = job.result()
+            status_text.empty()
             return converted_data, f"converted.{target_format}"
-        except Exception as e:
-            # 清理可能残留的临时文件
-            if 'temp_input_path' in locals() and os.path.exists(temp_input_path):
-                os.unlink(temp_input_path)
-            if 'temp_output_path' in locals() and os.path.exists(temp_output_path):
-                os.unlink(temp_output_path)
-                
+        except TranscodeError as e:
+            status_text.empty()
             st.error(f"音频格式转换失败: {str(e)}")
             return None, None
+        finally:
+            job.cancel()
+
+    def prepare_stt_checkpoint(audio_file, cost, timer):
+        """较长的音频拆成等长的若干段并建立断点，已有相同任务的断点时直接继续；
+        短音频或无法拆分时返回 None，按原流程整体转录"""
+        file_ext = audio_file.name.lower().split('.')[-1]
+        convert = file_ext in ['flac', 'm4a'] and convert_format and ffmpeg_available
+        params = {"model": model, "convert": convert}
+        job_id = checkpoint_store.job_id("stt", sub_key, params, audio_file.getvalue())
+        job = checkpoint_store.load(job_id)
+        # WAV 可直接按采样帧拆分，其他格式需要 FFmpeg
+        if job is not None or file_ext not in ['mp3', 'wav', 'flac', 'm4a'] or (file_ext != 'wav' and not ffmpeg_available):
+            return job
+        with timer.span("checkpoint_prepare"):
+            source = checkpoint_store.stage(job_id, audio_file.getvalue(), file_ext)
+            duration = audio_duration(source)
+            if not duration or duration <= STT_UNIT_SECONDS:
+                checkpoint_store.discard(job_id)
+                return None
+            if convert:
+                converted_data, _ = convert_audio_format(audio_file, "mp3")
+                if not converted_data:
+                    checkpoint_store.discard(job_id)
+                    return None
+                os.unlink(source)
+                source = checkpoint_store.stage(job_id, converted_data, "mp3")
+            return checkpoint_store.create_stt(job_id, source, params, yuan_to_cents(cost))
 
     # 转录功能区
     st.subheader("2. 开始语音转文字")
     
     # 费用说明
-    st.info("💡 未转录完成请勿刷新页面，否则将转录失败，且失败扣除的费用将无法返还")
+    st.info(f"💡 超过 {STT_UNIT_SECONDS / 60:.0f} 分钟的音频会分段转录并逐段保存进度：刷新页面或失败后重新上传同一文件并启动转录，"
+            "只处理剩余的段，已完成的部分不会重复扣费；较短的音频未转录完成请勿刷新页面")
+    show_checkpoint_notice()
     
     # 检查是否正在进行转录
     is_transcribing = st.session_state.get('transcription_in_progress', False)
@@ -389,15 +961,63 @@ if app_mode == "语音转文字":
             st.session_state.transcription_in_progress = False
             st.rerun()
         
+        timer = JobTimer("stt", file_size=audio_file.size, file_ext=audio_file.name.lower().split('.')[-1])
+        deadline = Deadline()
+        job_status = "error"
+        
         # 使用之前计算的费用
         actual_cost = st.session_state.estimated_cost
         
         # 显示费用信息
         st.info(f"📊 音频文件大小: {audio_file.size / (1024 * 1024):.2f} MB | 实际费用: ¥{actual_cost:.2f}")
 
+        # 较长的音频分段转录并保存进度，失败或刷新后重新提交只处理剩余的段
+        checkpoint_job = prepare_stt_checkpoint(audio_file, actual_cost, timer)
+        if checkpoint_job is not None:
+            try:
+                def send_unit(unit, input_path, output_path):
+                    """转录一段音频并把文字写入该段的结果文件；每段有独立的任务期限"""
+                    unit_deadline = Deadline()
+                    master_key = master_key_manager.get_random_master_key()
+                    unit_ext = input_path.rsplit('.', 1)[-1]
+                    upload_size = os.path.getsize(input_path)
+                    started = timer.now()
+                    try:
+                        with open(input_path, "rb") as unit_file:
+                            multipart_data = MultipartEncoder(fields={
+                                "file": (f"part{unit['index'] + 1}.{unit_ext}", unit_file, AUDIO_MIME_TYPES.get(unit_ext, "audio/mpeg")),
+                                "model": model
+                            })
+                            response = requests.post(
+                                url=f"{SILICONFLOW_BASE_URL}/audio/transcriptions",
+                                headers={"Authorization": f"Bearer {master_key}", "Content-Type": multipart_data.content_type,
+                                         "traceparent": timer.traceparent()},
+                                data=multipart_data,
+                                timeout=throughput_model.timeouts(master_key, "stt", upload_size, unit_deadline)
+                            )
+                    finally:
+                        timer.add_stage("unit", started, timer.now(), index=unit["index"], bytes=upload_size)
+                    if response.status_code != 200:
+                        raise UnitFailed(f"错误码 {response.status_code}，{response.text}")
+                    throughput_model.observe(master_key, "stt", upload_size, timer.now() - started)
+                    with open(output_path, "w", encoding="utf-8") as f:
+                        f.write(response.json().get("text", ""))
+                
+                job_status, result_path = run_checkpointed_job(checkpoint_job, sub_key, timer, send_unit)
+                if result_path:
+                    with open(result_path, "r", encoding="utf-8") as f:
+                        st.session_state.transcribed_text = f.read()
+                    st.session_state.transcription_done = True
+                    checkpoint_job.delete()
+                    st.success("🎉 转录完成！")
+            finally:
+                st.session_state.last_job_timing = timer.finish(job_status, checkpointed=True)
+                st.session_state.transcription_in_progress = False
+                st.rerun()
+
         # 先验证子密钥并扣除费用
-        with st.spinner("🔑 验证子密钥中..."):
-            deduction_result = kms_client.validate_and_deduct(sub_key, amount=actual_cost)
+        with st.spinner("🔑 验证子密钥中..."), timer.span("kms_deduct"):
+            deduction_result = kms_client.charge(sub_key, amount=actual_cost, deadline=deadline)
             
             if not deduction_result["success"]:
                 st.error(f"❌ {deduction_result['error']}")
@@ -414,6 +1034,7 @@ if app_mode == "语音转文字":
             
             # 保存当前费用用于可能的退款
             st.session_state.current_cost = actual_cost
+            st.session_state.current_charge = deduction_result
     
         # 确定最终要使用的音频文件
         final_audio = audio_file
@@ -425,11 +1046,12 @@ if app_mode == "语音转文字":
         
         # 如果是FLAC或M4A文件且选择了自动转换
         if file_ext in ['flac', 'm4a'] and convert_format and ffmpeg_available:
-            with st.spinner(f"🔄 正在转换{file_ext.upper()}到MP3格式..."):
-                converted_data, converted_name = convert_audio_format(audio_file, "mp3")
+            with st.spinner(f"🔄 正在转换{file_ext.upper()}到MP3格式..."), timer.span("convert"):
+                converted_data, converted_name = convert_audio_format(audio_file, "mp3", deadline)
                 if converted_data:
-                    st.session_state.converted_audio = converted_data
-                    final_audio = converted_data
+                    replace_result("converted_audio", result_store.put(converted_data, "mp3"))
+                    del converted_data
+                    final_audio = result_store.path(st.session_state.converted_audio)
                     final_filename = converted_name
                     conversion_performed = True
                     st.session_state.conversion_performed = True
@@ -445,33 +1067,14 @@ if app_mode == "语音转文字":
             st.rerun()
         
         # 转录处理 - 使用主密钥调用SiliconFlow API
-        api_url = "https://api.siliconflow.cn/v1/audio/transcriptions"
+        api_url = f"{SILICONFLOW_BASE_URL}/audio/transcriptions"
         headers = {
             "Authorization": f"Bearer {siliconflow_master_key}",  # 使用随机选择的主密钥
         }
 
         try:
-            # 构建请求体
-            if conversion_performed:
-                # 处理转换后的音频数据
-                multipart_data = MultipartEncoder(
-                    fields={
-                        "file": (final_filename, final_audio, "audio/mpeg"),
-                        "model": model
-                    }
-                )
-            else:
-                # 处理原始上传的文件
-                multipart_data = MultipartEncoder(
-                    fields={
-                        "file": (final_filename, final_audio.getvalue(), final_audio.type),
-                        "model": model
-                    }
-                )
-                
-            headers["Content-Type"] = multipart_data.content_type
-
             # 发送请求
+            progress_started = timer.now()
             progress_bar = st.progress(0)
             status_text = st.empty()
             
@@ -479,13 +1082,77 @@ if app_mode == "语音转文字":
                 progress_bar.progress(percent)
                 status_text.text(f"🔄 转录中... {percent}%")
                 time.sleep(0.1)  # 模拟进度
+            timer.add_stage("progress_ui", progress_started, timer.now())
+            
+            upload_size = os.path.getsize(final_audio) if conversion_performed else final_audio.size
+            
+            def transcribe():
+                """调用 SiliconFlow 转录；同一音频的并发请求只由第一个会话执行，响应过慢时用另一个主密钥对冲"""
+                def send(attempt):
+                    # 每份请求单独构建请求体（暂存文件流只能读取一次）；对冲请求的阶段加 hedge_ 前缀
+                    prefix = "hedge_" if attempt.hedge else ""
+                    if attempt.hedge:
+                        timer.attrs["hedged"] = True
+                    build_start = timer.now()
+                    upload_file = None
+                    if conversion_performed:
+                        # 处理转换后的音频数据（从暂存文件流式上传）
+                        upload_file = open(final_audio, "rb")
+                        fields = {"file": (final_filename, upload_file, "audio/mpeg"), "model": model}
+                    else:
+                        # 处理原始上传的文件
+                        fields = {"file": (final_filename, final_audio.getvalue(), final_audio.type), "model": model}
+                    multipart_data = MultipartEncoder(fields=fields)
+                    attempt_headers = dict(headers, Authorization=f"Bearer {attempt.master_key}",
+                                           traceparent=timer.traceparent(attempt.span_id))
+                    attempt_headers["Content-Type"] = multipart_data.content_type
+                    timer.add_stage(f"{prefix}multipart_build", build_start, timer.now())
+                    
+                    # 通过读取进度区分上传耗时和 SiliconFlow 处理耗时；请求落败或超过任务期限时在下一次读取时中止上传
+                    upload_done = []
+                    def on_read(monitor):
+                        attempt.check()
+                        deadline.check("上传音频")
+                        if monitor.bytes_read >= monitor.len and not upload_done:
+                            upload_done.append(timer.now())
+                    
+                    request_started = timer.now()
+                    try:
+                        # 超时按音频大小和该主密钥最近的吞吐推算，并限制在任务期限内；预计来不及时直接失败
+                        response = requests.post(
+                            url=api_url,
+                            headers=attempt_headers,
+                            data=MultipartEncoderMonitor(multipart_data, on_read),
+                            timeout=throughput_model.timeouts(attempt.master_key, "stt", upload_size, deadline)
+                        )
+                        if response.status_code == 200:
+                            throughput_model.observe(attempt.master_key, "stt", upload_size, timer.now() - request_started)
+                        return response
+                    except requests.exceptions.Timeout:
+                        throughput_model.count("timeouts")
+                        raise
+                    finally:
+                        request_finished = timer.now()
+                        if upload_file:
+                            upload_file.close()
+                        # 落败被取消的请求不计入阶段耗时
+                        if not attempt.cancelled.is_set():
+                            upload_end = upload_done[0] if upload_done else request_finished
+                            timer.add_stage(f"{prefix}upload", request_started, upload_end, span_id=attempt.span_id, bytes=multipart_data.len)
+                            if upload_done:
+                                timer.add_stage(f"{prefix}siliconflow", upload_done[0], request_finished)
                 
-            response = requests.post(
-                url=api_url,
-                headers=headers,
-                data=multipart_data,
-                timeout=300
-            )
+                response, winner, _ = hedger.call("stt", upload_size, send, siliconflow_master_key,
+                                                  master_key_manager.get_alternate_master_key)
+                timer.attrs["hedge_won"] = winner.hedge
+                return SharedResponse.from_response(response)
+            
+            call_started = timer.now()
+            signature = request_signature("stt", model, conversion_performed, audio_file.getvalue())
+            response, coalesced = coalescer.do(signature, transcribe)
+            timer.attrs["coalesced"] = coalesced
+            if coalesced:
+                timer.add_stage("coalesced_wait", call_started, timer.now())
 
             progress_bar.progress(100)
             status_text.text("")
@@ -494,19 +1161,23 @@ if app_mode == "语音转文字":
                 result = response.json()
                 st.session_state.transcribed_text = result.get("text", "")
                 st.session_state.transcription_done = True
+                job_status = "ok"
                 st.success("🎉 转录完成！")
+                if coalesced:
+                    settle_coalesced(sub_key, timer)
                 
                 # 显示转换状态
                 if conversion_performed:
                     st.info(f"📝 注：{file_ext.upper()}格式已自动转换为MP3进行转录")
             else:
+                job_status = "upstream_error"
                 st.error(f"❌ 转录失败！  \n错误码：{response.status_code}  \n错误信息：{response.text}")
                 if "unsupported format" in response.text.lower():
                     st.info("💡 检测到格式不支持错误，请尝试启用'自动转换格式到MP3'选项")
                 
                 # 如果API调用失败，退还费用
-                with st.spinner("🔄 正在退还费用..."):
-                    refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+                with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                    refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
                 
                 if refund_result["success"]:
                     st.session_state.current_balance = refund_result.get("new_balance")
@@ -514,12 +1185,26 @@ if app_mode == "语音转文字":
                 else:
                     st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
 
+        except DeadlineExceeded as e:
+            job_status = "deadline"
+            st.error(f"❌ 转录未能在期限内完成：{str(e)}")
+            
+            # 超过任务期限，退还费用
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
+            
+            if refund_result["success"]:
+                st.session_state.current_balance = refund_result.get("new_balance")
+                st.success(f"💰 已成功退还费用！当前余额: {st.session_state.current_balance:.2f}")
+            else:
+                st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
+
         except Exception as e:
             st.error(f"❌ 程序执行出错！  \n错误信息：{str(e)}")
             
             # 如果出现异常，退还费用
-            with st.spinner("🔄 正在退还费用..."):
-                refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
             
             if refund_result["success"]:
                 st.session_state.current_balance = refund_result.get("new_balance")
@@ -528,6 +1213,8 @@ if app_mode == "语音转文字":
                 st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
         
         finally:
+            st.session_state.last_job_timing = timer.finish(job_status, deadline_s=deadline.seconds,
+                                                            deadline_left_s=round(deadline.remaining(), 3))
             # 无论成功或失败，都重置转录状态
             st.session_state.transcription_in_progress = False
             # 重新渲染页面以更新按钮状态
@@ -556,6 +1243,8 @@ if app_mode == "语音转文字":
             key="download_transcription"
         )
 
+    render_timing_panel("stt")
+
     # 格式问题说明
     with st.expander("ℹ️ 关于音频格式转录问题的说明"):
         st.markdown("""
@@ -597,7 +1286,7 @@ else:
     # 当模型切换时，重置语音选择状态
     if model != st.session_state.current_model:
         st.session_state.current_model = model
-        st.session_state.generated_audio = None
+        replace_result("generated_audio")
         st.session_state.generation_done = False
         st.session_state.current_text = ""  # 切换模型时清空文本输入
 
@@ -688,17 +1377,15 @@ else:
 
     # 检测文本变化并重置生成状态
     if input_text != st.session_state.current_text:
-        st.session_state.generated_audio = None
+        replace_result("generated_audio")
         st.session_state.generation_done = False
         st.session_state.current_text = input_text
 
     # 显示文本统计信息和预估费用
     if input_text:
         char_count = len(input_text)
-        # 计算文本字节数和预估费用
-        text_bytes = len(input_text.encode('utf-8'))
-        estimated_cost = (text_bytes / 1_000_000) * 50
-        estimated_cost = max(estimated_cost, 0.10)  # 最低 ¥0.10
+        # 按 UTF-8 字节数计算预估费用
+        estimated_cost = tts_cost(input_text)
         
         # 保存预估费用到session state
         st.session_state.estimated_cost = estimated_cost
@@ -716,7 +1403,9 @@ else:
     st.subheader("2. 生成语音")
     
     # 费用说明
-    st.info("💡 未生成完成请勿刷新页面，否则将生成失败，且失败扣除的费用将无法返还")
+    st.info(f"💡 超过 {TTS_UNIT_CHARS} 字的文本会分段合成并逐段保存进度：刷新页面或失败后重新提交相同的文本和参数，"
+            "只处理剩余的段，已完成的部分不会重复扣费；较短的文本未生成完成请勿刷新页面")
+    show_checkpoint_notice()
     
     # 检查是否正在生成语音
     is_tts_generating = st.session_state.get('tts_generation_in_progress', False)
@@ -741,16 +1430,69 @@ else:
             st.session_state.tts_generation_in_progress = False
             st.rerun()
         
+        timer = JobTimer("tts", text_bytes=len(input_text.encode('utf-8')), model=model)
+        deadline = Deadline()
+        job_status = "error"
+        
         # 使用之前计算的费用
         actual_cost = st.session_state.estimated_cost
         
         # 显示费用信息
         st.info(f"📊 文本统计: {len(input_text)} 字符, {len(input_text.encode('utf-8'))} UTF-8 字节")
         st.info(f"💰 实际费用: ¥{actual_cost:.2f} (按照 ¥50/百万 UTF-8 字节)")
+
+        # 较长的文本分段合成并保存进度，失败或刷新后重新提交只处理剩余的段
+        tts_params = {"model": model, "voice": voice, "speed": speed, "format": format_option}
+        job_id = checkpoint_store.job_id("tts", sub_key, tts_params, input_text.encode("utf-8"))
+        checkpoint_job = (checkpoint_store.load(job_id)
+                          or checkpoint_store.create_tts(job_id, input_text, tts_params, yuan_to_cents(actual_cost)))
+        if checkpoint_job is not None:
+            try:
+                def send_unit(unit, input_path, output_path):
+                    """合成一段文本并边下载边写入该段的结果文件；每段有独立的任务期限"""
+                    unit_deadline = Deadline()
+                    master_key = master_key_manager.get_random_master_key()
+                    text_size = len(unit["text"].encode("utf-8"))
+                    started = timer.now()
+                    try:
+                        response = requests.post(
+                            url=f"{SILICONFLOW_BASE_URL}/audio/speech",
+                            headers={"Authorization": f"Bearer {master_key}", "Content-Type": "application/json",
+                                     "traceparent": timer.traceparent()},
+                            data=json.dumps({"model": model, "input": unit["text"], "voice": voice, "speed": speed,
+                                             "response_format": format_option}),
+                            timeout=throughput_model.timeouts(master_key, "tts", text_size, unit_deadline),
+                            stream=True
+                        )
+                        try:
+                            if response.status_code != 200:
+                                raise UnitFailed(f"错误码 {response.status_code}，{response.text}")
+                            with open(output_path, "wb") as f:
+                                for chunk in response.iter_content(64 * 1024):
+                                    unit_deadline.check("下载生成的语音")
+                                    f.write(chunk)
+                            throughput_model.observe(master_key, "tts", text_size, timer.now() - started)
+                        finally:
+                            response.close()
+                    finally:
+                        timer.add_stage("unit", started, timer.now(), index=unit["index"], text_bytes=text_size)
+                
+                job_status, result_path = run_checkpointed_job(checkpoint_job, sub_key, timer, send_unit)
+                if result_path:
+                    with open(result_path, "rb") as result_file:
+                        handle = result_store.put(iter(lambda: result_file.read(64 * 1024), b""), format_option)
+                    replace_result("generated_audio", handle)
+                    st.session_state.generation_done = True
+                    checkpoint_job.delete()
+                    st.success("🎉 语音生成完成！")
+            finally:
+                st.session_state.last_job_timing = timer.finish(job_status, checkpointed=True)
+                st.session_state.tts_generation_in_progress = False
+                st.rerun()
     
         # 先验证子密钥并扣除费用
-        with st.spinner("🔑 验证子密钥中..."):
-            deduction_result = kms_client.validate_and_deduct(sub_key, amount=actual_cost)
+        with st.spinner("🔑 验证子密钥中..."), timer.span("kms_deduct"):
+            deduction_result = kms_client.charge(sub_key, amount=actual_cost, deadline=deadline)
             
             if not deduction_result["success"]:
                 st.error(f"❌ {deduction_result['error']}")
@@ -766,6 +1508,7 @@ else:
         
         # 保存当前费用用于可能的退款
         st.session_state.current_cost = actual_cost
+        st.session_state.current_charge = deduction_result
 
         # 获取一个随机的主密钥
         try:
@@ -777,7 +1520,7 @@ else:
             st.rerun()
 
         # 使用主密钥调用SiliconFlow API
-        api_url = "https://api.siliconflow.cn/v1/audio/speech"
+        api_url = f"{SILICONFLOW_BASE_URL}/audio/speech"
         headers = {
             "Authorization": f"Bearer {siliconflow_master_key}",  # 使用随机选择的主密钥
             "Content-Type": "application/json"
@@ -803,21 +1546,72 @@ else:
 
         try:
             # 显示真实加载状态（替代模拟进度条）
+            text_size = len(input_text.encode('utf-8'))
+            
+            def synthesize():
+                """调用 SiliconFlow 合成语音；相同文本和参数的并发请求只由第一个会话执行，响应过慢时用另一个主密钥对冲"""
+                def send(attempt):
+                    if attempt.hedge:
+                        timer.attrs["hedged"] = True
+                    request_started = timer.now()
+                    try:
+                        # 超时按文本大小和该主密钥最近的吞吐推算，并限制在任务期限内；预计来不及时直接失败
+                        response = requests.post(
+                            url=api_url,
+                            headers=dict(headers, Authorization=f"Bearer {attempt.master_key}",
+                                         traceparent=timer.traceparent(attempt.span_id)),
+                            data=json.dumps(payload),
+                            timeout=throughput_model.timeouts(attempt.master_key, "tts", text_size, deadline),
+                            stream=True
+                        )
+                        if response.status_code == 200:
+                            throughput_model.observe(attempt.master_key, "tts", text_size, timer.now() - request_started)
+                        return response
+                    except requests.exceptions.Timeout:
+                        throughput_model.count("timeouts")
+                        raise
+                    finally:
+                        if not attempt.cancelled.is_set():
+                            timer.add_stage("hedge_siliconflow" if attempt.hedge else "siliconflow",
+                                            request_started, timer.now(), span_id=attempt.span_id)
+                
+                response, winner, _ = hedger.call("tts", text_size, send, siliconflow_master_key,
+                                                  master_key_manager.get_alternate_master_key)
+                timer.attrs["hedge_won"] = winner.hedge
+                if response.status_code != 200:
+                    return SharedResponse.from_response(response)
+                # 生成的音频边下载边写入暂存区，不在内存中保留完整副本；下载超过任务期限时中止
+                def chunks():
+                    for chunk in response.iter_content(64 * 1024):
+                        deadline.check("下载生成的语音")
+                        yield chunk
+                with timer.span("store_result"):
+                    try:
+                        handle = result_store.put(chunks(), format_option)
+                    finally:
+                        response.close()
+                return SharedResponse.from_response(response, handle)
+            
             with st.spinner("🔄 正在生成语音，请稍候...（文本越长耗时越久）"):
-                response = requests.post(
-                    url=api_url,
-                    headers=headers,
-                    data=json.dumps(payload),
-                    timeout=300  # 5分钟超时设置
-                )
+                call_started = timer.now()
+                signature = request_signature("tts", model, voice, speed, format_option, input_text)
+                response, coalesced = coalescer.do(signature, synthesize)
+                timer.attrs["coalesced"] = coalesced
+                if coalesced:
+                    timer.add_stage("coalesced_wait", call_started, timer.now())
 
             # 处理API响应
             if response.status_code == 200:
-                # 保存生成的音频数据
-                st.session_state.generated_audio = response.content
-                st.session_state.generation_done = True
+                # 共享结果时为本会话创建独立句柄，各会话替换结果时互不影响
+                handle = result_store.clone(response.handle) if coalesced else response.handle
+                replace_result("generated_audio", handle)
+                st.session_state.generation_done = handle is not None
+                job_status = "ok"
                 st.success("🎉 语音生成完成！")
+                if coalesced:
+                    settle_coalesced(sub_key, timer)
             else:
+                job_status = "upstream_error"
                 # 尝试解析错误信息（API可能返回JSON格式错误）
                 try:
                     error_detail = response.json().get("error", {}).get("message", "未知错误")
@@ -826,8 +1620,8 @@ else:
                 st.error(f"❌ 语音生成失败！\n错误码：{response.status_code}\n错误信息：{error_detail}")
                 
                 # 如果API调用失败，退还费用
-                with st.spinner("🔄 正在退还费用..."):
-                    refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+                with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                    refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
                 
                 if refund_result["success"]:
                     st.session_state.current_balance = refund_result.get("new_balance")
@@ -835,12 +1629,27 @@ else:
                 else:
                     st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
 
+        except DeadlineExceeded as e:
+            job_status = "deadline"
+            st.error(f"❌ 语音生成未能在期限内完成：{str(e)}")
+            
+            # 超过任务期限，退还费用
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
+            
+            if refund_result["success"]:
+                st.session_state.current_balance = refund_result.get("new_balance")
+                st.success(f"💰 已成功退还费用！当前余额: {st.session_state.current_balance:.2f}")
+            else:
+                st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
+
         except requests.exceptions.Timeout:
+            job_status = "timeout"
             st.error("❌ 请求超时！请检查网络或尝试缩短文本长度后重试")
             
             # 如果超时，退还费用
-            with st.spinner("🔄 正在退还费用..."):
-                refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
             
             if refund_result["success"]:
                 st.session_state.current_balance = refund_result.get("new_balance")
@@ -852,8 +1661,8 @@ else:
             st.error("❌ 网络连接错误！请检查你的网络设置")
             
             # 如果连接错误，退还费用
-            with st.spinner("🔄 正在退还费用..."):
-                refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
             
             if refund_result["success"]:
                 st.session_state.current_balance = refund_result.get("new_balance")
@@ -865,8 +1674,8 @@ else:
             st.error(f"❌ 程序执行出错！\n错误信息：{str(e)}")
             
             # 如果出现异常，退还费用
-            with st.spinner("🔄 正在退还费用..."):
-                refund_result = kms_client.validate_and_deduct(sub_key, amount=-st.session_state.current_cost)
+            with st.spinner("🔄 正在退还费用..."), timer.span("refund"):
+                refund_result = kms_client.refund(sub_key, st.session_state.current_cost, st.session_state.current_charge)
             
             if refund_result["success"]:
                 st.session_state.current_balance = refund_result.get("new_balance")
@@ -875,6 +1684,8 @@ else:
                 st.warning(f"⚠️ 退款失败: {refund_result['error']}，请联系管理员")
         
         finally:
+            st.session_state.last_job_timing = timer.finish(job_status, deadline_s=deadline.seconds,
+                                                            deadline_left_s=round(deadline.remaining(), 3))
             # 无论成功或失败，都重置生成状态
             st.session_state.tts_generation_in_progress = False
             # 重新渲染页面以更新按钮状态
@@ -883,19 +1694,26 @@ else:
     # 显示生成的语音
     if st.session_state.generation_done and st.session_state.generated_audio:
         st.subheader("3. 生成的语音")
+        generated_path = result_store.path(st.session_state.generated_audio)
         
-        # 显示音频播放器
-        st.audio(st.session_state.generated_audio, format=f"audio/{format_option}")
-        
-        # 提供下载链接
-        st.download_button(
-            label=f"📥 下载音频 ({format_option.upper()})",
-            data=st.session_state.generated_audio,
-            file_name=f"tts.{format_option}",
-            mime=f"audio/{format_option}",
-            type="secondary",
-            key="tts_download_btn"
-        )
+        if generated_path is None:
+            st.warning("⚠️ 生成的语音已过期被清理，请重新生成")
+        else:
+            # 显示音频播放器（直接从暂存文件读取）
+            st.audio(generated_path, format=f"audio/{format_option}")
+            
+            # 提供下载链接
+            with open(generated_path, "rb") as generated_file:
+                st.download_button(
+                    label=f"📥 下载音频 ({format_option.upper()})",
+                    data=generated_file,
+                    file_name=f"tts.{format_option}",
+                    mime=f"audio/{format_option}",
+                    type="secondary",
+                    key="tts_download_btn"
+                )
+
+    render_timing_panel("tts")
 
     # 使用说明
     with st.expander("ℹ️ 功能说明与模型差异"):